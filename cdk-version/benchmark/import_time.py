@@ -0,0 +1,58 @@
+"""
+Import time of the handler modules, from the -X importtime report of a fresh
+interpreter that does nothing but import the handler, so a dependency that
+starts loading at cold start shows up in the benchmark output.
+"""
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+from .local_aws import FAKE_CREDENTIALS
+
+MARKER = "benchmark: loading handler"
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """
+    The modules the handler imports directly (name, self us, cumulative us),
+    everything they import in turn is in their cumulative time.
+    """
+    if MARKER not in stderr:
+        return []
+    imports = []
+    for line in stderr.split(MARKER, 1)[1].splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            continue
+        # nested imports are indented below the module that imports them
+        if name[1:2] != " ":
+            imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def import_report(stage_name: str, region: str = "us-east-1", top: int = 5) -> dict:
+    env = dict(os.environ, AWS_DEFAULT_REGION=region, AWS_REGION=region, **FAKE_CREDENTIALS)
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-m", "benchmark.import_time", stage_name],
+                               cwd=PACKAGE_PARENT, env=env, capture_output=True, text=True)
+    if completed.returncode:
+        return {"stage": stage_name, "error": (completed.stderr.strip().splitlines() or ["failed"])[-1]}
+    imports = sorted(parse_importtime(completed.stderr), key=lambda entry: entry[2], reverse=True)
+    return {"stage": stage_name, "import_ms": sum(entry[2] for entry in imports) / 1000,
+            "slowest_imports": [{"module": name, "ms": cumulative_us / 1000} for name, _, cumulative_us in imports[:top]]}
+
+
+def _load(stage_name: str):
+    from .stages import STAGES, load_handler
+
+    stage = STAGES[stage_name]
+    app_dir = stage.app_dir()
+    print(MARKER, file=sys.stderr, flush=True)
+    load_handler(app_dir, stage.module_file)
+
+
+if __name__ == "__main__":
+    _load(sys.argv[1])
@@ -0,0 +1,25 @@
+import os
+from contextlib import contextmanager
+
+FAKE_CREDENTIALS = {
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_SECURITY_TOKEN": "testing",
+    "AWS_SESSION_TOKEN": "testing",
+}
+
+
+@contextmanager
+def local_aws(region: str = "us-east-1"):
+    """
+    In-process stand-in for S3 and Step Functions. The credentials are fake,
+    so a call that moto does not intercept fails instead of reaching AWS.
+    """
+    # not at the top, the import time report must not find boto3 loaded by moto
+    from moto import mock_aws
+
+    os.environ.update(FAKE_CREDENTIALS)
+    os.environ["AWS_DEFAULT_REGION"] = region
+    os.environ["AWS_REGION"] = region
+    with mock_aws():
+        yield
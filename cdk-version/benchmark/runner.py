@@ -0,0 +1,189 @@
+"""
+Runs the Lambda handlers in-process against synthetic Textract output in a
+local S3 stand-in, and reports wall time, peak RSS and pages per second.
+
+    cd cdk-version
+    python -m benchmark.runner --pages 1 10 100 1000 3000 --json benchmark.json
+
+Every stage and size runs in a fresh process, so the imports, the clients and
+the peak RSS of one case do not carry over into the next. The import time of
+every handler is reported from the -X importtime output of an interpreter
+that only imports it.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from dataclasses import asdict
+
+from .import_time import import_report
+from .textract_generator import DocumentSpec
+
+DEFAULT_PAGES = [1, 10, 100, 1000, 3000]
+
+
+def current_rss() -> int:
+    """Resident set size in bytes, 0 where there is no /proc."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def max_rss() -> int:
+    """Peak resident set size of the process so far, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    """
+    Samples the RSS while the handler runs. ru_maxrss alone would report the
+    peak of generating the input whenever that is higher than the peak of the
+    handler.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def run_case(stage_name: str, spec: DocumentSpec, connection):
+    """Child process: prepares the input, imports the handler and times a single invocation."""
+    try:
+        import boto3
+        from .local_aws import local_aws
+        from .stages import BUCKET, STAGES, load_handler
+
+        stage = STAGES[stage_name]
+        with local_aws():
+            s3_client = boto3.client("s3")
+            s3_client.create_bucket(Bucket=BUCKET)
+            event, environment = stage.prepare(s3_client, spec)
+            os.environ.update(environment)
+
+            started = time.perf_counter()
+            handler = load_handler(stage.app_dir(), stage.module_file)
+            import_seconds = time.perf_counter() - started
+
+            gc.collect()
+            rss_before = current_rss()
+            started = time.perf_counter()
+            # the EMF records the handlers write to stdout go into the results instead of the table
+            emitted = io.StringIO()
+            with RssSampler() as sampler, contextlib.redirect_stdout(emitted):
+                handler(event, None)
+            wall_seconds = time.perf_counter() - started
+
+        peak_rss = sampler.peak if rss_before else max_rss()
+        connection.send({"stage": stage_name, "pages": spec.pages, "wall_seconds": wall_seconds,
+                         "import_seconds": import_seconds, "pages_per_second": spec.pages / wall_seconds,
+                         "rss_before_bytes": rss_before, "peak_rss_bytes": peak_rss,
+                         "metrics": [json.loads(line) for line in emitted.getvalue().splitlines() if line.startswith('{"_aws"')]})
+    except Exception as e:
+        connection.send({"stage": stage_name, "pages": spec.pages, "error": f"{type(e).__name__}: {e}"})
+    finally:
+        connection.close()
+
+
+def run(stage_name: str, spec: DocumentSpec) -> dict:
+    # a plain process rather than a pool worker, the text formatting starts processes of its own
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_case, args=(stage_name, spec, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"stage": stage_name, "pages": spec.pages, "error": "benchmark process died"}
+    process.join()
+    return result
+
+
+def print_result(result: dict):
+    if "error" in result:
+        print(f"{result['stage']:<20} {result['pages']:>6}  {result['error']}")
+        return
+    mb = 1024 * 1024
+    print(f"{result['stage']:<20} {result['pages']:>6} {result['wall_seconds']:>10.3f} {result['pages_per_second']:>10.1f} "
+          f"{result['peak_rss_bytes'] / mb:>10.1f} {(result['peak_rss_bytes'] - result['rss_before_bytes']) / mb:>10.1f} "
+          f"{result['import_seconds']:>9.3f}")
+
+
+def print_import_report(report: dict):
+    if "error" in report:
+        print(f"{report['stage']:<20} {report['error']}")
+        return
+    slowest = ", ".join(f"{entry['module']} {entry['ms']:.1f}" for entry in report["slowest_imports"])
+    print(f"{report['stage']:<20} {report['import_ms']:>8.1f} ms  {slowest}")
+
+
+def parse_arguments(argv=None):
+    from .stages import STAGES
+
+    parser = argparse.ArgumentParser(description="Benchmark the Lambda handlers offline against synthetic Textract output")
+    parser.add_argument("--pages", type=int, nargs="+", default=DEFAULT_PAGES, help="document sizes in pages")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--lines-per-page", type=int, default=DocumentSpec.lines_per_page)
+    parser.add_argument("--words-per-line", type=int, default=DocumentSpec.words_per_line)
+    parser.add_argument("--tables-per-page", type=int, default=DocumentSpec.tables_per_page)
+    parser.add_argument("--key-values-per-page", type=int, default=DocumentSpec.key_values_per_page)
+    parser.add_argument("--skew", type=float, default=DocumentSpec.skew, help="rotation of the pages in radians")
+    parser.add_argument("--seed", type=int, default=DocumentSpec.seed)
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    print(f"{'stage':<20} {'pages':>6} {'wall s':>10} {'pages/s':>10} {'peak MB':>10} {'+RSS MB':>10} {'import s':>9}")
+    results = []
+    for stage_name in args.stages:
+        for pages in args.pages:
+            spec = DocumentSpec(pages=pages, lines_per_page=args.lines_per_page, words_per_line=args.words_per_line,
+                                tables_per_page=args.tables_per_page, key_values_per_page=args.key_values_per_page,
+                                skew=args.skew, seed=args.seed)
+            result = run(stage_name, spec)
+            result["spec"] = asdict(spec)
+            print_result(result)
+            results.append(result)
+
+    print(f"\n{'stage':<20} {'imports':>11}  slowest direct imports, ms")
+    import_reports = []
+    for stage_name in args.stages:
+        report = import_report(stage_name)
+        print_import_report(report)
+        import_reports.append(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"cases": results, "imports": import_reports}, f, indent=2)
+    return 1 if any("error" in result for result in results + import_reports) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
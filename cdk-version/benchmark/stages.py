@@ -0,0 +1,146 @@
+import importlib.util
+import io
+import os
+import shutil
+import sys
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, Dict, Tuple
+
+from .textract_generator import DocumentSpec, write_async_output, write_merged_json
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambda")
+BUCKET = "benchmark"
+JOB_ID = "benchmark-job"
+
+
+def load_handler(app_dir: str, module_file: str) -> Callable:
+    """
+    Imports the handler module like the Lambda runtime would, with the app
+    folder first on the path and the shared modules the images copy next to
+    it. Every Lambda has its own utils package, so the one of an earlier stage
+    is dropped first.
+    """
+    for name in [name for name in sys.modules if name == "utils" or name.startswith("utils.")]:
+        del sys.modules[name]
+    sys.path.insert(0, os.path.join(LAMBDA_DIR, "shared"))
+    sys.path.insert(0, app_dir)
+    module_name = os.path.splitext(module_file)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(app_dir, module_file))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module.lambda_handler
+
+
+def async_to_json_dir() -> str:
+    """
+    The layout of the async_to_json image, see its Dockerfile, in a temporary
+    folder. The image carries the text and analytics modules for the fused
+    output, the app folder alone does not import.
+    """
+    app_dir = tempfile.mkdtemp(prefix="async_to_json_")
+    source = os.path.join(LAMBDA_DIR, "async_to_json", "app")
+    for name in os.listdir(source):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(source, name), app_dir)
+    shutil.copytree(os.path.join(source, "utils"), os.path.join(app_dir, "utils"),
+                    ignore=shutil.ignore_patterns("__pycache__"))
+    shutil.copy(os.path.join(LAMBDA_DIR, "textract-to-txt", "app", "utils", "format_ocr_text.py"),
+                os.path.join(app_dir, "utils"))
+    shutil.copy(os.path.join(LAMBDA_DIR, "textract-analytics", "app", "utils", "analyze_textract.py"),
+                os.path.join(app_dir, "utils"))
+    return app_dir
+
+
+@dataclass
+class Stage:
+    """
+    A Lambda under benchmark. prepare writes the input of the handler to the
+    stand-in and returns the event and the environment of the function, so
+    nothing of the preparation is in the measured time.
+    """
+    app_dir: Callable[[], str]
+    module_file: str
+    prepare: Callable[..., Tuple[dict, Dict[str, str]]]
+
+
+def _prepare_decider(s3_client, spec: DocumentSpec):
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for _ in range(spec.pages):
+        writer.add_blank_page(width=612, height=792)
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    key = f"uploads/{spec.pages}-pages.pdf"
+    s3_client.put_object(Bucket=BUCKET, Key=key, Body=pdf.getvalue())
+    return {"Key": key, "Size": pdf.tell()}, {"S3_BUCKET": BUCKET}
+
+
+def _decider_result(spec: DocumentSpec) -> dict:
+    """The part of the decider result the state machine passes on to the later stages."""
+    return {"manifest": {"s3Path": f"s3://{BUCKET}/uploads/{spec.pages}-pages.pdf"},
+            "mime": "application/pdf", "numberOfPages": spec.pages}
+
+
+def _async_to_json_event(s3_client, spec: DocumentSpec) -> dict:
+    write_async_output(s3_client, BUCKET, "textract-temp", JOB_ID, spec)
+    return {"Payload": _decider_result(spec),
+            "textract_result": {"TextractTempOutputJsonPath": f"s3://{BUCKET}/textract-temp/{JOB_ID}"}}
+
+
+def _prepare_async_to_json(s3_client, spec: DocumentSpec):
+    return _async_to_json_event(s3_client, spec), {"S3_OUTPUT_BUCKET": BUCKET, "S3_OUTPUT_PREFIX": "textract-json"}
+
+
+def _prepare_async_to_json_fused(s3_client, spec: DocumentSpec):
+    return _async_to_json_event(s3_client, spec), {"S3_OUTPUT_BUCKET": BUCKET, "S3_OUTPUT_PREFIX": "textract-json",
+                                                   "FUSED_TEXT_ANALYTICS": "true", "OUTPUT_PREFIX": "textract-txt"}
+
+
+def _upload_merged_json(s3_client, spec: DocumentSpec) -> str:
+    key = f"textract-json/{JOB_ID}.json"
+    with tempfile.TemporaryFile() as merged:
+        write_merged_json(merged, spec)
+        merged.seek(0)
+        s3_client.upload_fileobj(merged, BUCKET, key)
+    return f"s3://{BUCKET}/{key}"
+
+
+def _prepare_textract_to_txt(s3_client, spec: DocumentSpec):
+    event = {"Payload": _decider_result(spec),
+             "textract_result": {"TextractOutputJsonPath": _upload_merged_json(s3_client, spec)}}
+    return event, {"OUTPUT_PREFIX": "textract-txt"}
+
+
+def _prepare_textract_analytics(s3_client, spec: DocumentSpec):
+    event = {"Payload": _decider_result(spec),
+             "textract_result": {"TextractOutputJsonPath": _upload_merged_json(s3_client, spec)}}
+    return event, {}
+
+
+def _prepare_startpipeline(s3_client, spec: DocumentSpec):
+    """One S3 notification record per page, the size here is the number of uploaded documents."""
+    import boto3
+
+    state_machine = boto3.client("stepfunctions").create_state_machine(
+        name="benchmark", roleArn="arn:aws:iam::123456789012:role/benchmark",
+        definition='{"StartAt": "Done", "States": {"Done": {"Type": "Succeed"}}}')
+    records = [{"eventSource": "aws:s3", "s3": {"bucket": {"name": BUCKET}, "object": {"key": f"uploads/document-{number}.pdf"}}}
+               for number in range(spec.pages)]
+    return {"Records": records}, {"STATE_MACHINE_ARN": state_machine["stateMachineArn"]}
+
+
+def _app(name: str) -> Callable[[], str]:
+    return lambda: os.path.join(LAMBDA_DIR, name, "app")
+
+
+STAGES: Dict[str, Stage] = {
+    "decider": Stage(_app("map-decider"), "decider_main.py", _prepare_decider),
+    "async_to_json": Stage(async_to_json_dir, "main.py", _prepare_async_to_json),
+    "async_to_json_fused": Stage(async_to_json_dir, "main.py", _prepare_async_to_json_fused),
+    "textract_to_txt": Stage(_app("textract-to-txt"), "textract-to-txt.py", _prepare_textract_to_txt),
+    "textract_analytics": Stage(_app("textract-analytics"), "start_textract-analytics.py", _prepare_textract_analytics),
+    "startpipeline": Stage(_app("startpipeline"), "start_execution.py", _prepare_startpipeline),
+}
@@ -0,0 +1,152 @@
+import json
+import math
+import random
+import uuid
+from dataclasses import dataclass
+from typing import Iterator, List
+
+# GetDocumentTextDetection returns at most 1000 blocks per page of results,
+# the async output in S3 has one file per page of results
+BLOCKS_PER_PART = 1000
+
+
+@dataclass
+class DocumentSpec:
+    """
+    Shape of a synthetic Textract response. Every page gets lines_per_page
+    lines of words_per_line words (every third line has a second column),
+    tables_per_page 2x2 tables and key_values_per_page KEY/VALUE pairs. The
+    pages are rotated by skew radians, alternating the direction.
+    """
+    pages: int = 1
+    lines_per_page: int = 40
+    words_per_line: int = 8
+    tables_per_page: int = 1
+    key_values_per_page: int = 2
+    skew: float = 0.01
+    seed: int = 1
+
+
+def _geometry(left: float, top: float, width: float, height: float) -> dict:
+    return {
+        "BoundingBox": {"Width": width, "Height": height, "Left": left, "Top": top},
+        "Polygon": [{"X": left, "Y": top}, {"X": left + width, "Y": top},
+                    {"X": left + width, "Y": top + height}, {"X": left, "Y": top + height}]
+    }
+
+
+def _skewed(geometry: dict, angle: float) -> dict:
+    """Rotates the box around the top left corner of the page, like a scanned page that is slightly off."""
+    tan = math.tan(angle)
+    box = geometry['BoundingBox']
+    box['Top'] += box['Left'] * tan
+    for point in geometry['Polygon']:
+        point['Y'] += point['X'] * tan
+    return geometry
+
+
+def iter_page_blocks(spec: DocumentSpec) -> Iterator[List[dict]]:
+    """Yields the blocks of each page, so a large document never has to be in memory at once."""
+    rnd = random.Random(spec.seed)
+    new_id = lambda: str(uuid.UUID(int=rnd.getrandbits(128)))
+    for page_number in range(1, spec.pages + 1):
+        angle = spec.skew if page_number % 2 else -spec.skew
+        page = {"BlockType": "PAGE", "Id": new_id(), "Page": page_number,
+                "Geometry": _skewed(_geometry(0.0, 0.0, 1.0, 1.0), angle),
+                "Relationships": [{"Type": "CHILD", "Ids": []}]}
+        blocks = [page]
+        words_on_page = []
+        line_height = 0.9 / max(1, spec.lines_per_page)
+        for line_number in range(spec.lines_per_page):
+            top = 0.05 + line_number * line_height + rnd.uniform(-0.1, 0.1) * line_height
+            for left in ([0.05, 0.55] if line_number % 3 == 0 else [0.05]):
+                words = []
+                for word_number in range(spec.words_per_line):
+                    text = "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(1, 10)))
+                    words.append({"BlockType": "WORD", "Confidence": rnd.uniform(80, 100), "Text": text,
+                                  "TextType": "PRINTED", "Id": new_id(), "Page": page_number,
+                                  "Geometry": _skewed(_geometry(left + word_number * 0.05, top, 0.045, line_height * 0.8), angle)})
+                line = {"BlockType": "LINE", "Confidence": rnd.uniform(80, 100),
+                        "Text": " ".join(word["Text"] for word in words), "Id": new_id(), "Page": page_number,
+                        "Geometry": _skewed(_geometry(left, top, 0.4, line_height * 0.8), angle),
+                        "Relationships": [{"Type": "CHILD", "Ids": [word["Id"] for word in words]}]}
+                page["Relationships"][0]["Ids"].append(line["Id"])
+                blocks.append(line)
+                blocks.extend(words)
+                words_on_page.extend(words)
+        for _ in range(spec.tables_per_page):
+            cells = [{"BlockType": "CELL", "Confidence": rnd.uniform(50, 100), "Id": new_id(), "Page": page_number,
+                      "RowIndex": cell // 2 + 1, "ColumnIndex": cell % 2 + 1, "RowSpan": 1, "ColumnSpan": 1,
+                      "Geometry": _skewed(_geometry(0.1 + cell % 2 * 0.2, 0.6 + cell // 2 * 0.1, 0.2, 0.1), angle)}
+                     for cell in range(4)]
+            blocks.append({"BlockType": "TABLE", "Confidence": rnd.uniform(50, 100), "Id": new_id(), "Page": page_number,
+                           "Geometry": _skewed(_geometry(0.1, 0.6, 0.4, 0.2), angle),
+                           "Relationships": [{"Type": "CHILD", "Ids": [cell["Id"] for cell in cells]}]})
+            blocks.extend(cells)
+        for pair in range(min(spec.key_values_per_page, len(words_on_page) // 2)):
+            key_word, value_word = words_on_page[2 * pair], words_on_page[2 * pair + 1]
+            value_id = new_id()
+            blocks.append({"BlockType": "KEY_VALUE_SET", "EntityTypes": ["KEY"], "Confidence": rnd.uniform(50, 100),
+                           "Id": new_id(), "Page": page_number, "Geometry": key_word["Geometry"],
+                           "Relationships": [{"Type": "VALUE", "Ids": [value_id]}, {"Type": "CHILD", "Ids": [key_word["Id"]]}]})
+            blocks.append({"BlockType": "KEY_VALUE_SET", "EntityTypes": ["VALUE"], "Confidence": rnd.uniform(50, 100),
+                           "Id": value_id, "Page": page_number, "Geometry": value_word["Geometry"],
+                           "Relationships": [{"Type": "CHILD", "Ids": [value_word["Id"]]}]})
+        yield blocks
+
+
+def iter_async_output_parts(spec: DocumentSpec, blocks_per_part: int = BLOCKS_PER_PART) -> Iterator[dict]:
+    """
+    The numbered output files of an async job (1, 2, ...), blocks_per_part
+    blocks each, every file but the last with a NextToken.
+    """
+    def chunks():
+        buffer: List[dict] = []
+        for blocks in iter_page_blocks(spec):
+            buffer.extend(blocks)
+            while len(buffer) >= blocks_per_part:
+                yield buffer[:blocks_per_part]
+                buffer = buffer[blocks_per_part:]
+        if buffer:
+            yield buffer
+
+    previous = None
+    for chunk in chunks():
+        if previous is not None:
+            yield _part(spec, previous, next_token=True)
+        previous = chunk
+    if previous is not None:
+        yield _part(spec, previous, next_token=False)
+
+
+def _part(spec: DocumentSpec, blocks: List[dict], next_token: bool) -> dict:
+    part = {"DocumentMetadata": {"Pages": spec.pages}, "JobStatus": "SUCCEEDED",
+            "DetectDocumentTextModelVersion": "1.0", "Blocks": blocks}
+    if next_token:
+        part["NextToken"] = uuid.uuid4().hex
+    return part
+
+
+def write_async_output(s3_client, bucket: str, prefix: str, job_id: str, spec: DocumentSpec,
+                       blocks_per_part: int = BLOCKS_PER_PART) -> int:
+    """Writes the output of an async job to s3://bucket/prefix/job_id/, like Textract does, returns the number of files."""
+    s3_client.put_object(Bucket=bucket, Key=f"{prefix}/{job_id}/.s3_access_check", Body=b"")
+    number_of_parts = 0
+    for number_of_parts, part in enumerate(iter_async_output_parts(spec, blocks_per_part), 1):
+        s3_client.put_object(Bucket=bucket, Key=f"{prefix}/{job_id}/{number_of_parts}", Body=json.dumps(part).encode('utf-8'))
+    return number_of_parts
+
+
+def write_merged_json(file_obj, spec: DocumentSpec):
+    """Writes the merged JSON of all parts, as async_to_json produces it, a page at a time."""
+    file_obj.write(json.dumps({"DocumentMetadata": {"Pages": spec.pages}, "JobStatus": "SUCCEEDED",
+                               "DetectDocumentTextModelVersion": "1.0"})[:-1].encode('utf-8'))
+    file_obj.write(b', "Blocks": [')
+    first = True
+    for blocks in iter_page_blocks(spec):
+        for block in blocks:
+            if not first:
+                file_obj.write(b', ')
+            file_obj.write(json.dumps(block).encode('utf-8'))
+            first = False
+    file_obj.write(b']}')
@@ -10,7 +10,8 @@ from aws_cdk import (
     aws_stepfunctions_tasks as sfn_tasks,
     aws_lambda as lambda_,
     aws_iam as iam,
-    aws_s3 as s3    
+    aws_s3 as s3,
+    aws_dynamodb as dynamodb
 )
 import amazon_textract_idp_cdk_constructs as tcdk
 
@@ -64,6 +65,54 @@ class ServerlessIDPArchivePipeline(Stack):
             default="txt_output",
             description="The name of the S3 prefix for the text output"
             )                
+        text_format_workers = CfnParameter(
+            self, 
+            "TextFormatWorkers", 
+            type="Number",
+            default=0,
+            min_value=0,
+            description="Number of processes the text formatting uses to lay out pages in parallel, 0 uses one per vCPU of the Lambda memory tier"
+            )
+        compact_block_store = CfnParameter(
+            self, 
+            "CompactBlockStore", 
+            type="String",
+            default="false",
+            allowed_values=["true", "false"],
+            description="Write a compact per block type NDJSON sidecar next to the merged textract json for the downstream steps to read"
+            )
+        fused_text_analytics = CfnParameter(
+            self, 
+            "FusedTextAnalytics", 
+            type="String",
+            default="false",
+            allowed_values=["true", "false"],
+            description="Write the txt and analytics output for async documents while merging the textract json, instead of in the TextractToTxt and Textract-Analytics steps"
+            )
+        decider_batch_size = CfnParameter(
+            self, 
+            "DeciderBatchSize", 
+            type="Number",
+            default=1,
+            min_value=1,
+            description="Number of S3 objects the map-decider classifies per invocation (ItemBatcher MaxItemsPerBatch), keep it small enough for the results of a batch to stay below 256 KB"
+            )
+        dedup_cache = CfnParameter(
+            self, 
+            "DedupCache", 
+            type="String",
+            default="false",
+            allowed_values=["true", "false"],
+            description="Skip Textract for documents with the same content (ETag and size) as a document processed before and point to its output"
+            )
+        profiler = CfnParameter(
+            self, 
+            "Profiler", 
+            type="String",
+            default="off",
+            allowed_values=["off", "cprofile", "tracemalloc", "sampler"],
+            description="Profile the Lambda invocations and write the profiles to the profiles prefix of the pipeline bucket, PROFILE_* environment variables of a function narrow it down"
+            )
         
         document_bucket = s3.Bucket(self,
                                     "Serverless-IDP-Archive-Pipeline",
@@ -82,19 +131,33 @@ class ServerlessIDPArchivePipeline(Stack):
 
         workflow_name = "ServerlessIDPArchivePipeline"
 
+        dedup_table = dynamodb.Table(
+            self,
+            f"{workflow_name}-DedupCache",
+            partition_key=dynamodb.Attribute(name="ContentHash", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
         lambda_custom_decider = lambda_.DockerImageFunction(
             self,
             f"{workflow_name}-map-decider",
             code=lambda_.DockerImageCode.from_image_asset(
-                os.path.join(script_location, '../lambda/map-decider')
+                os.path.join(script_location, '../lambda'),
+                file='map-decider/Dockerfile'
             ),
             memory_size=128,
             timeout=Duration.seconds(900),
             architecture=lambda_.Architecture.X86_64,
             environment={
-                'S3_BUCKET': source_bucket.value_as_string
+                'S3_BUCKET': source_bucket.value_as_string,
+                'DEDUP_CACHE': dedup_cache.value_as_string,
+                'DEDUP_CACHE_TABLE': dedup_table.table_name,
+                'PROFILER': profiler.value_as_string,
+                'PROFILE_BUCKET': s3_output_bucket
             }            
         )
+        dedup_table.grant_read_data(lambda_custom_decider)
 
         decider_task = sfn_tasks.LambdaInvoke(
             self,
@@ -147,26 +210,39 @@ class ServerlessIDPArchivePipeline(Stack):
             self,
             f"{workflow_name}-async_to_json",
             code=lambda_.DockerImageCode.from_image_asset(
-                os.path.join(script_location, '../lambda/async_to_json')
+                os.path.join(script_location, '../lambda'),
+                file='async_to_json/Dockerfile'
             ),
             memory_size=10240,
             timeout=Duration.seconds(900),
             architecture=lambda_.Architecture.X86_64,
             environment={
                 'S3_OUTPUT_BUCKET': s3_output_bucket,
-                'S3_OUTPUT_PREFIX': s3_output_prefix.value_as_string
+                'S3_OUTPUT_PREFIX': s3_output_prefix.value_as_string,
+                'MERGE_MODE': 'STREAMING',
+                'WRITE_BLOCK_STORE': compact_block_store.value_as_string,
+                'FUSED_TEXT_ANALYTICS': fused_text_analytics.value_as_string,
+                'OUTPUT_PREFIX': s3_txt_output_prefix.value_as_string,
+                'FORMAT_WORKERS': text_format_workers.value_as_string,
+                'PROFILER': profiler.value_as_string
             }            
         )
         
+        # async_to_json returns its event with the updated textract_result, keep the state flat
+        # as {"Payload": <decider result>, "textract_result": ...} like after the sync task
         textract_async_to_json = sfn_tasks.LambdaInvoke(
             self,
             f"{workflow_name}-TaskGenerate-async-to-json",            
-            lambda_function=textract_async_to_json_lambda)        
+            lambda_function=textract_async_to_json_lambda,
+            result_selector={
+                "Payload.$": "$.Payload.Payload",
+                "textract_result.$": "$.Payload.textract_result"
+            })        
         
         textract_async_to_json_lambda.add_to_role_policy(
             iam.PolicyStatement(
                 effect=iam.Effect.ALLOW,
-                actions=["s3:GetObject", "s3:PutObject", "s3:ListBucket"],
+                actions=["s3:GetObject", "s3:PutObject", "s3:ListBucket", "s3:AbortMultipartUpload"],
                 resources=[bucket_arn, f"{bucket_arn}/*"],
             )
         )
@@ -174,20 +250,24 @@ class ServerlessIDPArchivePipeline(Stack):
             self,
             f"{workflow_name}-TextractToTxt",
             code=lambda_.DockerImageCode.from_image_asset(
-                os.path.join(script_location, '../lambda/textract-to-txt')
+                os.path.join(script_location, '../lambda'),
+                file='textract-to-txt/Dockerfile'
             ),
             memory_size=2048,
             timeout=Duration.seconds(900),
             architecture=lambda_.Architecture.X86_64,
             environment={
-                'OUTPUT_PREFIX': s3_txt_output_prefix.value_as_string
+                'OUTPUT_PREFIX': s3_txt_output_prefix.value_as_string,
+                'FORMAT_WORKERS': text_format_workers.value_as_string,
+                'PROFILER': profiler.value_as_string
             }            
         )
 
         task_generate_lambda_textract_to_txt = sfn_tasks.LambdaInvoke(
             self,
             f"{workflow_name}-TaskGenerate-TextractToTxt",            
-            lambda_function=lambda_textract_to_txt)
+            lambda_function=lambda_textract_to_txt,
+            result_path=sfn.JsonPath.DISCARD)
                 
         lambda_textract_to_txt.add_to_role_policy(
             iam.PolicyStatement(
@@ -201,17 +281,22 @@ class ServerlessIDPArchivePipeline(Stack):
             self,
             f"{workflow_name}-Textract-Analytics",
             code=lambda_.DockerImageCode.from_image_asset(
-                os.path.join(script_location, '../lambda/textract-analytics')
+                os.path.join(script_location, '../lambda'),
+                file='textract-analytics/Dockerfile'
             ),
             memory_size=10240,
             timeout=Duration.seconds(900),
-            architecture=lambda_.Architecture.X86_64         
+            architecture=lambda_.Architecture.X86_64,
+            environment={
+                'PROFILER': profiler.value_as_string
+            }
         )
 
         task_generate_lambda_textract_analytics = sfn_tasks.LambdaInvoke(
             self,
             f"{workflow_name}-TaskGenerate-Analytics",            
-            lambda_function=lambda_textract_analytics)
+            lambda_function=lambda_textract_analytics,
+            result_path=sfn.JsonPath.DISCARD)
 
         lambda_textract_analytics.add_to_role_policy(
             iam.PolicyStatement(
@@ -221,28 +306,88 @@ class ServerlessIDPArchivePipeline(Stack):
             )
         )        
         
+        # with DedupCache the decider adds a contentHash, remember the outputs of the document under it
+        dedup_cache_put = sfn_tasks.DynamoPutItem(
+            self,
+            "DedupCachePut",
+            table=dedup_table,
+            item={
+                "ContentHash": sfn_tasks.DynamoAttributeValue.from_string(
+                    sfn.JsonPath.string_at('$.Payload.contentHash')),
+                "TextractResult": sfn_tasks.DynamoAttributeValue.from_string(
+                    sfn.JsonPath.json_to_string(sfn.JsonPath.object_at('$.textract_result'))),
+                "DeciderResult": sfn_tasks.DynamoAttributeValue.from_string(
+                    sfn.JsonPath.json_to_string(sfn.JsonPath.object_at('$.Payload')))
+            },
+            result_path=sfn.JsonPath.DISCARD
+        )
+        dedup_cache_choice = sfn.Choice(self, 'DedupCacheChoice') \
+                .when(
+                    sfn.Condition.is_present('$.Payload.contentHash'),
+                    dedup_cache_put
+                ).otherwise(sfn.Succeed(self, "DocumentProcessed"))
+
+        text_outputs_chain = sfn.Chain.start(task_generate_lambda_textract_to_txt) \
+                .next(task_generate_lambda_textract_analytics) \
+                .next(dedup_cache_choice)
+
+        # with FusedTextAnalytics the txt and analytics output is already written by async_to_json
+        fused_output_choice = sfn.Choice(self, 'FusedOutputChoice') \
+                .when(
+                    sfn.Condition.is_present('$.textract_result.TextractAnalyticsOutputPath'),
+                    dedup_cache_choice
+                ).otherwise(text_outputs_chain)
+
         async_chain = sfn.Chain.start(textract_async_task) \
                 .next(textract_async_to_json) \
-                .next(task_generate_lambda_textract_to_txt) \
-                .next(task_generate_lambda_textract_analytics)
+                .next(fused_output_choice)
                 
         sync_chain = sfn.Chain.start(textract_sync_task) \
-                .next(task_generate_lambda_textract_to_txt) 
+                .next(text_outputs_chain)
 
         number_pages_choice = sfn.Choice(self, 'NumberPagesChoice') \
                 .when(
                     sfn.Condition.and_(sfn.Condition.is_present('$.Payload.numberOfPages'),
                     sfn.Condition.number_greater_than('$.Payload.numberOfPages', 3000)),
-                    sfn.Fail(self, "NumberOfPagesFail", error="NumberOfPagesError", cause="number of pages > 3000")
+                    # a Fail would end the whole batch of the item, the item ends with the error instead
+                    sfn.Pass(self, "NumberOfPagesExceeded", parameters={
+                        "Item.$": "$.Payload",
+                        "Error": "NumberOfPagesError",
+                        "Cause": "number of pages > 3000"
+                    })
                 ).when(
                     sfn.Condition.and_(sfn.Condition.is_present('$.Payload.numberOfPages'),
                     sfn.Condition.number_greater_than('$.Payload.numberOfPages', 1),
                     sfn.Condition.number_less_than_equals('$.Payload.numberOfPages', 3000)), async_chain
                 ).otherwise(sync_chain)
 
+        # the decider returns {"Items": [...]} for a batch of S3 objects, every item goes
+        # through the sync/async choice on its own; an item the decider failed on ends here
+        # without failing the other items of the batch, its Error and Cause stay in the decider
+        # result, the output of the batch the ResultWriter records
+        decider_item_choice = sfn.Choice(self, 'DeciderItemChoice') \
+                .when(
+                    sfn.Condition.is_present('$.Payload.Error'),
+                    sfn.Pass(self, "DeciderItemFailed", output_path="$.Payload")
+                ).when(
+                    # same content as a document in the dedup cache, the decider points to its output
+                    sfn.Condition.is_present('$.Payload.textract_result'),
+                    sfn.Succeed(self, "DedupCacheHit")
+                ).otherwise(number_pages_choice)
+
+        decider_items_map = sfn.Map(
+            self,
+            "DeciderItemsMap",
+            items_path="$.Payload.Items",
+            parameters={"Payload.$": "$$.Map.Item.Value"},
+            # the outputs are in S3, the results of all items would soon exceed the 256 KB state limit
+            result_path=sfn.JsonPath.DISCARD
+        )
+        decider_items_map.iterator(decider_item_choice)
+
         sub_workflow = sfn.Chain \
                 .start(decider_task) \
-                .next(number_pages_choice)
+                .next(decider_items_map)
         dummy_map = sfn.Map(self, "dummy map")
         
         dummy_map.iterator(sub_workflow)
@@ -261,6 +406,9 @@ class ServerlessIDPArchivePipeline(Stack):
             "End": True,
             "Label": "distMap",
             "MaxConcurrency": 1000,
+            "ItemBatcher": {
+                "MaxItemsPerBatch": decider_batch_size.value_as_number
+            },
             "ItemReader": {
                 "Resource": "arn:aws:states:::s3:listObjectsV2",
                 "Parameters": {
@@ -289,6 +437,8 @@ class ServerlessIDPArchivePipeline(Stack):
             workflow_name,
             definition=distributed_map
         )
+        # DedupCachePut runs inside the custom distributed map state, CDK does not grant its table
+        dedup_table.grant_write_data(state_machine)
                 
         state_machine.add_to_role_policy(
             iam.PolicyStatement(
@@ -13,28 +13,40 @@ import textractmanifest as tm
 from datetime import timezone
 from urllib.parse import urlparse
 from botocore.config import Config
+from utils.stream_merge import stream_full_json_from_output_config
+from utils.block_store import BlockStoreWriter, block_store_prefix_for
+import emf_metrics
+import s3_io
+import profiling
 
 logger = logging.getLogger(__name__)
 
 config = Config(retries={'max_attempts': 0, 'mode': 'standard'})
 
 region = os.environ['AWS_REGION']
-step_functions_client = boto3.client(service_name='stepfunctions')
-s3 = boto3.client(service_name='s3')
+s3 = emf_metrics.instrument_s3(s3_io.client())
 
 __version__ = "0.0.11"
 
+# once per execution environment, not on every invocation
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+logger.info(f"version: {__version__}\n \
+    textractmanifest version: {tm.__version__}\n \
+    boto3 version: {boto3.__version__}\n \
+    textractcaller version: {tc.__version__}.")
 
+
+@profiling.profile_handler('async_to_json')
+@emf_metrics.emit_metrics('async_to_json')
 def lambda_handler(event, _):
     log_level = os.environ.get('LOG_LEVEL', 'INFO')
     logger.setLevel(log_level)
     logger.info(json.dumps(event))
-    logger.info(f"version: {__version__}\n \
-        textractmanifest version: {tm.__version__}\n \
-        boto3 version: {boto3.__version__}\n \
-        textractcaller version: {tc.__version__}.")
 
     textract_api = os.environ.get('TEXTRACT_API', None) or 'GENERIC'
+    merge_mode = os.environ.get('MERGE_MODE', None) or 'STREAMING'
+    write_block_store = (os.environ.get('WRITE_BLOCK_STORE', None) or 'false').lower() == 'true'
+    fused_text_analytics = (os.environ.get('FUSED_TEXT_ANALYTICS', None) or 'false').lower() == 'true'
     s3_output_bucket = os.environ.get('S3_OUTPUT_BUCKET', None)
     if not s3_output_bucket:
         raise Exception("no S3_OUTPUT_BUCKET set")
@@ -43,41 +55,103 @@ def lambda_handler(event, _):
     if not s3_output_prefix:
         raise Exception("no S3_OUTPUT_PREFIX set")
 
+    s3_txt_output_prefix = os.environ.get('OUTPUT_PREFIX', None)
+    if fused_text_analytics and not s3_txt_output_prefix:
+        raise Exception("no OUTPUT_PREFIX set")
+
     logger.info(f"LOG_LEVEL: {log_level} \n \
                 S3_OUTPUT_PREFIX: {s3_output_prefix} \n \
                 S3_OUTPUT_BUCKET: {s3_output_bucket} \n \
+                MERGE_MODE: {merge_mode} \n \
+                WRITE_BLOCK_STORE: {write_block_store} \n \
+                FUSED_TEXT_ANALYTICS: {fused_text_analytics} \n \
                 ")
 
     manifest: tm.IDPManifest = tm.IDPManifestSchema().load(
         event['Payload']['manifest']) 
+    emf_metrics.set_document(**emf_metrics.document_from_event(event))
     output_location = event['textract_result']['TextractTempOutputJsonPath']
     oc_s3_bucket = urlparse(output_location).netloc
     job_id = os.path.basename(urlparse(output_location).path)
     oc_s3_prefix = os.path.dirname(urlparse(output_location).path)
     output_config = tc.OutputConfig(s3_bucket=oc_s3_bucket,
                                     s3_prefix=oc_s3_prefix)
+    s3_filename, _ = os.path.splitext(os.path.basename(manifest.s3_path))
+    output_bucket_key = s3_output_prefix + "/" + s3_filename + datetime.utcnow().isoformat() + "/" + s3_filename + ".json"
+
+    block_store = None
+    if write_block_store and textract_api=='GENERIC':
+        block_store = BlockStoreWriter(s3_client=s3, bucket=s3_output_bucket,
+                                       prefix=block_store_prefix_for(output_bucket_key))
+    text_and_analytics = None
+    if fused_text_analytics and textract_api=='GENERIC':
+        # numpy and the text layout are only loaded when the fused output is on
+        from utils.fused_outputs import TextAndAnalytics
+        text_and_analytics = TextAndAnalytics(workers=int(os.environ.get('FORMAT_WORKERS', 0)))
+    block_counter = emf_metrics.BlockCounter()
+    consumers = [c for c in (block_store, text_and_analytics) if c]
+
     start_time = round(time.time() * 1000)
-    if textract_api=='GENERIC':
+    full_json = None
+    if textract_api=='GENERIC' and merge_mode=='STREAMING':
         logger.info(f"Textract API: {textract_api}")
-        full_json = tc.get_full_json_from_output_config(
-            output_config=output_config, job_id=job_id, s3_client=s3)
+        logger.info(f"Attempting to stream to S3 at s3://{s3_output_bucket}/{output_bucket_key}")
+        try:
+            with emf_metrics.timer('ParseTime'):
+                output_size = stream_full_json_from_output_config(
+                    output_config=output_config, job_id=job_id, s3_client=s3,
+                    s3_output_bucket=s3_output_bucket, s3_output_key=output_bucket_key,
+                    consumers=consumers + [block_counter])
+        except Exception:
+            if block_store:
+                block_store.abort()
+            raise
+        if block_store:
+            block_store.close()
+    elif textract_api=='GENERIC':
+        logger.info(f"Textract API: {textract_api}")
+        with emf_metrics.timer('ParseTime'):
+            full_json = tc.get_full_json_from_output_config(
+                output_config=output_config, job_id=job_id, s3_client=s3)
     elif textract_api=='LENDING':
         logger.info(f"Textract API: {textract_api}")
-        full_json = tc.get_full_json_lending_from_output_config(
-            output_config=output_config, job_id=job_id, s3_client=s3,
-            subfolder="detailedResponse"
-        )
-
-    s3_filename, _ = os.path.splitext(os.path.basename(manifest.s3_path))
+        with emf_metrics.timer('ParseTime'):
+            full_json = tc.get_full_json_lending_from_output_config(
+                output_config=output_config, job_id=job_id, s3_client=s3,
+                subfolder="detailedResponse"
+            )
 
     call_duration = round(time.time() * 1000) - start_time
     logger.info(f"textract_async_to_json_call_duration_in_ms: {call_duration}")
-    output_bucket_key = s3_output_prefix + "/" + s3_filename + datetime.utcnow().isoformat() + "/" + s3_filename + ".json"
-    logger.info(f"Attempting to write to S3 at s3://{s3_output_bucket}/{output_bucket_key}")
-    s3.put_object(Body=bytes(json.dumps(full_json, indent=4).encode('UTF-8')),
-                  Bucket=s3_output_bucket,
-                  Key=output_bucket_key)
-
+    if full_json is not None:
+        block_counter.blocks = len(full_json.get('Blocks', []))
+        logger.info(f"Attempting to write to S3 at s3://{s3_output_bucket}/{output_bucket_key}")
+        output_body = bytes(json.dumps(full_json, indent=4).encode('UTF-8'))
+        output_size = len(output_body)
+        s3_io.upload(s3, s3_output_bucket, output_bucket_key, output_body)
+        del output_body
+        if consumers:
+            try:
+                for block in full_json.get('Blocks', []):
+                    for consumer in consumers:
+                        consumer.add(block)
+            except Exception:
+                if block_store:
+                    block_store.abort()
+                raise
+            if block_store:
+                block_store.close()
+
+    if block_store:
+        logger.info(f"Wrote block store to {block_store.index_path}")
+        event["textract_result"]["TextractBlockStorePath"] = block_store.index_path
+    emf_metrics.add('BlockCount', block_counter.blocks)
+    if text_and_analytics:
+        logger.info("Writing text and analytics output")
+        with emf_metrics.timer('ComputeTime'):
+            event["textract_result"].update(text_and_analytics.write(
+                s3_client=s3, s3_bucket=s3_output_bucket, json_s3_key=output_bucket_key,
+                txt_output_prefix=s3_txt_output_prefix, size=output_size))
     event["textract_result"]["TextractOutputJsonPath"]=f"s3://{s3_output_bucket}/{output_bucket_key}"
 
     return event
\ No newline at end of file
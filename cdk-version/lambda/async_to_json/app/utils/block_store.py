@@ -0,0 +1,121 @@
+import json
+import logging
+import posixpath
+
+from s3_io import S3MultipartWriter, DEFAULT_PART_SIZE
+
+logger = logging.getLogger(__name__)
+
+BLOCK_STORE_VERSION = 1
+BLOCK_STORE_DIR = "blocks"
+BLOCK_STORE_INDEX = "index.json"
+
+
+def block_store_prefix_for(json_key: str) -> str:
+    """The block store lives in a folder next to the merged JSON it was built from."""
+    return posixpath.join(posixpath.dirname(json_key), BLOCK_STORE_DIR)
+
+
+def compact_block(block: dict) -> dict:
+    """
+    Projects a Textract block onto the columns the downstream stages read:
+    BlockType, Id, Page, Text, EntityTypes, Relationships and the BoundingBox.
+    PAGE blocks also keep their Polygon, which is used to estimate skew.
+    """
+    row = {'BlockType': block.get('BlockType'), 'Id': block.get('Id'), 'Page': block.get('Page', 1)}
+    for key in ('Text', 'EntityTypes', 'Relationships'):
+        if key in block:
+            row[key] = block[key]
+    geometry = block.get('Geometry')
+    if geometry:
+        row['Geometry'] = {'BoundingBox': geometry.get('BoundingBox')}
+        if block.get('BlockType') == 'PAGE':
+            row['Geometry']['Polygon'] = geometry.get('Polygon')
+    return row
+
+
+class BlockStoreWriter:
+    """
+    Writes a compact sidecar of a Textract document: one NDJSON object per
+    BlockType (LINE.ndjson, WORD.ndjson, ...) holding one compact block per
+    line, plus an index.json with the byte range and block count of every
+    page in every file. Consumers read only the block types they need and can
+    fetch single pages with ranged GETs.
+
+    index.json:
+        {
+            "Version": 1,
+            "Pages": 2,
+            "BlockTypes": {
+                "LINE": {"Key": "<prefix>/blocks/LINE.ndjson",
+                         "Count": 40,
+                         "Pages": {"1": [start, end, count], ...}},
+                ...
+            }
+        }
+
+    start/end are a half-open byte range; rows of a page are contiguous as
+    long as Textract returns the blocks of a page together, which it does.
+    """
+
+    def __init__(self, s3_client, bucket: str, prefix: str, part_size: int = DEFAULT_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.index_key = posixpath.join(prefix, BLOCK_STORE_INDEX)
+        self.index_path = f"s3://{bucket}/{self.index_key}"
+        self._writers = {}
+        self._block_types = {}
+        self._pages = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def add(self, block: dict):
+        row = compact_block(block)
+        block_type = row['BlockType']
+        writer = self._writers.get(block_type)
+        if not writer:
+            key = posixpath.join(self.prefix, f"{block_type}.ndjson")
+            writer = S3MultipartWriter(s3_client=self.s3_client, bucket=self.bucket, key=key,
+                                       part_size=self.part_size)
+            self._writers[block_type] = writer
+            self._block_types[block_type] = {'Key': key, 'Count': 0, 'Pages': {}}
+
+        start = writer.bytes_written
+        writer.write((json.dumps(row, separators=(',', ':')) + "\n").encode('utf-8'))
+        page = str(row['Page'])
+        self._pages.add(page)
+        entry = self._block_types[block_type]
+        entry['Count'] += 1
+        page_range = entry['Pages'].get(page)
+        if page_range:
+            page_range[1] = writer.bytes_written
+            page_range[2] += 1
+        else:
+            entry['Pages'][page] = [start, writer.bytes_written, 1]
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        index = {
+            'Version': BLOCK_STORE_VERSION,
+            'Pages': len(self._pages),
+            'BlockTypes': self._block_types
+        }
+        self.s3_client.put_object(Body=json.dumps(index, separators=(',', ':')).encode('utf-8'),
+                                  Bucket=self.bucket,
+                                  Key=self.index_key)
+        logger.info(f"wrote block store {self.index_path} "
+                    f"with {sum(e['Count'] for e in self._block_types.values())} blocks")
+
+    def abort(self):
+        for writer in self._writers.values():
+            writer.abort()
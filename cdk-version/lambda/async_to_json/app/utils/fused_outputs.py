@@ -0,0 +1,60 @@
+import datetime
+import logging
+
+import s3_io
+
+from utils.block_store import compact_block
+from utils.format_ocr_text import FormatOCR
+from utils.analyze_textract import AnalyzeTextract
+
+logger = logging.getLogger(__name__)
+
+
+class TextAndAnalytics:
+    """
+    Builds the outputs of the textract-to-txt and textract-analytics Lambdas
+    from the blocks while they are merged, so the merged JSON does not have to
+    be read and parsed again by two more Lambdas.
+
+    Only compact LINE and PAGE blocks are kept for the text layout, the
+    analytics are counted as the blocks go by. The object keys are the same the
+    two Lambdas write to.
+    """
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.analysis = AnalyzeTextract()
+        self._layout_blocks = []
+
+    def add(self, block: dict):
+        self.analysis.add(block)
+        if block.get('BlockType') in ('LINE', 'PAGE'):
+            self._layout_blocks.append(compact_block(block))
+
+    def write(self, s3_client, s3_bucket: str, json_s3_key: str, txt_output_prefix: str, size: int) -> dict:
+        """
+        Writes the text and the analytics for the merged JSON at
+        s3://s3_bucket/json_s3_key, which is size bytes long.
+
+        Returns the TextractOutputTextPath and TextractAnalyticsOutputPath.
+        """
+        timestamp = datetime.datetime.now().astimezone().replace(
+                    microsecond=0).isoformat()
+        date = datetime.datetime.today().strftime('%Y-%m-%d')
+        file_name = json_s3_key.split('/')[-1].split('.')[0]
+
+        full_text, _ = FormatOCR(j={'Blocks': self._layout_blocks}, workers=self.workers).json_to_text()
+        self._layout_blocks = []
+        txt_output_key = f"{txt_output_prefix}/{timestamp}_{file_name}_txt.txt"
+        logger.info(f"Writing to {txt_output_key}")
+        s3_io.upload(s3_client, s3_bucket, txt_output_key, full_text)
+
+        self.analysis.finish(size=size)
+        analytics_output_key = f"analytics_output_{date}/{timestamp}_{file_name}_analytics.json"
+        logger.info(f"Writing to {analytics_output_key}")
+        s3_io.upload(s3_client, s3_bucket, analytics_output_key, self.analysis.metrics_to_json())
+
+        return {
+            "TextractOutputTextPath": f"s3://{s3_bucket}/{txt_output_key}",
+            "TextractAnalyticsOutputPath": f"s3://{s3_bucket}/{analytics_output_key}"
+        }
@@ -0,0 +1,83 @@
+import json
+import logging
+
+import textractcaller as tc
+from textractcaller.t_call import get_s3_output_config_keys, remove_none
+from s3_io import S3MultipartWriter, DEFAULT_PART_SIZE, iter_objects
+
+logger = logging.getLogger(__name__)
+
+def _indent(text: str, prefix: str) -> str:
+    # json.dumps escapes newlines inside strings, so every "\n" is a line break
+    return text.replace("\n", "\n" + prefix)
+
+
+def _dump_member(key: str, value) -> str:
+    return f'    {json.dumps(key)}: {_indent(json.dumps(value, indent=4), "    ")}'
+
+
+def stream_full_json_from_output_config(output_config: tc.OutputConfig,
+                                        job_id: str,
+                                        s3_client,
+                                        s3_output_bucket: str,
+                                        s3_output_key: str,
+                                        part_size: int = DEFAULT_PART_SIZE,
+                                        consumers=()) -> int:
+    """
+    Streaming equivalent of
+
+        json.dumps(tc.get_full_json_from_output_config(...), indent=4)
+
+    written to s3://s3_output_bucket/s3_output_key. The numbered Textract output
+    parts are parsed one at a time and their Blocks are appended to the output,
+    so only one part (and the next ones being read ahead) is held in memory.
+    The bytes written are identical to the in-memory merge.
+
+    Every block is also passed to the add() method of the consumers, e.g. a
+    utils.block_store.BlockStoreWriter, so they are built in the same pass.
+
+    Returns the size of the merged JSON in bytes.
+    """
+    keys = get_s3_output_config_keys(output_config=output_config, job_id=job_id, s3_client=s3_client)
+    number_of_blocks = 0
+    with S3MultipartWriter(s3_client=s3_client, bucket=s3_output_bucket, key=s3_output_key,
+                           part_size=part_size) as writer:
+        if not keys:
+            writer.write(b"{}")
+            return writer.bytes_written
+
+        trailer = []
+        logger.info(f"found keys: {keys}")
+        for index, body in enumerate(iter_objects(s3_client, output_config.s3_bucket, keys)):
+            response = json.loads(body.decode('utf-8'))
+            del body
+            if index == 0:
+                # The first part decides the top-level layout, like the in-memory merge does
+                head, trailer = [], []
+                members = head
+                for k, v in response.items():
+                    if k == 'Blocks':
+                        members = trailer
+                    elif k != 'NextToken' and v is not None:
+                        members.append((k, remove_none(v)))
+                writer.write(("{\n" + "".join(_dump_member(k, v) + ",\n" for k, v in head) +
+                              '    "Blocks": [').encode('utf-8'))
+            blocks = response.get('Blocks') or []
+            del response
+
+            chunk = []
+            for block in blocks:
+                chunk.append(("\n" if number_of_blocks == 0 else ",\n") + "        " +
+                             _indent(json.dumps(remove_none(block), indent=4), "        "))
+                number_of_blocks += 1
+                for consumer in consumers:
+                    consumer.add(block)
+            writer.write("".join(chunk).encode('utf-8'))
+            del blocks, chunk
+
+        writer.write(("\n    ]" if number_of_blocks else "]").encode('utf-8'))
+        writer.write(("".join(",\n" + _dump_member(k, v) for k, v in trailer) + "\n}").encode('utf-8'))
+
+    logger.info(f"streamed {number_of_blocks} blocks ({writer.bytes_written} bytes) "
+                f"to s3://{s3_output_bucket}/{s3_output_key}")
+    return writer.bytes_written
@@ -4,38 +4,26 @@
 import json
 import logging
 import os
-import boto3
 import filetype
-from typing import Tuple, Optional
-from pypdf import PdfReader
-from PIL import Image, ImageSequence
+from typing import Optional
 import io
 import json
+from concurrent.futures import ThreadPoolExecutor
 import textractmanifest as tm
+from page_count import S3RangeReader, count_pages_with_ranged_reads
+from dedup_cache import dedup_cache_from_env, get_content_hash
+import emf_metrics
+import s3_io
+import profiling
 
 logger = logging.getLogger(__name__)
 version = "0.0.14"
-s3_client = boto3.client('s3')
+# items of a batch that are classified at the same time
+decider_workers = int(os.environ.get('DECIDER_WORKERS', 16))
+s3_client = emf_metrics.instrument_s3(s3_io.client(max_pool_connections=max(10, decider_workers)))
 
 s3_bucket = state_machine_arn = os.environ.get('S3_BUCKET', "test-bench")
-
-def split_s3_path_to_bucket_and_key(s3_path: str) -> Tuple[str, str]:
-    if len(s3_path) <= 7 or not s3_path.lower().startswith("s3://"):
-        raise ValueError(
-            f"s3_path: {s3_path} is no s3_path in the form of s3://bucket/key."
-        )
-    s3_bucket, s3_key = s3_path.replace("s3://", "").split("/", 1)
-    return (s3_bucket, s3_key)
-
-
-def get_file_from_s3(s3_path: str, range=None) -> bytes:
-    s3_bucket, s3_key = split_s3_path_to_bucket_and_key(s3_path)
-    if range:
-        o = s3_client.get_object(Bucket=s3_bucket, Key=s3_key, Range=range)
-    else:
-        o = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-    return o.get('Body').read()
-
+dedup_cache = dedup_cache_from_env()
 
 def get_mime_for_file(file_bytes: bytes) -> Optional[str]:
     """
@@ -46,18 +34,20 @@ def get_mime_for_file(file_bytes: bytes) -> Optional[str]:
 
 
 def parse_manifest(s3_path: str) -> tm.IDPManifest:
-    s3_bucket, s3_key = split_s3_path_to_bucket_and_key(s3_path)
-    o = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-    file_content = o.get('Body').read().decode('utf-8')
+    file_content = s3_io.read_s3_path(s3_client, s3_path).decode('utf-8')
     return tm.IDPManifestSchema().loads(file_content)  
 
 
 def get_number_of_pages(file_bytes: bytes, mime: str) -> int:
+    # pypdf and PIL are only imported for the documents that need them, most
+    # items never get here (see get_number_of_pages_from_s3)
     if mime == 'application/pdf':
+        from pypdf import PdfReader
         with io.BytesIO(file_bytes) as input_pdf_file:
             pdf_reader = PdfReader(input_pdf_file)
             return len(pdf_reader.pages)
     elif mime == 'image/tiff':
+        from PIL import Image, ImageSequence
         f = io.BytesIO(file_bytes)
         img = Image.open(f)
         return sum(1 for _ in ImageSequence.Iterator(img))
@@ -67,7 +57,45 @@ def get_number_of_pages(file_bytes: bytes, mime: str) -> int:
         raise ValueError(f"unsupported mime type: {mime}")
 
 
-def lambda_handler(event, _):
+def get_number_of_pages_from_s3(s3_path: str, mime: str, first_file_bytes: bytes, size: Optional[int] = None) -> int:
+    """
+    Counts the pages of a PDF or TIFF with ranged reads of its structure (see
+    page_count), downloading the whole file only if that fails.
+    """
+    if mime in {'application/pdf', 'image/tiff'}:
+        s3_bucket, s3_key = s3_io.split_s3_path_to_bucket_and_key(s3_path)
+        reader = S3RangeReader(s3_client, s3_bucket, s3_key, head=first_file_bytes, size=size)
+        try:
+            number_of_pages = count_pages_with_ranged_reads(reader, mime)
+            logger.info(f"counted {number_of_pages} pages with {reader.requests} ranged GETs")
+            return number_of_pages
+        except Exception as e:
+            logger.warning(f"could not count the pages of {s3_path} with ranged GETs, downloading it: {e}")
+        return get_number_of_pages(file_bytes=s3_io.read_s3_path(s3_client, s3_path), mime=mime)
+    # no need for the file to know there is 1 page or the mime type is not supported
+    return get_number_of_pages(file_bytes=first_file_bytes, mime=mime)
+
+
+def dedup_hit_result(manifest: tm.IDPManifest, content_hash: str, cached: dict) -> dict:
+    """
+    The result for a document with the same content as one processed before,
+    with its textract_result, which makes the state machine skip Textract.
+    """
+    decider_result = cached.get('DeciderResult') or {}
+    result_value = {
+        "manifest": tm.IDPManifestSchema().dump(manifest),
+        "mime": decider_result.get('mime'),
+        "classification": decider_result.get('classification'),
+        "numberOfPages": decider_result.get('numberOfPages'),
+        "contentHash": content_hash,
+        "textract_result": cached['TextractResult']
+    }
+    if 'numberOfQueries' in decider_result:
+        result_value['numberOfQueries'] = decider_result['numberOfQueries']
+    return result_value
+
+
+def decide(event: dict) -> dict:
     # Accepts a manifest file, will enrich with information if possible
     # add
     #    "mime": mime,
@@ -77,12 +105,7 @@ def lambda_handler(event, _):
     supported_mime_types = [
         'application/pdf', 'image/png', 'image/jpeg', 'image/tiff'
     ]
-    log_level = os.environ.get('LOG_LEVEL', 'INFO')
-    logger.setLevel(log_level)
-    logger.info(f"version: {version}")
-    logger.info(f"amazon-textract-idp-cdk-manifest version: {tm.__version__}")
-    logger.info(json.dumps(event))
-    
+
     if event.get('Size') == 0:
         raise ValueError(
             "File Size is 0"
@@ -102,24 +125,43 @@ def lambda_handler(event, _):
     else:
         s3_path = manifest.s3_path
 
-    first_file_bytes = get_file_from_s3(s3_path=s3_path, range='bytes=0-2000')
+    content_hash = None
+    if dedup_cache:
+        content_hash = get_content_hash(s3_client, s3_bucket, s3_key, etag=event.get('Etag'), size=event.get('Size'))
+        cached = dedup_cache.get(content_hash)
+        if cached:
+            logger.info(f"{manifest.s3_path} has the same content as a processed document: {cached['TextractResult']}")
+            emf_metrics.add('DedupHits', 1)
+            emf_metrics.set_document(**emf_metrics.document_from_event(cached.get('DeciderResult') or {}))
+            return dedup_hit_result(manifest, content_hash, cached)
+
+    first_file_bytes = s3_io.read_s3_path(s3_client, s3_path, range='bytes=0-2000')
     mime = get_mime_for_file(file_bytes=first_file_bytes)
     logger.debug(f"initial mime: {mime}")
     if not mime or mime not in supported_mime_types:        
         manifest = parse_manifest(s3_path=s3_path)
 
-        file_bytes = (
-            get_file_from_s3(s3_path=manifest.document_pages[0])
+        document_path = (
+            manifest.document_pages[0]
             if manifest.classification == 'IDENTITY'
-            else get_file_from_s3(s3_path=manifest.s3_path)
+            else manifest.s3_path
         )
-        mime = get_mime_for_file(file_bytes=file_bytes)
+        first_file_bytes = s3_io.read_s3_path(s3_client, document_path, range='bytes=0-2000')
+        mime = get_mime_for_file(file_bytes=first_file_bytes)
         logger.info(f"document mime: {mime}")
         if not mime:
             raise Exception(f"not supported Mime type: {mime}")
+        document_size = None
     else:        
-        file_bytes = get_file_from_s3(s3_path=manifest.s3_path)
-    numberOfPages = get_number_of_pages(file_bytes=file_bytes, mime=mime)
+        document_path = manifest.s3_path
+        # Size of the S3 object the map item describes
+        document_size = event.get('Size')
+    with emf_metrics.timer('ParseTime'):
+        numberOfPages = get_number_of_pages_from_s3(s3_path=document_path,
+                                                    mime=mime,
+                                                    first_file_bytes=first_file_bytes,
+                                                    size=document_size)
+    emf_metrics.set_document(mime=mime, pages=numberOfPages)
     logger.info(f"return: {manifest}")
 
     result_value = {
@@ -132,4 +174,48 @@ def lambda_handler(event, _):
     if manifest and manifest.queries_config:
         result_value['numberOfQueries'] = len(manifest.queries_config)
 
+    if content_hash:
+        # the state machine adds the document to the dedup cache under this hash once processed
+        result_value['contentHash'] = content_hash
+
     return result_value
+
+
+def decide_batch_item(item: dict) -> dict:
+    """
+    decide() for one item of a batch. Errors are returned as the result of the
+    item, with the item, so the other items of the batch are still processed.
+    """
+    try:
+        return decide(item)
+    except Exception as e:
+        logger.exception(f"failed to process {item.get('Key')}")
+        return {"Item": item, "Error": type(e).__name__, "Cause": str(e)}
+
+
+@profiling.profile_handler('decider')
+@emf_metrics.emit_metrics('decider')
+def lambda_handler(event, _):
+    # Single item: a listObjectsV2 item of the distributed map ({"Key": ..., "Size": ...})
+    # Batch: {"Items": [item, ...]} from the ItemBatcher of the distributed map,
+    #    returns {"Items": [result, ...]} with the result of every item in the same order
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')
+    logger.setLevel(log_level)
+    logger.info(f"version: {version}")
+    logger.info(f"amazon-textract-idp-cdk-manifest version: {tm.__version__}")
+    logger.info(json.dumps(event))
+
+    if 'Items' not in event:
+        return decide(event)
+
+    items = event['Items']
+    if not items:
+        return {"Items": []}
+    with ThreadPoolExecutor(max_workers=min(decider_workers, len(items))) as executor:
+        results = list(executor.map(decide_batch_item, items))
+    failed = [result for result in results if 'Error' in result]
+    logger.info(f"processed {len(items)} items, {len(failed)} failed")
+    # like a single item, a batch without any successful item fails the execution
+    if len(failed) == len(items):
+        raise ValueError(f"all {len(items)} items failed, first error: {failed[0]['Error']}: {failed[0]['Cause']}")
+    return {"Items": results}
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+# ETags are quoted
+QUOTE = '"'
+
+
+class DedupCache(ABC):
+    """
+    Maps the content hash of a document to the results of the run that
+    processed it:
+
+        {"TextractResult": {"TextractOutputJsonPath": ..., ...},
+         "DeciderResult": {"manifest": ..., "mime": ..., "numberOfPages": ...}}
+
+    The decider only reads the cache, the state machine writes it.
+    """
+
+    @abstractmethod
+    def get(self, content_hash: str) -> Optional[dict]:
+        pass
+
+
+class DynamoDBDedupCache(DedupCache):
+    """
+    One item per content hash, TextractResult and DeciderResult stored as JSON
+    strings. The state machine writes the items (DedupCachePut) once a
+    document is processed.
+    """
+
+    def __init__(self, table_name: str, dynamodb_client=None):
+        self.table_name = table_name
+        self.dynamodb_client = dynamodb_client or boto3.client('dynamodb')
+
+    def get(self, content_hash: str) -> Optional[dict]:
+        item = self.dynamodb_client.get_item(TableName=self.table_name,
+                                             Key={'ContentHash': {'S': content_hash}}).get('Item')
+        if not item or 'TextractResult' not in item:
+            return None
+        return {
+            'TextractResult': json.loads(item['TextractResult']['S']),
+            'DeciderResult': json.loads(item['DeciderResult']['S']) if 'DeciderResult' in item else {}
+        }
+
+
+class LocalFileDedupCache(DedupCache):
+    """
+    The cache as one JSON object {content hash: entry} in a local file, for
+    tests and local runs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, content_hash: str) -> Optional[dict]:
+        with self._lock:
+            return self._load().get(content_hash)
+
+
+def dedup_cache_from_env() -> Optional[DedupCache]:
+    """
+    DEDUP_CACHE=true with DEDUP_CACHE_TABLE uses DynamoDB, DEDUP_CACHE_FILE
+    a local file, otherwise there is no cache.
+    """
+    if os.environ.get('DEDUP_CACHE_FILE'):
+        return LocalFileDedupCache(os.environ['DEDUP_CACHE_FILE'])
+    if os.environ.get('DEDUP_CACHE', 'false') == 'true' and os.environ.get('DEDUP_CACHE_TABLE'):
+        return DynamoDBDedupCache(os.environ['DEDUP_CACHE_TABLE'])
+    return None
+
+
+def get_content_hash(s3_client, s3_bucket: str, s3_key: str, etag: Optional[str] = None,
+                     size: Optional[int] = None) -> str:
+    """
+    Hash identifying the content of an S3 object. The ETag and size of the
+    listObjectsV2 item are used when given, no request needed; otherwise a
+    full object SHA-256 checksum if the object has one, or its ETag.
+
+    Identical content uploaded differently (multipart part size, SSE-KMS) can
+    get different ETags, which only costs a cache miss.
+    """
+    if etag and size is not None:
+        return f"etag:{etag.strip(QUOTE)}:{size}"
+    o = s3_client.head_object(Bucket=s3_bucket, Key=s3_key, ChecksumMode='ENABLED')
+    checksum = o.get('ChecksumSHA256')
+    # composite checksums of multipart uploads end in -<number of parts>
+    if checksum and '-' not in checksum:
+        return f"sha256:{checksum}:{o['ContentLength']}"
+    return f"etag:{o['ETag'].strip(QUOTE)}:{o['ContentLength']}"
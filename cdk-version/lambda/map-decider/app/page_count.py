@@ -0,0 +1,569 @@
+import logging
+import re
+import struct
+import zlib
+from collections import namedtuple
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# bytes fetched per ranged GET; small reads around the same offset are served from it
+READ_AHEAD = 64 * 1024
+# above this many ranged GETs downloading the whole object is cheaper
+MAX_RANGE_REQUESTS = 256
+# the largest PDF object (dictionary) we try to parse from ranged reads
+MAX_OBJECT_SIZE = 1024 * 1024
+
+
+class PageCountError(Exception):
+    """The page count could not be read from the document headers."""
+
+
+class S3RangeReader:
+    """
+    Reads byte ranges of an S3 object. Every GET fetches at least READ_AHEAD
+    bytes and keeps them, so the many small reads of walking a file structure
+    cost one request per region of the file instead of one per read.
+
+    head are the first bytes of the object if they were already fetched,
+    size is the object size if known, it is taken from the Content-Range of
+    the first response otherwise.
+    """
+
+    def __init__(self, s3_client, s3_bucket: str, s3_key: str, head: bytes = b'', size: Optional[int] = None,
+                 read_ahead: int = READ_AHEAD, max_requests: int = MAX_RANGE_REQUESTS):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.size = size
+        self.read_ahead = read_ahead
+        self.max_requests = max_requests
+        self.requests = 0
+        self._segments = [(0, head)] if head else []
+
+    def _get(self, range_header: str) -> Tuple[int, bytes]:
+        if self.requests >= self.max_requests:
+            raise PageCountError(f"more than {self.max_requests} ranged GETs")
+        self.requests += 1
+        o = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_key, Range=range_header)
+        data = o.get('Body').read()
+        # bytes <start>-<end>/<size>
+        match = re.match(r'bytes (\d+)-\d+/(\d+)', o.get('ContentRange') or '')
+        if match:
+            start = int(match.group(1))
+            self.size = int(match.group(2))
+        else:
+            # the whole object was returned
+            start = 0
+            self.size = len(data)
+        self._segments.append((start, data))
+        return start, data
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Up to length bytes at offset, fewer only at the end of the object."""
+        if self.size is not None:
+            length = max(0, min(length, self.size - offset))
+        for start, data in self._segments:
+            if start <= offset and offset + length <= start + len(data):
+                return data[offset - start:offset + length - start]
+        if length == 0:
+            return b''
+        start, data = self._get(f"bytes={offset}-{offset + max(length, self.read_ahead) - 1}")
+        return data[offset - start:offset + length - start]
+
+    def read_tail(self, length: int) -> Tuple[int, bytes]:
+        """The last length bytes of the object and their offset."""
+        if self.size is not None:
+            offset = max(0, self.size - length)
+            return offset, self.read(offset, self.size - offset)
+        return self._get(f"bytes=-{max(length, self.read_ahead)}")
+
+
+# --- TIFF ---------------------------------------------------------------------
+
+def count_tiff_pages(reader: S3RangeReader) -> int:
+    """
+    Number of images in a TIFF (or BigTIFF), counted by following the chain of
+    image file directories (IFDs) from the header. Every IFD is its count of
+    entries, the entries and the offset of the next IFD, 0 for the last one.
+    """
+    header = reader.read(0, 16)
+    if header[:2] == b'II':
+        endian = '<'
+    elif header[:2] == b'MM':
+        endian = '>'
+    else:
+        raise PageCountError("no TIFF byte order mark")
+    magic, = struct.unpack(endian + 'H', header[2:4])
+    if magic == 42:
+        count_format, entry_size, offset_format = 'H', 12, 'I'
+        offset, = struct.unpack(endian + 'I', header[4:8])
+    elif magic == 43:
+        count_format, entry_size, offset_format = 'Q', 20, 'Q'
+        offset, = struct.unpack(endian + 'Q', header[8:16])
+    else:
+        raise PageCountError(f"unknown TIFF version {magic}")
+    count_size = struct.calcsize(count_format)
+    offset_size = struct.calcsize(offset_format)
+
+    pages = 0
+    seen = set()
+    while offset:
+        if offset in seen or (reader.size is not None and offset >= reader.size):
+            raise PageCountError(f"invalid IFD offset {offset}")
+        seen.add(offset)
+        number_of_entries, = struct.unpack(endian + count_format, reader.read(offset, count_size))
+        next_offset_at = offset + count_size + number_of_entries * entry_size
+        next_offset = reader.read(next_offset_at, offset_size)
+        if len(next_offset) != offset_size:
+            raise PageCountError(f"IFD at {offset} is truncated")
+        pages += 1
+        offset, = struct.unpack(endian + offset_format, next_offset)
+    return pages
+
+
+# --- PDF ----------------------------------------------------------------------
+
+Ref = namedtuple('Ref', ['num', 'gen'])
+
+
+class Name(str):
+    pass
+
+
+class _Truncated(Exception):
+    pass
+
+
+WHITESPACE = b'\x00\t\n\x0c\r '
+DELIMITERS = b'()<>[]{}/%'
+NUMBER_RE = re.compile(rb'[+-]?(\d+\.?\d*|\.\d+)')
+INT_RE = re.compile(rb'\d+')
+ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f'}
+
+
+class PdfLexer:
+    """
+    Parses the PDF objects in a buffer holding part of a file: dictionaries,
+    arrays, names, numbers, strings and indirect references (n g R). Running
+    off the end of the buffer raises _Truncated, so the caller can read more,
+    unless the buffer is complete, i.e. reaches the end of the data.
+    """
+
+    def __init__(self, buf: bytes, pos: int = 0, complete: bool = False):
+        self.buf = buf
+        self.pos = pos
+        self.complete = complete
+
+    def skip_whitespace(self):
+        buf = self.buf
+        while self.pos < len(buf):
+            c = buf[self.pos]
+            if c in WHITESPACE:
+                self.pos += 1
+            elif c == ord('%'):
+                while self.pos < len(buf) and buf[self.pos] not in b'\r\n':
+                    self.pos += 1
+            else:
+                return
+        raise _Truncated()
+
+    def keyword(self) -> bytes:
+        self.skip_whitespace()
+        start = self.pos
+        while self.pos < len(self.buf) and self.buf[self.pos] not in WHITESPACE + DELIMITERS:
+            self.pos += 1
+        if self.pos == len(self.buf) and not self.complete:
+            raise _Truncated()
+        return self.buf[start:self.pos]
+
+    def expect(self, keyword: bytes):
+        found = self.keyword()
+        if found != keyword:
+            raise PageCountError(f"expected {keyword!r}, found {found[:20]!r}")
+
+    def integer(self) -> int:
+        self.skip_whitespace()
+        match = INT_RE.match(self.buf, self.pos)
+        if not match:
+            raise PageCountError(f"expected an integer at {self.pos}")
+        self.pos = match.end()
+        return int(match.group())
+
+    def parse(self):
+        self.skip_whitespace()
+        buf = self.buf
+        c = buf[self.pos:self.pos + 2]
+        if c == b'<<':
+            self.pos += 2
+            result = {}
+            while True:
+                self.skip_whitespace()
+                if buf.startswith(b'>>', self.pos):
+                    self.pos += 2
+                    return result
+                key = self.parse()
+                if not isinstance(key, Name):
+                    raise PageCountError(f"dictionary key {key!r} is no name")
+                result[key] = self.parse()
+        if c[:1] == b'[':
+            self.pos += 1
+            result = []
+            while True:
+                self.skip_whitespace()
+                if buf[self.pos] == ord(']'):
+                    self.pos += 1
+                    return result
+                result.append(self.parse())
+        if c[:1] == b'/':
+            self.pos += 1
+            start = self.pos
+            while self.pos < len(buf) and buf[self.pos] not in WHITESPACE + DELIMITERS:
+                self.pos += 1
+            return Name(re.sub(rb'#([0-9a-fA-F]{2})', lambda m: bytes([int(m.group(1), 16)]),
+                               buf[start:self.pos]).decode('latin-1'))
+        if c[:1] == b'(':
+            return self._literal_string()
+        if c[:1] == b'<':
+            end = buf.find(b'>', self.pos)
+            if end < 0:
+                raise _Truncated()
+            digits = re.sub(rb'[^0-9a-fA-F]', b'', buf[self.pos + 1:end])
+            self.pos = end + 1
+            return bytes.fromhex((digits + b'0' * (len(digits) % 2)).decode())
+        match = NUMBER_RE.match(buf, self.pos)
+        if match:
+            if match.end() == len(buf) and not self.complete:
+                raise _Truncated()
+            self.pos = match.end()
+            if b'.' in match.group():
+                return float(match.group())
+            number = int(match.group())
+            # n g R is an indirect reference
+            reference = re.compile(rb'\s+(\d+)\s+R(?=[\s/<>\[\]()%])').match(buf, self.pos)
+            if reference:
+                self.pos = reference.end()
+                return Ref(number, int(reference.group(1)))
+            # the reference may continue past the end of the buffer
+            if len(buf) - self.pos < 16 and not self.complete:
+                raise _Truncated()
+            return number
+        word = self.keyword()
+        if word == b'true':
+            return True
+        if word == b'false':
+            return False
+        if word == b'null':
+            return None
+        raise PageCountError(f"unexpected {word[:20]!r} at {self.pos}")
+
+    def _literal_string(self) -> bytes:
+        buf = self.buf
+        self.pos += 1
+        depth = 1
+        out = bytearray()
+        while True:
+            if self.pos >= len(buf):
+                raise _Truncated()
+            c = buf[self.pos]
+            self.pos += 1
+            if c == ord('\\'):
+                if self.pos >= len(buf):
+                    raise _Truncated()
+                e = buf[self.pos]
+                self.pos += 1
+                if e in ESCAPES:
+                    out += ESCAPES[e]
+                elif e in b'01234567':
+                    digits = re.match(rb'[0-7]{1,3}', buf[self.pos - 1:self.pos + 2]).group()
+                    self.pos += len(digits) - 1
+                    out.append(int(digits, 8) & 0xFF)
+                elif e not in b'\r\n':
+                    out.append(e)
+                continue
+            if c == ord('('):
+                depth += 1
+            elif c == ord(')'):
+                depth -= 1
+                if not depth:
+                    return bytes(out)
+            out.append(c)
+
+
+def _png_unpredict(data: bytes, columns: int, bytes_per_pixel: int) -> bytes:
+    """Reverses the PNG row filters (predictors 10 to 15) of a FlateDecode stream."""
+    row_size = columns
+    rows = []
+    previous = bytearray(row_size)
+    for row_start in range(0, len(data), row_size + 1):
+        filter_type = data[row_start]
+        row = bytearray(data[row_start + 1:row_start + 1 + row_size])
+        for i in range(len(row)):
+            left = row[i - bytes_per_pixel] if i >= bytes_per_pixel else 0
+            up = previous[i]
+            if filter_type == 1:
+                row[i] = (row[i] + left) & 0xFF
+            elif filter_type == 2:
+                row[i] = (row[i] + up) & 0xFF
+            elif filter_type == 3:
+                row[i] = (row[i] + (left + up) // 2) & 0xFF
+            elif filter_type == 4:
+                up_left = previous[i - bytes_per_pixel] if i >= bytes_per_pixel else 0
+                p = left + up - up_left
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+                row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else up_left)) & 0xFF
+            elif filter_type != 0:
+                raise PageCountError(f"unknown PNG filter {filter_type}")
+        rows.append(bytes(row))
+        previous = row
+    return b''.join(rows)
+
+
+class PdfPageCounter:
+    """
+    Reads the page count of a PDF from the /Count of its page tree root, which
+    is found through the trailer: startxref -> cross-reference table or
+    stream -> /Root catalog -> /Pages. Only the end of the file and the few
+    objects on the way are read. Cross-reference streams, object streams and
+    incremental updates (/Prev, /XRefStm) are followed; anything else, e.g.
+    encrypted object streams or a broken xref, raises so the caller can fall
+    back to parsing the whole file.
+    """
+
+    def __init__(self, reader: S3RangeReader):
+        self.reader = reader
+        self._sections = []
+        self._next_section = None
+        self._object_streams = {}
+
+    def linearized_page_count(self) -> Optional[int]:
+        """
+        /N of the linearization dictionary at the start of the file, as long as
+        its /L still matches the file size (no incremental update since).
+        """
+        if self.reader.size is None:
+            return None
+        head = self.reader.read(0, 1024)
+        match = re.search(rb'\d+\s+\d+\s+obj', head)
+        if not match:
+            return None
+        try:
+            lexer = PdfLexer(head, match.end())
+            params = lexer.parse()
+        except (_Truncated, PageCountError, IndexError):
+            return None
+        if isinstance(params, dict) and 'Linearized' in params and params.get('L') == self.reader.size \
+                and isinstance(params.get('N'), int):
+            return params['N']
+        return None
+
+    def count(self) -> int:
+        linearized = self.linearized_page_count()
+        if linearized:
+            return linearized
+
+        _, tail = self.reader.read_tail(self.reader.read_ahead)
+        position = tail.rfind(b'startxref')
+        if position < 0:
+            raise PageCountError("no startxref")
+        self._next_section = PdfLexer(tail, position + len(b'startxref')).integer()
+
+        trailer = self._load_section()
+        while 'Root' not in trailer:
+            trailer = self._load_section()
+        catalog = self._resolve(trailer['Root'])
+        pages = self._resolve(catalog.get('Pages'))
+        count = self._resolve(pages.get('Count')) if isinstance(pages, dict) else None
+        if not isinstance(count, int) or count < 1:
+            raise PageCountError(f"invalid page tree /Count {count!r}")
+        return count
+
+    def _parse_at(self, offset: int, parse):
+        """Runs parse on a PdfLexer at offset, with more bytes until it is not truncated."""
+        length = 4096
+        while True:
+            data = self.reader.read(offset, length)
+            try:
+                return parse(PdfLexer(data, complete=len(data) < length))
+            except (_Truncated, IndexError):
+                if len(data) < length or length >= MAX_OBJECT_SIZE:
+                    raise PageCountError(f"object at {offset} is truncated")
+                length *= 4
+
+    def _indirect_object(self, offset: int):
+        """The object n g obj ... at offset, with the start of its stream data for streams."""
+
+        def parse(lexer):
+            lexer.integer()
+            lexer.integer()
+            lexer.expect(b'obj')
+            value = lexer.parse()
+            stream_start = None
+            if isinstance(value, dict):
+                lexer.skip_whitespace()
+                if lexer.buf.startswith(b'stream', lexer.pos):
+                    stream_start = lexer.pos + len(b'stream')
+                    if lexer.buf.startswith(b'\r\n', stream_start):
+                        stream_start += 2
+                    elif lexer.buf.startswith(b'\n', stream_start):
+                        stream_start += 1
+                    elif stream_start >= len(lexer.buf):
+                        raise _Truncated()
+                    stream_start += offset
+            return value, stream_start
+
+        return self._parse_at(offset, parse)
+
+    def _stream_data(self, dictionary: dict, stream_start: int) -> bytes:
+        length = self._resolve(dictionary.get('Length'))
+        data = self.reader.read(stream_start, length)
+        filters = dictionary.get('Filter')
+        filters = filters if isinstance(filters, list) else [filters] if filters else []
+        params = dictionary.get('DecodeParms')
+        params = (params[0] if isinstance(params, list) and params else params) or {}
+        for filter_name in filters:
+            if filter_name != 'FlateDecode':
+                raise PageCountError(f"unsupported stream filter {filter_name}")
+            data = zlib.decompress(data)
+        predictor = params.get('Predictor', 1)
+        if predictor >= 10:
+            colors = params.get('Colors', 1)
+            bits = params.get('BitsPerComponent', 8)
+            columns = params.get('Columns', 1)
+            data = _png_unpredict(data, (columns * colors * bits + 7) // 8, max(1, colors * bits // 8))
+        elif predictor != 1:
+            raise PageCountError(f"unsupported predictor {predictor}")
+        return data
+
+    def _load_section(self) -> dict:
+        """Loads the next (older) cross-reference section and returns its trailer."""
+        offset = self._next_section
+        if offset is None:
+            raise PageCountError("object not found in any cross-reference section")
+        if any(section[0] == offset for section in self._sections):
+            raise PageCountError(f"cross-reference loop at {offset}")
+
+        if self.reader.read(offset, 4) == b'xref':
+            trailer, subsections = self._xref_table(offset + 4)
+            self._sections.append((offset, 'table', subsections))
+            if isinstance(trailer.get('XRefStm'), int):
+                # hybrid file: the stream holds the objects the table does not
+                self._xref_stream(trailer['XRefStm'])
+        else:
+            trailer = self._xref_stream(offset)
+        self._next_section = trailer.get('Prev') if isinstance(trailer.get('Prev'), int) else None
+        return trailer
+
+    def _xref_table(self, position: int):
+        subsections = []
+        while True:
+            line = self.reader.read(position, 64)
+            lexer = PdfLexer(line)
+            lexer.skip_whitespace()
+            if line.startswith(b'trailer', lexer.pos):
+                trailer = self._parse_at(position + lexer.pos + len(b'trailer'), lambda l: l.parse())
+                return trailer, subsections
+            first = lexer.integer()
+            count = lexer.integer()
+            # the 20 byte entries start on the next line
+            while lexer.pos < len(line) and line[lexer.pos] in b' \t':
+                lexer.pos += 1
+            if line.startswith(b'\r\n', lexer.pos):
+                lexer.pos += 2
+            elif lexer.pos < len(line) and line[lexer.pos] in b'\r\n':
+                lexer.pos += 1
+            else:
+                raise PageCountError(f"malformed cross-reference subsection at {position}")
+            subsections.append((first, count, position + lexer.pos))
+            position = position + lexer.pos + 20 * count
+
+    def _xref_stream(self, offset: int) -> dict:
+        dictionary, stream_start = self._indirect_object(offset)
+        if not isinstance(dictionary, dict) or dictionary.get('Type') != 'XRef' or stream_start is None:
+            raise PageCountError(f"no cross-reference stream at {offset}")
+        data = self._stream_data(dictionary, stream_start)
+        widths = dictionary['W']
+        entry_size = sum(widths)
+        index = dictionary.get('Index', [0, dictionary['Size']])
+        entries = {}
+        position = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            for num in range(first, first + count):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(data[position:position + width], 'big') if width else None)
+                    position += width
+                entry_type = 1 if fields[0] is None else fields[0]
+                entries[num] = (entry_type, fields[1], fields[2] or 0)
+            if position > len(data):
+                raise PageCountError(f"cross-reference stream at {offset} is truncated")
+        self._sections.append((offset, 'stream', entries))
+        return dictionary
+
+    def _entry(self, section, num: int):
+        """
+        The entry of an object in a section, None if it has none or a free one:
+        hybrid files list the objects of their object streams as free in the
+        table and in use in the /XRefStm stream.
+        """
+        _, kind, content = section
+        if kind == 'stream':
+            entry = content.get(num)
+            return entry if entry and entry[0] else None
+        for first, count, entries_offset in content:
+            if first <= num < first + count:
+                entry = self.reader.read(entries_offset + 20 * (num - first), 20)
+                match = re.match(rb'(\d{10}) (\d{5}) ([nf])', entry)
+                if not match:
+                    raise PageCountError(f"malformed cross-reference entry for object {num}")
+                if match.group(3) == b'f':
+                    return None
+                return 1, int(match.group(1)), int(match.group(2))
+        return None
+
+    def _lookup(self, num: int):
+        """The newest cross-reference entry of an object, loading older sections as needed."""
+        position = 0
+        while True:
+            while position < len(self._sections):
+                entry = self._entry(self._sections[position], num)
+                if entry is not None:
+                    return entry
+                position += 1
+            self._load_section()
+
+    def _resolve(self, value):
+        if not isinstance(value, Ref):
+            return value
+        entry_type, field, index = self._lookup(value.num)
+        if entry_type == 1:
+            obj, _ = self._indirect_object(field)
+            return obj
+        if entry_type == 2:
+            return self._object_stream_member(field, index)
+        raise PageCountError(f"unknown cross-reference entry type {entry_type} for object {value.num}")
+
+    def _object_stream_member(self, stream_num: int, index: int):
+        if stream_num not in self._object_streams:
+            entry_type, offset, _ = self._lookup(stream_num)
+            if entry_type != 1:
+                raise PageCountError(f"object stream {stream_num} is not stored at an offset")
+            dictionary, stream_start = self._indirect_object(offset)
+            data = self._stream_data(dictionary, stream_start)
+            header = PdfLexer(data[:dictionary['First']] + b' ', complete=True)
+            offsets = [(header.integer(), header.integer())[1] for _ in range(dictionary['N'])]
+            self._object_streams[stream_num] = (data, dictionary['First'], offsets)
+        data, first, offsets = self._object_streams[stream_num]
+        return PdfLexer(data, first + offsets[index], complete=True).parse()
+
+
+def count_pdf_pages(reader: S3RangeReader) -> int:
+    return PdfPageCounter(reader).count()
+
+
+def count_pages_with_ranged_reads(reader: S3RangeReader, mime: str) -> int:
+    if mime == 'application/pdf':
+        return count_pdf_pages(reader)
+    if mime == 'image/tiff':
+        return count_tiff_pages(reader)
+    raise ValueError(f"no ranged page count for mime type: {mime}")
@@ -0,0 +1,237 @@
+"""
+Per-invocation stage metrics, written to the log in the CloudWatch Embedded
+Metric Format (EMF), so CloudWatch turns them into metrics without any API call:
+
+    s3 = boto3.client('s3')
+    emf_metrics.instrument_s3(s3)
+
+    @emf_metrics.emit_metrics('textract-to-txt')
+    def lambda_handler(event, _):
+        emf_metrics.set_document(**emf_metrics.document_from_event(event))
+        with emf_metrics.timer('ParseTime'):
+            ...
+
+Every invocation writes one record with the S3 GET/PUT bytes, counts and
+latency, the timers, page and block counts, the handler time and the peak
+memory. The metrics have the dimension sets [Stage] and
+[Stage, Mime, PageBucket]. METRICS_NAMESPACE sets the namespace,
+EMF_METRICS=false turns the records off.
+"""
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from botocore.utils import determine_content_length
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAMESPACE = "IDPArchivePipeline"
+# S3 operations that download or upload object data
+GET_OPERATIONS = {'GetObject'}
+PUT_OPERATIONS = {'PutObject', 'UploadPart'}
+# upper bounds of the PageBucket dimension values
+PAGE_BUCKETS = [(1, "1"), (10, "2-10"), (100, "11-100"), (1000, "101-1000")]
+
+
+def page_bucket(pages: Optional[int]) -> str:
+    if not pages:
+        return "unknown"
+    for upper, name in PAGE_BUCKETS:
+        if pages <= upper:
+            return name
+    return f">{PAGE_BUCKETS[-1][0]}"
+
+
+def peak_memory_mb() -> float:
+    """Peak RSS of the execution environment so far, ru_maxrss is in KB on Linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageMetrics:
+    """
+    The metrics of one invocation. add() and the S3 hooks may be called from
+    several threads, the values are summed per name.
+    """
+
+    def __init__(self, stage: str, namespace: Optional[str] = None):
+        self.stage = stage
+        self.namespace = namespace or os.environ.get('METRICS_NAMESPACE', DEFAULT_NAMESPACE)
+        self.mimes = set()
+        self.pages = None
+        self.values = {}
+        self.units = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, value: float, unit: str = 'Count'):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def set_document(self, mime: Optional[str] = None, pages: Optional[int] = None):
+        """
+        A batch (decider) sets a document per item, the Mime dimension is then
+        'mixed' if they differ and PageBucket is the one of the largest document.
+        """
+        with self._lock:
+            if mime:
+                self.mimes.add(mime)
+            if pages:
+                self.pages = max(self.pages or 0, int(pages))
+
+    @contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000, 'Milliseconds')
+
+    def record(self) -> dict:
+        with self._lock:
+            values = dict(self.values)
+            units = dict(self.units)
+            mime = self.mimes.copy().pop() if len(self.mimes) == 1 else ("mixed" if self.mimes else "unknown")
+            pages = self.pages
+        if pages:
+            values['PageCount'] = pages
+            units['PageCount'] = 'Count'
+        values['PeakMemory'] = peak_memory_mb()
+        units['PeakMemory'] = 'Megabytes'
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [["Stage"], ["Stage", "Mime", "PageBucket"]],
+                    "Metrics": [{"Name": name, "Unit": units[name]} for name in values]
+                }]
+            },
+            "Stage": self.stage,
+            "Mime": mime,
+            "PageBucket": page_bucket(pages),
+            **values
+        }
+
+    def flush(self):
+        if (os.environ.get('EMF_METRICS', None) or 'true').lower() == 'false':
+            return
+        # EMF records have to be a line of their own in the log, not a logging record
+        sys.stdout.write(json.dumps(self.record()) + "\n")
+        sys.stdout.flush()
+
+
+_current: Optional[StageMetrics] = None
+
+
+def current() -> Optional[StageMetrics]:
+    return _current
+
+
+def add(name: str, value: float, unit: str = 'Count'):
+    if _current:
+        _current.add(name, value, unit)
+
+
+def set_document(mime: Optional[str] = None, pages: Optional[int] = None):
+    if _current:
+        _current.set_document(mime=mime, pages=pages)
+
+
+@contextmanager
+def timer(name: str):
+    if not _current:
+        yield
+        return
+    with _current.timer(name):
+        yield
+
+
+def document_from_event(event: dict) -> dict:
+    """
+    mime and numberOfPages of the decider result, which the state machine
+    passes on under one or more levels of Payload.
+    """
+    document = event
+    for _ in range(4):
+        if not isinstance(document, dict):
+            break
+        if 'mime' in document or 'numberOfPages' in document:
+            return {'mime': document.get('mime'), 'pages': document.get('numberOfPages')}
+        document = document.get('Payload')
+    return {}
+
+
+def emit_metrics(stage: str):
+    """Decorator of a Lambda handler, collects the metrics of every invocation and writes them at the end."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _current
+            _current = metrics = StageMetrics(stage)
+            try:
+                with metrics.timer('HandlerTime'):
+                    return handler(event, context)
+            finally:
+                _current = None
+                try:
+                    metrics.flush()
+                except Exception:
+                    logger.exception("could not write the metrics")
+        return wrapper
+    return decorator
+
+
+class BlockCounter:
+    """A consumer of the streamed blocks (see stream_merge) that counts them."""
+
+    def __init__(self):
+        self.blocks = 0
+
+    def add(self, block: dict):
+        self.blocks += 1
+
+
+def _before_call(model, params, context, **_):
+    if model.name in GET_OPERATIONS or model.name in PUT_OPERATIONS:
+        context['emf_started'] = time.perf_counter()
+
+
+def _after_call(model, parsed, context, **_):
+    started = context.get('emf_started')
+    metrics = _current
+    if started is None or metrics is None:
+        return
+    latency = (time.perf_counter() - started) * 1000
+    if model.name in GET_OPERATIONS:
+        metrics.add('S3GetBytes', parsed.get('ContentLength') or 0, 'Bytes')
+        metrics.add('S3GetLatency', latency, 'Milliseconds')
+        metrics.add('S3GetCount', 1)
+    else:
+        metrics.add('S3PutBytes', context.get('emf_put_bytes', 0), 'Bytes')
+        metrics.add('S3PutLatency', latency, 'Milliseconds')
+        metrics.add('S3PutCount', 1)
+
+
+def _put_size(params, context, model, **_):
+    if model.name in PUT_OPERATIONS:
+        context['emf_put_bytes'] = determine_content_length(params.get('Body')) or 0
+
+
+def instrument_s3(s3_client):
+    """
+    Records the GET and PUT requests of the client into the metrics of the
+    running invocation. The latency of a GET is the time to the response
+    headers, reading the body is part of the time of the caller.
+    """
+    events = s3_client.meta.events
+    events.register('before-parameter-build.s3', _put_size)
+    events.register('before-call.s3', _before_call)
+    events.register('after-call.s3', _after_call)
+    return s3_client
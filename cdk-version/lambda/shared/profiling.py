@@ -0,0 +1,285 @@
+"""
+Opt-in profiling of Lambda handlers, controlled by the environment:
+
+    PROFILER               off (default), cprofile, tracemalloc or sampler
+    PROFILE_SAMPLE_RATE    share of the invocations to profile, 1.0 by default
+    PROFILE_MIN_PAGES      only profile documents with at least this many pages
+    PROFILE_MIN_SECONDS    only upload profiles of invocations that ran this long
+    PROFILE_TOP_N          lines of the text reports, 50 by default
+    PROFILE_INTERVAL       seconds between the samples of the sampler, 0.01 by default
+    PROFILE_BUCKET         bucket for the profiles, S3_OUTPUT_BUCKET or the
+                           bucket of the document by default
+    PROFILE_PREFIX         prefix of the profiles, profiles by default
+
+    @profiling.profile_handler('textract-to-txt')
+    def lambda_handler(event, _):
+        ...
+
+With PROFILER off the decorator returns the handler itself, so there is no
+wrapper on the call path at all. The profiles are written to
+s3://<bucket>/<prefix>/<execution>/<stage>/<request id>.<ext>:
+
+    cprofile     .pstats (pstats.Stats(path)) and a .txt by cumulative time
+    tracemalloc  .txt with the top allocating lines and the peak
+    sampler      .folded stacks of the handler thread (flamegraph.pl,
+                 speedscope) and a .txt of the hottest stacks
+
+Shortly before the Lambda timeout the sampler and tracemalloc write what they
+have, so a run that never finishes still leaves a profile. cProfile only
+profiles the handler thread and cannot be read from another one.
+"""
+import functools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+# the profilers import their modules themselves, with PROFILER off none of them is loaded
+
+# left of the Lambda timeout when the profile of an unfinished invocation is written
+DEADLINE_MARGIN_SECONDS = 10
+
+
+class CProfileProfiler:
+    dumps_at_deadline = False
+
+    def __init__(self, settings: dict):
+        import cProfile
+
+        self.top_n = settings['top_n']
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def artifacts(self) -> Dict[str, bytes]:
+        import io
+        import pstats
+        import tempfile
+
+        text = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(self.top_n)
+        with tempfile.NamedTemporaryFile(suffix='.pstats') as dump:
+            stats.dump_stats(dump.name)
+            binary = dump.read()
+        return {'pstats': binary, 'txt': text.getvalue().encode('utf-8')}
+
+
+class TracemallocProfiler:
+    dumps_at_deadline = True
+
+    def __init__(self, settings: dict):
+        import tracemalloc
+
+        self.tracemalloc = tracemalloc
+        self.top_n = settings['top_n']
+        self.report = None
+
+    def start(self):
+        self.tracemalloc.start()
+
+    def stop(self):
+        # the snapshot has to be taken while tracemalloc still traces
+        self.report = self._report()
+        self.tracemalloc.stop()
+
+    def artifacts(self) -> Dict[str, bytes]:
+        return {'txt': self.report or self._report()}
+
+    def _report(self) -> bytes:
+        current, peak = self.tracemalloc.get_traced_memory()
+        lines = [f"current {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB", ""]
+        for statistic in self.tracemalloc.take_snapshot().statistics('lineno')[:self.top_n]:
+            lines.append(str(statistic))
+        return "\n".join(lines).encode('utf-8')
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampler: a thread records the stack of the handler thread every
+    interval, waiting on I/O included, which cProfile does not show as such.
+    """
+    dumps_at_deadline = True
+
+    def __init__(self, settings: dict):
+        self.top_n = settings['top_n']
+        self.interval = settings['interval']
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def artifacts(self) -> Dict[str, bytes]:
+        stacks = self.stacks.copy()
+        folded = "\n".join(f"{stack} {count}" for stack, count in stacks.items())
+        total = sum(stacks.values()) or 1
+        lines = [f"{total} samples every {self.interval} s", ""]
+        for stack, count in stacks.most_common(self.top_n):
+            lines.append(f"{100 * count / total:5.1f}% {stack.rsplit(';', 1)[-1]}  <-  {stack}")
+        return {'folded': folded.encode('utf-8'), 'txt': "\n".join(lines).encode('utf-8')}
+
+
+PROFILERS = {
+    'cprofile': CProfileProfiler,
+    'tracemalloc': TracemallocProfiler,
+    'sampler': SamplingProfiler,
+}
+
+
+def settings_from_env() -> Optional[dict]:
+    """None if profiling is off."""
+    profiler = (os.environ.get('PROFILER', None) or 'off').lower()
+    if profiler == 'off':
+        return None
+    if profiler not in PROFILERS:
+        raise ValueError(f"PROFILER: {profiler} is none of off, {', '.join(PROFILERS)}")
+    return {
+        'profiler': profiler,
+        'sample_rate': float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0)),
+        'min_pages': int(os.environ.get('PROFILE_MIN_PAGES', 0)),
+        'min_seconds': float(os.environ.get('PROFILE_MIN_SECONDS', 0)),
+        'top_n': int(os.environ.get('PROFILE_TOP_N', 50)),
+        'interval': float(os.environ.get('PROFILE_INTERVAL', 0.01)),
+        'bucket': os.environ.get('PROFILE_BUCKET', None) or os.environ.get('S3_OUTPUT_BUCKET', None),
+        'prefix': os.environ.get('PROFILE_PREFIX', None) or 'profiles',
+    }
+
+
+def _find(event, key: str, depth: int = 4):
+    """The value of key in the event or in one of its Payloads, the state machine nests the results."""
+    for _ in range(depth):
+        if not isinstance(event, dict):
+            return None
+        if key in event:
+            return event[key]
+        event = event.get('Payload')
+    return None
+
+
+def _split_s3_path(s3_path) -> Tuple[Optional[str], Optional[str]]:
+    if not isinstance(s3_path, str) or not s3_path.startswith('s3://'):
+        return None, None
+    bucket, _, key = s3_path[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def _output_path(event: dict) -> Optional[str]:
+    textract_result = _find(event, 'textract_result') or {}
+    return textract_result.get('TextractOutputJsonPath') or textract_result.get('TextractTempOutputJsonPath')
+
+
+def _output_bucket(event: dict) -> Optional[str]:
+    """The pipeline bucket, from the Textract output of the event, the manifest points to the source bucket."""
+    return _split_s3_path(_output_path(event))[0]
+
+
+def _document_name(event: dict) -> Optional[str]:
+    manifest = _find(event, 'manifest') or {}
+    _, key = _split_s3_path(manifest.get('s3Path') if isinstance(manifest, dict) else None)
+    if not key:
+        _, key = _split_s3_path(_output_path(event))
+    return os.path.basename(key) if key else None
+
+
+def profile_key(settings: dict, stage: str, event: dict, context) -> str:
+    """
+    Keyed by the name of the Step Functions execution where the event carries
+    its ExecutionId, otherwise by the document.
+    """
+    execution = _find(event, 'ExecutionId')
+    if execution:
+        execution = str(execution).rsplit(':', 1)[-1]
+    else:
+        execution = _document_name(event) or 'no-execution'
+    request_id = getattr(context, 'aws_request_id', None) or f"{int(time.time() * 1000)}"
+    return f"{settings['prefix']}/{execution}/{stage}/{request_id}"
+
+
+def should_profile(settings: dict, event: dict) -> bool:
+    if settings['min_pages']:
+        pages = _find(event, 'numberOfPages')
+        if pages is not None and int(pages) < settings['min_pages']:
+            return False
+    return random.random() < settings['sample_rate']
+
+
+def write_artifacts(profiler, settings: dict, bucket: Optional[str], key: str):
+    if not bucket:
+        logger.warning(f"no PROFILE_BUCKET and no bucket in the event, not writing the profile {key}")
+        return
+    import boto3
+
+    s3_client = boto3.client('s3')
+    for extension, body in profiler.artifacts().items():
+        s3_client.put_object(Bucket=bucket, Key=f"{key}.{extension}", Body=body)
+        logger.info(f"wrote profile s3://{bucket}/{key}.{extension}")
+
+
+def profile_handler(stage: str):
+    """Decorator of a Lambda handler, see the module docstring."""
+    def decorator(handler):
+        settings = settings_from_env()
+        if settings is None:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not should_profile(settings, event):
+                return handler(event, context)
+            bucket = settings['bucket'] or _output_bucket(event)
+            key = profile_key(settings, stage, event, context)
+            profiler = PROFILERS[settings['profiler']](settings)
+            deadline = None
+            remaining = getattr(context, 'get_remaining_time_in_millis', None)
+            if profiler.dumps_at_deadline and remaining:
+                deadline = threading.Timer(max(0.0, remaining() / 1000 - DEADLINE_MARGIN_SECONDS),
+                                           _write_safely, (profiler, settings, bucket, f"{key}-deadline"))
+                deadline.daemon = True
+                deadline.start()
+            started = time.perf_counter()
+            profiler.start()
+            try:
+                return handler(event, context)
+            finally:
+                if deadline:
+                    deadline.cancel()
+                profiler.stop()
+                if time.perf_counter() - started >= settings['min_seconds']:
+                    _write_safely(profiler, settings, bucket, key)
+        return wrapper
+    return decorator
+
+
+def _write_safely(profiler, settings: dict, bucket: Optional[str], key: str):
+    """A profile that cannot be written must not fail the invocation."""
+    try:
+        write_artifacts(profiler, settings, bucket, key)
+    except Exception:
+        logger.exception(f"could not write the profile {key}")
@@ -0,0 +1,234 @@
+"""
+S3 reads and writes of the pipeline, shared by all Lambdas:
+
+    s3 = s3_io.client()
+    body = s3_io.read_s3_path(s3, "s3://bucket/key")        # bytes, parallel ranged GETs when large
+    for chunk in s3_io.iter_object(s3, bucket, key): ...     # streamed
+    for body in s3_io.iter_objects(s3, bucket, keys): ...    # in order, the next ones prefetched
+    s3_io.upload(s3, bucket, key, text)                      # multipart with concurrent parts when large
+    with s3_io.S3MultipartWriter(s3, bucket, key) as writer: # streamed upload of unknown size
+        writer.write(...)
+
+S3_IO_CONCURRENCY sets the number of requests one read or upload has in
+flight (8 by default), S3_MAX_POOL_CONNECTIONS the connection pool of client().
+"""
+import builtins
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# S3 requires every part but the last to be at least 5 MiB
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+# objects larger than one range are read with parallel ranged GETs
+RANGE_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+CONCURRENCY = int(os.environ.get('S3_IO_CONCURRENCY', 8))
+MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 50))
+
+
+def client(max_pool_connections: Optional[int] = None):
+    """
+    S3 client with a connection pool for the parallel requests of this module
+    and the threads of the caller, keep-alive and standard retries.
+    """
+    return boto3.client('s3', config=Config(
+        max_pool_connections=max(max_pool_connections or MAX_POOL_CONNECTIONS, CONCURRENCY),
+        retries={'max_attempts': 5, 'mode': 'standard'},
+        tcp_keepalive=True))
+
+
+def split_s3_path_to_bucket_and_key(s3_path: str) -> Tuple[str, str]:
+    if len(s3_path) <= 7 or not s3_path.lower().startswith("s3://"):
+        raise ValueError(
+            f"s3_path: {s3_path} is no s3_path in the form of s3://bucket/key."
+        )
+    s3_bucket, s3_key = s3_path.replace("s3://", "").split("/", 1)
+    return (s3_bucket, s3_key)
+
+
+def open_object(s3_client, bucket: str, key: str, range: Optional[str] = None):
+    """The body of the object as a file-like object, read() it in pieces or iter_chunks() it."""
+    if range:
+        return s3_client.get_object(Bucket=bucket, Key=key, Range=range)['Body']
+    return s3_client.get_object(Bucket=bucket, Key=key)['Body']
+
+
+def iter_object(s3_client, bucket: str, key: str, range: Optional[str] = None,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    body = open_object(s3_client, bucket, key, range=range)
+    try:
+        yield from body.iter_chunks(chunk_size)
+    finally:
+        body.close()
+
+
+def _total_size(response: dict) -> int:
+    # ContentRange: bytes 0-8388607/123456789
+    return int(response['ContentRange'].rsplit('/', 1)[1])
+
+
+def read_object(s3_client, bucket: str, key: str, range: Optional[str] = None,
+                range_size: int = RANGE_SIZE, concurrency: int = CONCURRENCY) -> bytes:
+    """
+    The whole object (or range) in memory. The first range tells the size of
+    the object, the rest of a large object is read with parallel ranged GETs of
+    the same version (IfMatch the ETag of the first one).
+    """
+    if range:
+        return open_object(s3_client, bucket, key, range=range).read()
+    try:
+        first = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{range_size - 1}")
+    except ClientError as e:
+        # a range of an empty object is not satisfiable
+        if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+            return b''
+        raise
+    head = first['Body'].read()
+    size = _total_size(first) if 'ContentRange' in first else len(head)
+    if size <= len(head):
+        return head
+
+    data = bytearray(size)
+    data[:len(head)] = head
+    etag = first['ETag']
+
+    def read_range(start: int):
+        end = min(start + range_size, size) - 1
+        body = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)['Body']
+        data[start:end + 1] = body.read()
+
+    # range is the parameter of the same name as in the get_file_from_s3 helpers this replaces
+    starts = list(builtins.range(len(head), size, range_size))
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(starts))) as executor:
+        list(executor.map(read_range, starts))
+    logger.debug(f"read s3://{bucket}/{key} ({size} bytes) with {len(starts) + 1} ranged GETs")
+    return bytes(data)
+
+
+def read_s3_path(s3_client, s3_path: str, range: Optional[str] = None) -> bytes:
+    s3_bucket, s3_key = split_s3_path_to_bucket_and_key(s3_path)
+    return read_object(s3_client, s3_bucket, s3_key, range=range)
+
+
+def iter_objects(s3_client, bucket: str, keys: Iterable[str], read_ahead: int = 2) -> Iterator[bytes]:
+    """The bodies of the keys in order, read_ahead of them are read while the caller works on the current one."""
+    keys = iter(keys)
+    with ThreadPoolExecutor(max_workers=max(1, read_ahead)) as executor:
+        pending = deque()
+        for key in keys:
+            pending.append(executor.submit(read_object, s3_client, bucket, key))
+            if len(pending) > read_ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class S3MultipartWriter:
+    """
+    Write-only file-like object that buffers bytes into S3 multipart upload
+    parts, so memory stays bounded by the part size and not the object size.
+    Up to concurrency parts are uploaded at the same time, while the caller
+    keeps writing. Output smaller than one part is written with a single
+    put_object.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, part_size: int = DEFAULT_PART_SIZE,
+                 concurrency: int = CONCURRENCY):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size: {part_size} is smaller than the S3 minimum of {MIN_PART_SIZE}")
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = max(1, concurrency)
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._executor = None
+        self._uploads = deque()
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data: bytes) -> int:
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body: bytes):
+        if not self._upload_id:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self._upload_id = response['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        # the parts in flight are the memory of the writer, wait for the oldest one first
+        while len(self._uploads) >= self.concurrency:
+            self._parts.append(self._uploads.popleft().result())
+        part_number = len(self._parts) + len(self._uploads) + 1
+        self._uploads.append(self._executor.submit(self._send_part, part_number, body))
+
+    def _send_part(self, part_number: int, body: bytes) -> dict:
+        response = self.s3_client.upload_part(Bucket=self.bucket,
+                                              Key=self.key,
+                                              UploadId=self._upload_id,
+                                              PartNumber=part_number,
+                                              Body=body)
+        logger.debug(f"uploaded part {part_number} of s3://{self.bucket}/{self.key}")
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def close(self):
+        if not self._upload_id:
+            self.s3_client.put_object(Body=bytes(self._buffer), Bucket=self.bucket, Key=self.key)
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            while self._uploads:
+                self._parts.append(self._uploads.popleft().result())
+            self._executor.shutdown()
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket,
+                                                     Key=self.key,
+                                                     UploadId=self._upload_id,
+                                                     MultipartUpload={'Parts': self._parts})
+        self._buffer = bytearray()
+
+    def abort(self):
+        if self._upload_id:
+            logger.error(f"aborting multipart upload for s3://{self.bucket}/{self.key}")
+            for upload in self._uploads:
+                upload.cancel()
+            self._executor.shutdown()
+            self._uploads.clear()
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        self._buffer = bytearray()
+
+
+def upload(s3_client, bucket: str, key: str, body, part_size: int = DEFAULT_PART_SIZE) -> int:
+    """Writes body (bytes or str) to s3://bucket/key, multipart above part_size. Returns the size."""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if len(body) <= part_size:
+        s3_client.put_object(Body=body, Bucket=bucket, Key=key)
+        return len(body)
+    with S3MultipartWriter(s3_client, bucket, key, part_size=part_size) as writer:
+        view = memoryview(body)
+        for start in range(0, len(body), part_size):
+            writer.write(view[start:start + part_size])
+    return len(body)
@@ -7,6 +7,8 @@ from datetime import datetime
 import re
 
 import boto3
+import emf_metrics
+import profiling
 
 from datetime import timezone
 logger = logging.getLogger(__name__)
@@ -15,6 +17,8 @@ step_functions_client = boto3.client(service_name='stepfunctions')
 TRIGGER_TYPES = []
 
 
+@profiling.profile_handler('startpipeline')
+@emf_metrics.emit_metrics('startpipeline')
 def lambda_handler(event, _):
     log_level = os.environ.get('LOG_LEVEL', 'INFO')
     logger.setLevel(log_level)
@@ -56,4 +60,5 @@ def lambda_handler(event, _):
             stateMachineArn=state_machine_arn,
             name=filename,
             input=tm.IDPManifestSchema().dumps(manifest))
+        emf_metrics.add('ExecutionsStarted', 1)
         logger.info(response)
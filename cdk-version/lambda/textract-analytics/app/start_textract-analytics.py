@@ -1,13 +1,15 @@
 
-from typing import Tuple
 import os 
 import logging
 import json
 import datetime
 
 from utils.analyze_textract import AnalyzeTextract
-import boto3
-s3 = boto3.client('s3')
+from utils.block_store import iter_block_store
+import emf_metrics
+import s3_io
+import profiling
+s3 = emf_metrics.instrument_s3(s3_io.client())
 
 logger = logging.getLogger(__name__)
 log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -15,23 +17,8 @@ logger.setLevel(log_level)
 
 version = "0.0.1"
 
-def split_s3_path_to_bucket_and_key(s3_path: str) -> Tuple[str, str]:
-    if len(s3_path) <= 7 or not s3_path.lower().startswith("s3://"):
-        raise ValueError(
-            f"s3_path: {s3_path} is no s3_path in the form of s3://bucket/key."
-        )
-    s3_bucket, s3_key = s3_path.replace("s3://", "").split("/", 1)
-    return (s3_bucket, s3_key)
-        
-
-def get_file_from_s3(s3_path: str, range=None) -> bytes:
-    s3_bucket, s3_key = split_s3_path_to_bucket_and_key(s3_path)
-    if range:
-        o = s3.get_object(Bucket=s3_bucket, Key=s3_key, Range=range)
-    else:
-        o = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-    return o.get('Body').read()
-
+@profiling.profile_handler('textract-analytics')
+@emf_metrics.emit_metrics('textract-analytics')
 def lambda_handler(event, _):
     logger.setLevel('INFO')
     logger.info(f"version: {version}")
@@ -42,30 +29,45 @@ def lambda_handler(event, _):
     date = datetime.datetime.today().strftime('%Y-%m-%d')
     logger.info(json.dumps(event))
 
-    if event.get('Payload').get('Payload').get("textract_result"):
-        textract_result = event.get('Payload').get('Payload').get("textract_result")
-    elif event.get('Payload').get("textract_result"):
-        textract_result = event.get('Payload').get("textract_result")
+    # the state machine passes {"Payload": <decider result>, "textract_result": ...}, older
+    # definitions nested the output of the previous Lambda under Payload
+    payload = event.get('Payload') or {}
+    if (payload.get('Payload') or {}).get("textract_result"):
+        textract_result = payload.get('Payload').get("textract_result")
+    elif payload.get("textract_result"):
+        textract_result = payload.get("textract_result")
     else:
         textract_result = event.get("textract_result")
     
     
-    logger.info(f"Get Textract JSON {textract_result.get('TextractOutputJsonPath')}")
-    textract_s3_byte = get_file_from_s3(textract_result.get('TextractOutputJsonPath'))
-    s3_bucket, s3_key = split_s3_path_to_bucket_and_key(textract_result.get('TextractOutputJsonPath'))
+    emf_metrics.set_document(**emf_metrics.document_from_event(event))
+    s3_bucket, s3_key = s3_io.split_s3_path_to_bucket_and_key(textract_result.get('TextractOutputJsonPath'))
     file_name = s3_key.split('/')[-1].split('.')[0]    
-    logger.info("Reading the JSON")    
-    textract_json = json.loads(textract_s3_byte)
+    if textract_result.get('TextractBlockStorePath'):
+        logger.info(f"Get Textract blocks {textract_result.get('TextractBlockStorePath')}")
+        textract_json = {'Blocks': iter_block_store(s3, textract_result.get('TextractBlockStorePath'))}
+        size = s3.head_object(Bucket=s3_bucket, Key=s3_key)['ContentLength']
+    else:
+        logger.info(f"Get Textract JSON {textract_result.get('TextractOutputJsonPath')}")
+        textract_s3_byte = s3_io.read_s3_path(s3, textract_result.get('TextractOutputJsonPath'))
+        # the ContentLength of the merged JSON object
+        size = len(textract_s3_byte)
+        logger.info("Reading the JSON")    
+        with emf_metrics.timer('ParseTime'):
+            textract_json = json.loads(textract_s3_byte)
+        del textract_s3_byte
     
     logger.info("Analyzing JSON")
-    analysis = AnalyzeTextract(textract_json=textract_json)
-    
-    json_analysis = analysis.metrics_to_json()
+    with emf_metrics.timer('ComputeTime'):
+        analysis = AnalyzeTextract(textract_json=textract_json, size=size)
+        json_analysis = analysis.metrics_to_json()
+    emf_metrics.add('BlockCount', analysis.blocks)
+    emf_metrics.set_document(pages=analysis.pages)
     analytics_outputKey = f"analytics_output_{date}/{timestamp}_{file_name}_analytics.json"
     
     logger.info("Finished Analyzing")
     logger.info(f"Writing to {analytics_outputKey}")
-    s3.put_object(Body=json_analysis, Bucket=s3_bucket, Key=analytics_outputKey)
+    s3_io.upload(s3, s3_bucket, analytics_outputKey, json_analysis)
     
     textract_result["TextractAnalyticsOutputPath"] = f"s3://{s3_bucket}/{analytics_outputKey}"
         
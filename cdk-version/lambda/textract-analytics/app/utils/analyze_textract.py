@@ -1,6 +1,3 @@
-import numpy as np
-import trp.trp2 as t2
-import trp
 import json
 import os 
 import logging
@@ -9,6 +6,8 @@ import math
 logger = logging.getLogger(__name__)
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
+        # only objects json cannot encode get here, numpy is not loaded for the metrics
+        import numpy as np
         if isinstance(obj, np.integer):
             return int(obj)
         if isinstance(obj, np.floating):
@@ -18,22 +17,45 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
     
 def sum_list(num_list):
-    a = np.array(num_list)
-    return np.sum(a)
+    return sum(num_list)
 
 def get_res_byte_size(textractRes):
-    json_string = json.dumps(textractRes)
-    bytes_ = json_string.encode("utf-8")
-    return len(bytes_)
+    """
+    Length of json.dumps(textractRes) in bytes, counted block by block so the
+    whole document is never serialised into one string.
+    """
+    members = []
+    for key, value in textractRes.items():
+        if key == 'Blocks' and isinstance(value, list):
+            blocks = [len(json.dumps(block)) for block in value]
+            value_size = 2 + sum(blocks) + 2 * max(len(blocks) - 1, 0)
+        else:
+            value_size = len(json.dumps(value))
+        members.append(len(json.dumps(key)) + 2 + value_size)
+    return 2 + sum(members) + 2 * max(len(members) - 1, 0)
 
 class AnalyzeTextract:
-    def __init__(self, textract_json):
+    """
+    Document metrics computed in a single pass over the Blocks.
+
+    The pass builds an index of the WORD blocks (id -> text length) and per
+    page counters of blocks, LINEs, TABLEs and KEY fields, keyed by the Page of
+    each block. Words and characters of the LINEs are resolved against the
+    index afterwards, because Textract lists a LINE before its WORDs. The
+    numbers are the same the trp based implementation reported, without
+    building a trp.Document.
+
+    Blocks may be any iterable of blocks, e.g. rows of the block store. When
+    size is not given it is the length of json.dumps(textract_json).
+
+    Without textract_json the blocks are fed one at a time with add() and the
+    metrics are computed by finish(), e.g. while a document is being merged.
+    """
+    def __init__(self, textract_json=None, size=None):
         log_level = os.environ.get('LOG_LEVEL', 'DEBUG')    
         
         logger.setLevel(log_level)
         self.ocr_output = textract_json
-        self.t_document = t2.TDocumentSchema().load(self.ocr_output)
-        self.trp_doc = trp.Document(t2.TDocumentSchema().dump(self.t_document))
         self.blocks = 0
         self.characters = 0
         self.words = 0
@@ -43,41 +65,63 @@ class AnalyzeTextract:
         self.pages = 0
         self.size = 0
         self.paginator = 0
-    
-        num_lines = []
-        num_tables = []
-        num_words = []
-        num_char = []
-        num_form_fields = []
-        num_blocks = []
-        
-        for page in self.trp_doc.pages:
-            lines = list(page.lines)
-            words = [word for line in lines for word in line.words]
-            char = [char for word in words for char in word.text]
 
-            num_char.append(len(char))
-            num_words.append(len(words))
-            num_lines.append(len(lines))
-            num_blocks.append(len(page.blocks))
+        self._word_lengths = {}
+        self._line_children = []
+        self._page_numbers = []
+        self._num_blocks = {}
+        self._num_lines = {}
+        self._num_tables = {}
+        self._num_form_fields = {}
+        self._current_page = None
+
+        if textract_json is not None:
+            for block in textract_json.get('Blocks', []):
+                self.add(block)
+            self.finish(size=size if size is not None else get_res_byte_size(self.ocr_output))
+
+    def add(self, block):
+        block_type = block.get('BlockType')
+        if block_type == 'PAGE':
+            self._current_page = block.get('Page', len(self._page_numbers) + 1)
+            self._page_numbers.append(self._current_page)
+        page = block.get('Page', self._current_page)
+        self._num_blocks[page] = self._num_blocks.get(page, 0) + 1
+
+        if block_type == 'WORD':
+            self._word_lengths[block['Id']] = len(block.get('Text') or '')
+        elif block_type == 'LINE':
+            self._num_lines[page] = self._num_lines.get(page, 0) + 1
+            for relationship in block.get('Relationships') or []:
+                if relationship['Type'] == 'CHILD':
+                    self._line_children.append((page, relationship['Ids']))
+        elif block_type == 'TABLE':
+            self._num_tables[page] = self._num_tables.get(page, 0) + 1
+        elif block_type == 'KEY_VALUE_SET' and 'KEY' in block.get('EntityTypes', []):
+            # trp only keeps fields that have a CHILD relationship for the key
+            if any(relationship['Type'] == 'CHILD' for relationship in block.get('Relationships') or []):
+                self._num_form_fields[page] = self._num_form_fields.get(page, 0) + 1
+
+    def finish(self, size=0):
+        num_words = {}
+        num_char = {}
+        for page, child_ids in self._line_children:
+            for child_id in child_ids:
+                if child_id in self._word_lengths:
+                    num_words[page] = num_words.get(page, 0) + 1
+                    num_char[page] = num_char.get(page, 0) + self._word_lengths[child_id]
 
-            if hasattr(page, "tables"):
-                num_tables.append(len(page.tables))
-            else:
-                num_tables = [0]
-            if hasattr(page, "form"):
-                num_form_fields.append(len(page.form.fields))
-            else:
-                num_form_fields = [0]
+        def per_page(counter):
+            return [counter.get(page, 0) for page in self._page_numbers]
 
-        self.blocks = sum_list(num_blocks)
-        self.characters = sum_list(num_char)
-        self.words = sum_list(num_words)
-        self.lines = sum_list(num_lines)
-        self.tables = sum_list(num_tables)
-        self.forms = sum_list(num_form_fields)
-        self.pages = len(self.trp_doc.pages)
-        self.size = get_res_byte_size(self.ocr_output)
+        self.blocks = sum_list(per_page(self._num_blocks))
+        self.characters = sum_list(per_page(num_char))
+        self.words = sum_list(per_page(num_words))
+        self.lines = sum_list(per_page(self._num_lines))
+        self.tables = sum_list(per_page(self._num_tables))
+        self.forms = sum_list(per_page(self._num_form_fields))
+        self.pages = len(self._page_numbers)
+        self.size = size
         self.paginator = math.ceil((self.blocks/1000))
     def metrics_to_json(self):
         
@@ -94,4 +138,4 @@ class AnalyzeTextract:
         }
 
         logger.info(json.dumps(json_res, cls=NpEncoder))
-        return json.dumps(json_res, cls=NpEncoder)                                   
\ No newline at end of file
+        return json.dumps(json_res, cls=NpEncoder)
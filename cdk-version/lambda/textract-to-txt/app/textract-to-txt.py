@@ -1,59 +1,28 @@
 
-from typing import Tuple
 import os 
 import logging
 import json
 import datetime
 
 from utils.format_ocr_text import FormatOCR
-import boto3
-s3 = boto3.client('s3')
+from utils.block_store import iter_block_store
+import emf_metrics
+import s3_io
+import profiling
+s3 = emf_metrics.instrument_s3(s3_io.client())
 
 
 logger = logging.getLogger(__name__)
 log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
 s3_txt_output_prefix = os.environ.get('OUTPUT_PREFIX')
+# number of processes used to lay out the pages, 0 uses one per available vCPU
+format_workers = int(os.environ.get('FORMAT_WORKERS', 0))
 logger.setLevel(log_level)
 
 version = "0.0.1"
 
-def split_s3_path_to_bucket_and_key(s3_path: str) -> Tuple[str, str]:
-    if len(s3_path) <= 7 or not s3_path.lower().startswith("s3://"):
-        raise ValueError(
-            f"s3_path: {s3_path} is no s3_path in the form of s3://bucket/key."
-        )
-    s3_bucket, s3_key = s3_path.replace("s3://", "").split("/", 1)
-    return (s3_bucket, s3_key)
-        
-
-def get_file_from_s3(s3_path: str, range=None) -> bytes:
-    """
-    Retrieves a file from S3.
-
-    Args:
-        s3_path (str): The path of the file in S3.
-        range (str, optional): The range of bytes to retrieve from the file. Defaults to None.
-
-    Returns:
-        bytes: The content of the file.
-
-    Raises:
-        Exception: If there is an error retrieving the file.
-
-    Examples:
-        >>> get_file_from_s3('s3://my-bucket/my-file.txt')
-        b'File content'
-        
-        >>> get_file_from_s3('s3://my-bucket/my-file.txt', 'bytes=0-100')
-        b'Partial file content'
-    """
-    s3_bucket, s3_key = split_s3_path_to_bucket_and_key(s3_path)
-    if range:
-        o = s3.get_object(Bucket=s3_bucket, Key=s3_key, Range=range)
-    else:
-        o = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-    return o.get('Body').read()
-
+@profiling.profile_handler('textract-to-txt')
+@emf_metrics.emit_metrics('textract-to-txt')
 def lambda_handler(event, _):
     logger.setLevel('INFO')
     logger.info(f"version: {version}")
@@ -67,22 +36,32 @@ def lambda_handler(event, _):
     else:
         textract_result = event.get("textract_result")
     
-    logger.info(f"Get Textract JSON {textract_result.get('TextractOutputJsonPath')}")
-    textract_s3_byte = get_file_from_s3(textract_result.get('TextractOutputJsonPath'))
-    s3_bucket, s3_key = split_s3_path_to_bucket_and_key(textract_result.get('TextractOutputJsonPath'))
+    emf_metrics.set_document(**emf_metrics.document_from_event(event))
+    s3_bucket, s3_key = s3_io.split_s3_path_to_bucket_and_key(textract_result.get('TextractOutputJsonPath'))
     file_name = s3_key.split('/')[-1].split('.')[0]    
-    logger.info("Reading the JSON")
-    
-    textract_json = json.loads(textract_s3_byte)
+    if textract_result.get('TextractBlockStorePath'):
+        # only the PAGE and LINE blocks are needed for the text layout
+        logger.info(f"Get Textract blocks {textract_result.get('TextractBlockStorePath')}")
+        with emf_metrics.timer('ParseTime'):
+            textract_json = {'Blocks': list(iter_block_store(s3, textract_result.get('TextractBlockStorePath'),
+                                                             block_types=['PAGE', 'LINE']))}
+    else:
+        logger.info(f"Get Textract JSON {textract_result.get('TextractOutputJsonPath')}")
+        textract_s3_byte = s3_io.read_s3_path(s3, textract_result.get('TextractOutputJsonPath'))
+        logger.info("Reading the JSON")
+        with emf_metrics.timer('ParseTime'):
+            textract_json = json.loads(textract_s3_byte)
+    emf_metrics.add('BlockCount', len(textract_json.get('Blocks', [])))
+    emf_metrics.set_document(pages=(textract_json.get('DocumentMetadata') or {}).get('Pages'))
     
     logger.info("Formatting OCR")
-    formatter = FormatOCR(j=textract_json)
-    
-    full_text, lines = formatter.json_to_text()
+    with emf_metrics.timer('ComputeTime'):
+        formatter = FormatOCR(j=textract_json, workers=format_workers)
+        full_text, lines = formatter.json_to_text()
     txt_outputKey = f"{s3_txt_output_prefix}/{timestamp}_{file_name}_txt.txt"
     
     logger.info(f"Writing to {txt_outputKey}")
-    s3.put_object(Body=full_text, Bucket=s3_bucket, Key=txt_outputKey)
+    s3_io.upload(s3, s3_bucket, txt_outputKey, full_text)
    
     textract_result["TextractOutputTextPath"] = f"s3://{s3_bucket}/{txt_outputKey}"
     
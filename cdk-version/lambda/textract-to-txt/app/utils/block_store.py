@@ -0,0 +1,45 @@
+import json
+import logging
+from typing import Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def read_block_store_index(s3_client, index_s3_path: str) -> dict:
+    s3_bucket, s3_key = index_s3_path.replace("s3://", "").split("/", 1)
+    o = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+    return json.loads(o.get('Body').read())
+
+
+def iter_block_store(s3_client, index_s3_path: str, block_types: Optional[Iterable[str]] = None,
+                     pages: Optional[Iterable[int]] = None) -> Iterator[dict]:
+    """
+    Yields the compact blocks of the given block types (all without
+    block_types) from the block store written by async_to_json (see
+    TextractBlockStorePath), grouped by block type. Without pages the
+    whole NDJSON object of each block type is streamed line by line, with pages
+    only the byte ranges of those pages are fetched.
+    """
+    s3_bucket = index_s3_path.replace("s3://", "").split("/", 1)[0]
+    index = read_block_store_index(s3_client, index_s3_path)
+    wanted_pages = {str(page) for page in pages} if pages is not None else None
+    for block_type in (block_types if block_types is not None else index['BlockTypes']):
+        entry = index['BlockTypes'].get(block_type)
+        if not entry:
+            continue
+        if wanted_pages is None:
+            body = s3_client.get_object(Bucket=s3_bucket, Key=entry['Key'])['Body']
+            for line in body.iter_lines():
+                if line:
+                    yield json.loads(line)
+            continue
+        for page, (start, end, _) in sorted(entry['Pages'].items(), key=lambda item: int(item[0])):
+            if page not in wanted_pages:
+                continue
+            body = s3_client.get_object(Bucket=s3_bucket, Key=entry['Key'], Range=f"bytes={start}-{end - 1}")['Body']
+            for line in body.iter_lines():
+                if line:
+                    block = json.loads(line)
+                    # a range only holds rows of other pages if Textract interleaved them
+                    if str(block.get('Page')) == page:
+                        yield block
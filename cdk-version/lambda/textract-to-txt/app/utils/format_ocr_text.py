@@ -1,16 +1,197 @@
 import os
 import logging
+import multiprocessing
 from statistics import median
 import math
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
+MIN_Y_THRESHOLD = 0.01
+# below this many lines forking workers costs more than it saves
+PARALLEL_MIN_LINES = 5000
+
+
+def skew_angle_for_page(page):
+    """Skew angle of a page from the first edge of its PAGE block polygon, 0 if unknown."""
+    if not page:
+        return 0.0
+    polygon = page.get('Geometry', {}).get('Polygon') or []
+    if len(polygon) < 2:
+        return 0.0
+    p1, p2 = polygon[:2]
+    if p1['X'] == p2['X']:
+        return 0.0
+    return math.atan((p1['Y'] - p2['Y']) / (p1['X'] - p2['X']))
+
+
+def _median_per_page(values, value_pages, number_of_pages):
+    """Median of the values of every page, NaN for pages without values."""
+    medians = np.full(number_of_pages, np.nan)
+    if not values.size:
+        return medians
+    order = np.lexsort((values, value_pages))
+    values = values[order]
+    counts = np.bincount(value_pages, minlength=number_of_pages)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    has_values = counts > 0
+    lower = starts + (counts - 1) // 2
+    upper = starts + counts // 2
+    medians[has_values] = (values[lower[has_values]] + values[upper[has_values]]) / 2
+    return medians
+
+
+def _layout(lines_per_page, page_blocks):
+    """
+    Lays out the LINE blocks of a sequence of pages in reading order.
+
+    lines_per_page holds the LINE blocks of every page in output order,
+    page_blocks the matching PAGE block (or None). Top/Left of all lines are
+    pulled into arrays once; every page is deskewed with the angle of its own
+    PAGE block and sorted by the adjusted Top. Lines whose Top is within the
+    median line spacing of their page from the first line of a group go on the
+    same output row, ordered by Left. Each line is followed by a tab and each
+    row by a newline.
+
+    Returns the text and the indexes of the lines, counted over all pages, in
+    Top order page by page.
+    """
+    lines = [line for page_lines in lines_per_page for line in page_lines]
+    if not lines:
+        return '', []
+
+    number_of_pages = len(lines_per_page)
+    boxes = [line['Geometry']['BoundingBox'] for line in lines]
+    tops = np.fromiter((box['Top'] for box in boxes), dtype=np.float64, count=len(boxes))
+    lefts = np.fromiter((box['Left'] for box in boxes), dtype=np.float64, count=len(boxes))
+    pages = np.repeat(np.arange(number_of_pages), [len(page_lines) for page_lines in lines_per_page])
+
+    # Deskew every page with its own angle, then sort by page and adjusted Top
+    tan_skew = np.array([math.tan(skew_angle_for_page(page)) for page in page_blocks])
+    tops = tops - lefts * tan_skew[pages]
+    order = np.lexsort((tops, pages))
+    sorted_tops = tops[order]
+    sorted_pages = pages[order]
+
+    # The median difference between consecutive lines of a page is its Y threshold
+    same_page = sorted_pages[1:] == sorted_pages[:-1]
+    diffs = np.diff(sorted_tops)[same_page]
+    y_thresholds = _median_per_page(diffs, sorted_pages[1:][same_page], number_of_pages)
+    y_thresholds[~(y_thresholds > MIN_Y_THRESHOLD)] = MIN_Y_THRESHOLD
+
+    # A group starts at its first line and takes every following line of the
+    # page that is less than the threshold below it
+    group_ids = []
+    group = -1
+    anchor_top = anchor_page = None
+    thresholds = y_thresholds.tolist()
+    for top, page in zip(sorted_tops.tolist(), sorted_pages.tolist()):
+        if page != anchor_page or abs(top - anchor_top) >= thresholds[page]:
+            group += 1
+            anchor_top, anchor_page = top, page
+        group_ids.append(group)
+    group_ids = np.array(group_ids)
+
+    # Order by group, then by Left within the group, stable for equal Left
+    reading_order = order[np.lexsort((lefts[order], group_ids))]
+    row_starts = np.flatnonzero(np.diff(group_ids, prepend=-1)).tolist()
+    row_ends = row_starts[1:] + [len(reading_order)]
+
+    texts = [lines[i].get('Text', '') for i in reading_order.tolist()]
+    rows = ['\t'.join(texts[row_start:row_end]) + '\t\n' for row_start, row_end in zip(row_starts, row_ends)]
+
+    return ''.join(rows), order.tolist()
+
+
+def lines_to_text(lines_per_page, page_blocks):
+    """
+    Lays out the LINE blocks of a sequence of pages in reading order, see _layout.
+
+    Returns the text and the lines in Top order, page by page.
+    """
+    lines = [line for page_lines in lines_per_page for line in page_lines]
+    text, order = _layout(lines_per_page, page_blocks)
+    return text, [lines[i] for i in order]
+
+
+def _layout_worker(connection, lines_per_page, page_blocks):
+    try:
+        connection.send(_layout(lines_per_page, page_blocks))
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+
+def split_pages(lines_per_page, number_of_chunks):
+    """Splits the pages into contiguous chunks with about the same number of lines."""
+    total = sum(len(page_lines) for page_lines in lines_per_page)
+    bounds = [0]
+    seen = 0
+    for index, page_lines in enumerate(lines_per_page[:-1]):
+        seen += len(page_lines)
+        if len(bounds) < number_of_chunks and seen >= total * len(bounds) / number_of_chunks:
+            bounds.append(index + 1)
+    bounds.append(len(lines_per_page))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def lines_to_text_parallel(lines_per_page, page_blocks, workers):
+    """
+    Same result as lines_to_text, with the pages split into contiguous chunks
+    that are laid out in forked worker processes and stitched back together in
+    page order. Pages are laid out independently, so the output is identical.
+
+    Lambda has no /dev/shm, so multiprocessing.Pool and ProcessPoolExecutor do
+    not work there; plain Processes returning their result through a Pipe do.
+    The forked workers inherit the blocks, only the results are pickled.
+    """
+    context = multiprocessing.get_context('fork')
+    running = []
+    for start, end in split_pages(lines_per_page, min(workers, len(lines_per_page))):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_layout_worker,
+                                  args=(sender, lines_per_page[start:end], page_blocks[start:end]))
+        process.start()
+        sender.close()
+        running.append((process, receiver, start, end))
+
+    texts = []
+    sorted_lines = []
+    try:
+        for process, receiver, start, end in running:
+            try:
+                result = receiver.recv()
+            except EOFError:
+                raise RuntimeError(f"text formatting worker for pages {start}-{end} exited with {process.exitcode}")
+            if isinstance(result, Exception):
+                raise result
+            text, order = result
+            chunk_lines = [line for page_lines in lines_per_page[start:end] for line in page_lines]
+            texts.append(text)
+            sorted_lines.extend(chunk_lines[i] for i in order)
+    finally:
+        for process, receiver, _, _ in running:
+            receiver.close()
+            process.join()
+    return ''.join(texts), sorted_lines
+
+
+def available_workers() -> int:
+    """Number of vCPUs this process may run on, which scales with the Lambda memory size."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 class FormatOCR:
-    def __init__(self, j):
+    def __init__(self, j, workers=1):
         log_level = os.environ.get('LOG_LEVEL', 'DEBUG')    
         logger.setLevel(log_level)
         self.ocr_output = j
         self.Blocks = j.get('Blocks', [])
+        self.workers = max(1, workers or available_workers())
     
     def json_to_tables(self):        
         return [block for block in self.Blocks if block.get('BlockType') in ['TABLE', 'CELL','TABLE_TITLE']]
@@ -18,7 +199,46 @@ class FormatOCR:
     def json_to_forms(self):        
         return [block for block in self.Blocks if block.get('BlockType') == 'KEY_VALUE_SET']        
 
+    def lines_by_page(self):
+        """Returns ({page number: [LINE blocks]}, {page number: PAGE block})."""
+        lines = {}
+        pages = {}
+        for block in self.Blocks:
+            block_type = block.get('BlockType')
+            if block_type == 'LINE':
+                lines.setdefault(block.get('Page', 1), []).append(block)
+            elif block_type == 'PAGE':
+                pages.setdefault(block.get('Page', 1), block)
+        return lines, pages
+
     def json_to_text(self):
+        """
+        Text of the whole document, each page laid out on its own with the skew
+        of its own PAGE block, pages in page order.
+
+        With more than one worker, documents of several pages and at least
+        PARALLEL_MIN_LINES lines are laid out in parallel, with the same result.
+
+        Returns the text and the LINE blocks in Top order, page by page.
+        """
+        lines, pages = self.lines_by_page()
+        page_numbers = sorted(lines)
+        lines_per_page = [lines[page_number] for page_number in page_numbers]
+        page_blocks = [pages.get(page_number) for page_number in page_numbers]
+        number_of_lines = sum(len(page_lines) for page_lines in lines_per_page)
+        if self.workers > 1 and len(page_numbers) > 1 and number_of_lines >= PARALLEL_MIN_LINES:
+            logger.info(f"formatting {len(page_numbers)} pages with {self.workers} workers")
+            text, sorted_lines = lines_to_text_parallel(lines_per_page, page_blocks, self.workers)
+        else:
+            text, sorted_lines = lines_to_text(lines_per_page, page_blocks)
+        return text.strip(), sorted_lines
+
+    def json_to_text_legacy(self):
+        """
+        The original pure Python layout, which deskews every page with the angle
+        of the first PAGE block and sorts the lines of all pages together.
+        Kept as the reference for benchmarks; it modifies the LINE blocks in place.
+        """
         y_threshold = 0.01
         blocks = self.ocr_output.get('Blocks', [])
 
@@ -47,7 +267,7 @@ class FormatOCR:
         # default y_threshold if it is less than or equal to 0.01
         if y_threshold <= 0.01:
             y_threshold = 0.01
-      
+
         # Group lines with similar Y positions together
         line_groups = []
         current_group = [sorted_lines[0]]
@@ -70,4 +290,4 @@ class FormatOCR:
                 text += line.get('Text', '') + '\t'
             text += '\n'  # start a new line for the next group
 
-        return text.strip(), sorted_lines
\ No newline at end of file
+        return text.strip(), sorted_lines
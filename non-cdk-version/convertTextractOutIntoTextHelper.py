@@ -3,9 +3,14 @@ import boto3
 import json
 import time
 import threading
+import itertools
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from botocore.config import Config
 from pynamodb.models import Model
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from textractFeeder import S3Profile
 
 
 logger = logging.getLogger(__name__)
@@ -16,99 +21,289 @@ dynamoDBMaxlistCount = 200 #  Max number of rows to pull at a time from DynamoDB
 
 _tracking_table = "s3ObjectNamesforTextract" # name of DynamoDB table used to track objects that have been sent to Textract
 _textractFolder = "textract_output/" # name of folder that Textract created when it wrote results out to S3
+_completion_queue_url = "" # Optional, SQS queue subscribed to the Textract completion topic of the feeder, next to the queue of the feeder, converts each job as it completes
+_sqs_endpoint_url = "" # Optional, endpoint of a local SQS stand-in (ElasticMQ, LocalStack) for testing
 
-threadCountforTextExtract = 50 # Number of threads used to call Textract
+threadCountforTextExtract = 50 # Number of threads converting Textract output into text
+partReadAhead = 4 # Textract output parts of a document downloaded ahead of the one being parsed
+multipartPartSize = 8 * 1024 * 1024 # Text written as a multipart upload part at a time, at least 5 MiB
+completionQueueIdleSeconds = 300 # consumeTextractCompletions run on its own stops once the queue has been empty this long
+notificationRetrySeconds = 10 # A completion that arrives before the feeder stored its job is received again after this
+notificationMaxReceives = 10 # A completion whose job never shows up in the table is dropped after this many receives
 
-def orchestrateTextExtraction():
+"""Feeds the rows that are ready for text extraction from the DynamoDB scan to a pool of worker threads"""
+def orchestrateTextExtraction(threadCount=threadCountforTextExtract, shardIndex=0, shardCount=1):
     print("Convert JSON from Textract into blobs of Text and save to S3")
-    totalDocs = 0
+    stats = TextExtractionStats()
+    """rows read ahead of the workers, the scan waits when they are all taken"""
+    rowSlots = threading.BoundedSemaphore(2 * threadCount)
     try:
-        while True:
-            txtThreads = []
-            threadCounter = 0
-            objRows = DocumentObjStatusModel.scan(DocumentObjStatusModel.outputTextObjName.does_not_exist(), limit=dynamoDBMaxlistCount)
-            exitLoop = True
-            for objRow in objRows:
-                exitLoop = False
-                if (len(objRow.outputTextObjName)==0 and len(objRow.txJobId) > 2):
-                    txtThreads.append(threading.Thread(name="Thread - " + str(threadCounter), target=extractText, args=(objRow, create_s3_client(),)))
-                    threadCounter+=1
-                    totalDocs+=1
-                    if threadCounter == threadCountforTextExtract:
-                        for thread in txtThreads:
-                            thread.start()
-                        for thread in txtThreads:
-                            thread.join()
-                        threadCounter = 0
-                        txtThreads.clear()
-
-            if len(txtThreads) > 0:
-                for thread in txtThreads:
-                    thread.start()
-                for thread in txtThreads:
-                    thread.join()
-            
-            if exitLoop: 
-                print (f"Total text documents created {totalDocs}")
-                break
+        with ThreadPoolExecutor(max_workers=threadCount) as executor:
+            while True:
+                """the rows done in a pass get an outputTextObjName, the next pass picks up rows whose jobs finished since"""
+                submitted = 0
+                """only rows whose Textract job succeeded, rows from before the workState of the feeder have none"""
+                jobSucceeded = DocumentObjStatusModel.workState.does_not_exist() | (DocumentObjStatusModel.workState == "SUCCEEDED")
+                objRows = DocumentObjStatusModel.scan(DocumentObjStatusModel.outputTextObjName.does_not_exist() & jobSucceeded, page_size=dynamoDBMaxlistCount)
+                for objRow in objRows:
+                    """a shard of the runner processes converts the rows it sent to Textract"""
+                    if (len(objRow.outputTextObjName)==0 and len(objRow.txJobId) > 2 and inShard(objRow.objectName, shardIndex, shardCount)):
+                        rowSlots.acquire()
+                        executor.submit(timedExtractText, objRow, stats).add_done_callback(lambda _: rowSlots.release())
+                        submitted+=1
+                """wait for the pass to finish before scanning again"""
+                for _ in range(2 * threadCount):
+                    rowSlots.acquire()
+                for _ in range(2 * threadCount):
+                    rowSlots.release()
+                if submitted == 0:
+                    break
 
     except Exception as e:
         logger.error(e)
         print ("Unable to run script")
 
+    stats.report()
+    return stats.summary()
+
+
+"""the shard of the runner processes a row belongs to, the same as in textractFeeder"""
+def inShard(objectName, shardIndex, shardCount):
+    return shardCount == 1 or zlib.crc32(objectName.encode('utf-8')) % shardCount == shardIndex
+
+
+"""Converts the output of every Textract job as soon as its completion notification arrives (SNS topic -> SQS queue).
+Given a stopped event it runs until the event is set and a full long poll after that came back empty, the notifications
+can lag behind the feed. Without one it stops once the queue stayed empty for idleSeconds"""
+def consumeTextractCompletions(queueUrl=None, threadCount=threadCountforTextExtract, stopped=None, idleSeconds=completionQueueIdleSeconds):
+    print("Convert the output of Textract jobs into text as the jobs complete")
+    queueUrl = queueUrl or _completion_queue_url
+    sqs = create_sqs_client()
+    stats = TextExtractionStats()
+    """messages received ahead of the workers, a receive only asks for as many as there are free slots"""
+    messageSlots = threading.BoundedSemaphore(2 * threadCount)
+    deletes = []
+    deletesLock = threading.Lock()
+
+    def finished(message, future):
+        try:
+            if future.result():
+                with deletesLock:
+                    deletes.append(message['ReceiptHandle'])
+        except Exception as e:
+            logger.error(e)
+        finally:
+            messageSlots.release()
+
+    def flushDeletes():
+        with deletesLock:
+            receiptHandles = deletes[:]
+            deletes.clear()
+        for start in range(0, len(receiptHandles), 10):
+            sqs.delete_message_batch(QueueUrl=queueUrl, Entries=[{'Id': str(i), 'ReceiptHandle': receiptHandle} for i, receiptHandle in enumerate(receiptHandles[start:start + 10])])
+
+    lastMessage = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threadCount) as executor:
+        while True:
+            flushDeletes()
+            messageSlots.acquire()
+            freeSlots = 1
+            while freeSlots < 10 and messageSlots.acquire(blocking=False):
+                freeSlots += 1
+            stopping = stopped is not None and stopped.is_set()
+            messages = []
+            try:
+                messages = sqs.receive_message(QueueUrl=queueUrl, MaxNumberOfMessages=freeSlots, WaitTimeSeconds=20,
+                                               AttributeNames=['ApproximateReceiveCount']).get('Messages', [])
+            finally:
+                for _ in range(freeSlots - len(messages)):
+                    messageSlots.release()
+            if messages:
+                lastMessage = time.monotonic()
+            elif stopping or (stopped is None and idleSeconds is not None and time.monotonic() - lastMessage >= idleSeconds):
+                """the feed may go without a completion for longer than idleSeconds, only the stopped event ends it then"""
+                break
+            for message in messages:
+                executor.submit(convertCompletedJob, message, stats, sqs, queueUrl).add_done_callback(lambda future, message=message: finished(message, future))
+    flushDeletes()
+
+    stats.report()
+    return stats.summary()
+
+
+"""Converts the job of a completion notification, returns True once the message can be deleted"""
+def convertCompletedJob(message, stats, sqs, queueUrl):
+    body = json.loads(message['Body'])
+    """SNS wraps the Textract notification in its own envelope unless raw message delivery is on"""
+    notification = json.loads(body['Message']) if 'Message' in body else body
+    if notification['Status'] not in ('SUCCEEDED', 'PARTIAL_SUCCESS'):
+        """the feeder retries failed jobs, their new job sends its own notification"""
+        return True
+    try:
+        objRow = DocumentObjStatusModel.get(notification['DocumentLocation']['S3ObjectName'])
+    except DocumentObjStatusModel.DoesNotExist:
+        return True
+    if objRow.txJobId != notification['JobId']:
+        """the notification overtook the feeder storing the job, or belongs to an older job of the row"""
+        if int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)) >= notificationMaxReceives:
+            return True
+        sqs.change_message_visibility(QueueUrl=queueUrl, ReceiptHandle=message['ReceiptHandle'], VisibilityTimeout=notificationRetrySeconds)
+        return False
+    if not objRow.outputTextObjName:
+        timedExtractText(objRow, stats)
+    return True
+
+
+def timedExtractText(objRow, stats):
+    started = time.perf_counter()
+    try:
+        extractText(objRow, s3_client)
+    finally:
+        stats.add(time.perf_counter() - started, objRow.outputTextObjName != "-1")
+
+
+"""Per document latency and throughput of a run"""
+class TextExtractionStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.latencies = []
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, latency, succeeded):
+        with self._lock:
+            self.latencies.append(latency)
+            if not succeeded:
+                self.failed += 1
+
+    def summary(self):
+        with self._lock:
+            return {'documents': len(self.latencies) - self.failed, 'failed': self.failed,
+                    'seconds': time.perf_counter() - self.started, 'latencies': sorted(self.latencies)}
 
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        latencies = sorted(self.latencies)
+        print(f"Total text documents created {len(latencies) - self.failed}, failed {self.failed}")
+        if not latencies:
+            return
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+        print(f"Throughput {len(latencies) / elapsed:.2f} documents/s over {elapsed:.1f} s")
+        print(f"Latency per document p50 {percentile(0.5):.3f} s, p90 {percentile(0.9):.3f} s, p99 {percentile(0.99):.3f} s, max {latencies[-1]:.3f} s")
+
+
+"""Converts the numbered Textract output parts of a job into one text object, a part at a time"""
 def extractText(objRow, s3):
     
     outPutFolder = _textractFolder + objRow.txJobId
-    outPutTextObjName = outPutFolder
-    objRow.outputTextObjName = outPutTextObjName
+    objRow.outputTextObjName = outPutFolder
+    outPutTextObjName = outPutFolder + "/" + objRow.objectName + ".txt"
 
-    txJSONoutputFiles = []
-    s3_profile = S3Profile(objRow.outputbucketName , objRow.outputTextObjName)
+    s3_profile = S3Profile(objRow.outputbucketName , outPutFolder + "/", s3)
+    textWriter = S3TextWriter(s3, objRow.outputbucketName, outPutTextObjName)
     try:
-        for item in s3_profile.profile_object_list:
-            if item['fileObj'].split("/")[-1].isnumeric():
-                txJSONoutputFiles.append(item['fileObj'])
-
-        txJSONoutputFiles.sort()
-        fileText = ""
-        for file in txJSONoutputFiles:
-            jsonContent = json.loads(s3.get_object(Bucket=objRow.outputbucketName, Key=file)['Body'].read().decode('utf-8'))
-            for block in jsonContent["Blocks"]:
-                if block["BlockType"] == "LINE":
-                    fileText += block["Text"] + "\n"    
-
-        objRow.outputTextObjName = objRow.outputTextObjName + "/" + objRow.objectName + ".txt"
+        """parts are numbered 1, 2, ... and have to be read in numeric order"""
+        txJSONoutputFiles = sorted((file for file in s3_profile if file.split("/")[-1].isnumeric()), key=lambda file: int(file.split("/")[-1]))
+
+        for part in fetchPartsInOrder(s3, objRow.outputbucketName, txJSONoutputFiles):
+            jsonContent = json.loads(part)
+            textWriter.write("".join(block["Text"] + "\n" for block in jsonContent["Blocks"] if block["BlockType"] == "LINE"))
+
+        # write the remaining text out to S3
+        textWriter.close()
+        objRow.outputTextObjName = outPutTextObjName
         #print(objRow.outputTextObjName)
     except Exception as e:
-        logger.error(e + "Unable to parse text from JSON " + objRow.objectName)
+        textWriter.abort()
+        logger.error(f"{e} Unable to parse text from JSON {objRow.objectName}")
         print ("Unable to parse text from JSON " + objRow.objectName)      
         objRow.outputTextObjName = "-1"
 
-
-    try:
-        # write fileText content out to S3
-        s3.put_object(
-            Body=fileText, 
-            Bucket=objRow.outputbucketName, 
-            Key=objRow.outputTextObjName
-        )
-    except Exception as e:
-        logger.error(e)
-        print("Unable to write to S3")
-
     
     try:
-        # update DynamoDB table with text file info
-        objRow.save()   
+        # update DynamoDB table with text file info, only the text attribute, the feeder may be updating the row at the same time
+        objRow.update(actions=[DocumentObjStatusModel.outputTextObjName.set(objRow.outputTextObjName)])
     except Exception as e:
         logger.error(e)
         print("Unable to update DynamoDB table")
 
 
+"""yield the bodies of the parts in order, downloading up to readAhead of them at the same time"""
+def fetchPartsInOrder(s3, bucketName, keys, readAhead=partReadAhead):
+    keys = iter(keys)
+    fetch = lambda key: s3.get_object(Bucket=bucketName, Key=key)['Body'].read()
+    pending = deque(partFetchExecutor.submit(fetch, key) for key in itertools.islice(keys, readAhead))
+    while pending:
+        part = pending.popleft().result()
+        for key in itertools.islice(keys, 1):
+            pending.append(partFetchExecutor.submit(fetch, key))
+        yield part
+
 
-def create_s3_client():
-    return boto3.client('s3', config=config)
+"""Writes text to S3 with one put, or as a multipart upload once it is larger than a part"""
+class S3TextWriter:
+    def __init__(self, s3, bucketName, key, partSize=multipartPartSize):
+        self.s3 = s3
+        self.bucketName = bucketName
+        self.key = key
+        self.partSize = partSize
+        self._buffer = []
+        self._buffered = 0
+        self._uploadId = None
+        self._parts = []
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.partSize:
+            self._uploadPart()
+
+    def _uploadPart(self):
+        if self._uploadId is None:
+            self._uploadId = self.s3.create_multipart_upload(Bucket=self.bucketName, Key=self.key)['UploadId']
+        partNumber = len(self._parts) + 1
+        response = self.s3.upload_part(
+            Body="".join(self._buffer).encode('utf-8'),
+            Bucket=self.bucketName,
+            Key=self.key,
+            PartNumber=partNumber,
+            UploadId=self._uploadId
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': partNumber})
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self):
+        if self._uploadId is None:
+            self.s3.put_object(
+                Body="".join(self._buffer), 
+                Bucket=self.bucketName, 
+                Key=self.key
+            )
+            self._buffer = []
+            return
+        if self._buffer:
+            self._uploadPart()
+        self.s3.complete_multipart_upload(Bucket=self.bucketName, Key=self.key, UploadId=self._uploadId, MultipartUpload={'Parts': self._parts})
+        self._uploadId = None
+
+    """drop an unfinished multipart upload, S3 keeps charging for its parts otherwise"""
+    def abort(self):
+        if self._uploadId is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucketName, Key=self.key, UploadId=self._uploadId)
+            except Exception as e:
+                logger.error(e)
+            self._uploadId = None
+
+
+def create_sqs_client():
+    return boto3.client('sqs', config=config, endpoint_url=_sqs_endpoint_url or None)
+
+"""one client shared by all threads, with a connection per thread and part download"""
+s3_client = boto3.client('s3', config=config.merge(Config(max_pool_connections=threadCountforTextExtract * (partReadAhead + 1))))
+"""downloads the parts for all documents being converted"""
+partFetchExecutor = ThreadPoolExecutor(max_workers=threadCountforTextExtract * partReadAhead)
 
 """DynamoDB Class"""
 class DocumentObjStatusModel(Model):
@@ -122,27 +317,17 @@ class DocumentObjStatusModel(Model):
     createDate = NumberAttribute(null=True)
     txJobId = UnicodeAttribute(null=True)
     outputbucketName = UnicodeAttribute(null=True)
+    workState = UnicodeAttribute(null=True)
     outputTextObjName = UnicodeAttribute(null=True, default="")
 
-"""S3 Class for retrieving Object Names"""
-class S3Profile:
-    def __init__(self, bucketName, prefixName):
-        self.bucketName = bucketName
-        self.prefixName = prefixName
-        self.s3_client = boto3.client('s3')
-        self.profile_object_list = []
-        paginator = self.s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=self.bucketName, Prefix=self.prefixName)
-        for page in pages:
-            for content in page.get('Contents'):
-                file = content.get('Key')
-                self.profile_object_list.append({"fileObj": file})
-
 """Main entry point into script --- Start Here"""
 if __name__ == "__main__":   
     now = time.perf_counter()
     print("started")   
     
-    orchestrateTextExtraction()
+    if _completion_queue_url:
+        consumeTextractCompletions()
+    else:
+        orchestrateTextExtraction()
     
     print(f"completed in - {time.perf_counter()-now} seconds")
\ No newline at end of file
@@ -1,146 +1,635 @@
 import logging
+import os
+import random
 import boto3
 import time
 from boto3.dynamodb.types import TypeDeserializer
 from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
 from pynamodb.models import Model
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from pynamodb.indexes import GlobalSecondaryIndex, IncludeProjection
 import threading
-from threading import Lock
+import queue
+import itertools
+import json
+import zlib
+import hashlib
+import socket
+import string
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import deque, OrderedDict, Counter
 
 logger = logging.getLogger(__name__)
 
 config = Config(retries = {'max_attempts': 10,'mode': 'adaptive'})
+"""no botocore retries for the Textract calls, throttling is handled by the TextractRateGovernor and other transient errors by callTextract"""
+textractConfig = Config(retries = {'max_attempts': 1,'mode': 'standard'})
 
 _tracking_table = "s3ObjectNamesforTextract"
 _input_bucket = "mybucket-testfiles-fewer"
 _input_prefix = ""
 _output_bucket = "mybucket-testfiles-fewer-out"
+_sns_topic_arn = "" # Optional, SNS topic Textract notifies on job completion
+_sns_role_arn = "" # Optional, role that allows Textract to publish to the topic
+_completion_queue_url = "" # Optional, SQS queue subscribed to the topic, the job status is polled without it
+_sqs_endpoint_url = "" # Optional, endpoint of a local SQS stand-in (ElasticMQ, LocalStack) for testing
+_ingest_checkpoint_file = "ingest_checkpoint.json" # Progress of fetchAllObjectsInBucketandStoreName, to resume an interrupted run
+_worker_id = socket.gethostname() # Owner of the leases this process takes, give every feeder process on a host its own
 
 threadCountforTextractAPICall = 20 # Number of threads used to call Textract
-dynamoDBMaxlistCount = 200 #  Max number of rows to pull at a time from DynamoDB and store in memory to be processed by threads
+dynamoDBMaxlistCount = 200 #  Max number of rows to pull at a time from DynamoDB by getFilesToSendToTextractfromDynamoDB
+workQueueMaxSize = 400 # Max number of rows read ahead from DynamoDB and held in memory for the threads
+textractMaxTPS = 10 # Max StartDocumentTextDetection calls per second, keep it at or below the account quota
+textractMinTPS = 0.5 # The rate never backs off below this
+metricsIntervalSeconds = 30 # How often the achieved TPS and throttle rate are printed
+textractMaxConcurrentJobs = 100 # Max Textract jobs in flight, keep it at or below the account quota for concurrent async jobs
+jobPollIntervalSeconds = 10 # How often the jobs in flight are polled for their status
+jobPollBatchSize = 50 # Max jobs polled per round, oldest first
+jobPollTPS = 5 # Max GetDocumentTextDetection calls per second for polling
+completionReturnSeconds = 5 # A completion of a job another feeder tracks goes back to the queue, visible again after this
+completionFallbackAgeSeconds = 900 # With a completion queue, jobs in flight this long are polled as well, their completion may never arrive
+completionFallbackIntervalSeconds = 60 # How often the jobs in flight for completionFallbackAgeSeconds are polled
+pendingShardCount = 10 # Number of partitions of the pending work index, spreads its writes and reads
+pendingIndexSettleSeconds = 5 # Wait between passes for the index to catch up with the rows taken out of it
+pendingIndexName = "pendingShard-createDate-index"
+jobsInProgressIndexName = "jobShard-createDate-index"
+ingestWriterCount = 8 # Number of threads writing listed object names to DynamoDB
+ingestListPartitions = 1 # Key ranges of the input prefix listed in parallel, more than 1 lists faster but cannot resume
+leaseSeconds = 300 # How long a claimed row stays with this process before another one may take it over
+jobLeaseSeconds = 3600 # How long the jobs of a process that stopped wait before another process adopts them
+textractMaxAttempts = 3 # Textract jobs started for a file before it is left FAILED
+textractTransientRetries = 4 # Retries of a Textract call that failed with a server or connection error
+
+THROTTLING_ERRORS = {'ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException'}
+TRANSIENT_ERRORS = {'InternalServerError', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout', 'RequestTimeoutException'}
+SUBMITTED, FAILED, THROTTLED, SKIPPED = 'submitted', 'failed', 'throttled', 'skipped'
+JOB_IN_PROGRESS = 'IN_PROGRESS'
+JOB_SUCCEEDED_STATUSES = {'SUCCEEDED', 'PARTIAL_SUCCESS'}
+"""workState of a row: PENDING -> SUBMITTED -> SUCCEEDED or FAILED, a FAILED job goes back to PENDING until textractMaxAttempts"""
+WORK_PENDING, WORK_SUBMITTED, WORK_SUCCEEDED, WORK_FAILED = 'PENDING', 'SUBMITTED', 'SUCCEEDED', 'FAILED'
 
 dbDynoSelect = f"SELECT objectName, bucketName FROM \"{_tracking_table}\" WHERE txJobId=?"
-dbDynoUpdate = f"UPDATE \"{_tracking_table}\" SET txJobId=?, outputbucketName=? WHERE objectName=? AND bucketName=?"
+"""a pending row is claimed with a lease, held rows are only taken over once their lease expired"""
+dbDynoClaim = "SET workState = :pending, leaseOwner = :owner, leaseExpires = :leaseExpires, attempts = if_not_exists(attempts, :zero)"
+dbDynoClaimCondition = "bucketName = :bucketName AND (attribute_not_exists(workState) OR workState = :pending) AND (attribute_not_exists(leaseExpires) OR leaseExpires < :now OR leaseOwner = :owner)"
+"""sets the job of a claimed row and moves it from the sparse pending work index to the sparse index of the jobs in progress"""
+dbDynoUpdateSent = "SET workState = :submitted, txJobId = :txJobId, outputbucketName = :outputbucketName, txJobStatus = :txJobStatus, attempts = attempts + :one, leaseExpires = :leaseExpires, jobShard = :jobShard REMOVE pendingShard"
+dbDynoUpdateStartFailed = "SET attempts = attempts + :one REMOVE leaseOwner, leaseExpires"
+dbDynoUpdateGaveUp = "SET workState = :failed, txJobId = :txJobId, outputbucketName = :outputbucketName, txJobStatus = :txJobStatus, attempts = attempts + :one REMOVE pendingShard, leaseOwner, leaseExpires"
+dbDynoLeaseHeld = "leaseOwner = :owner AND workState = :pending"
+"""the status of a job is only stored while the row still belongs to the job"""
+dbDynoUpdateJobStatus = "SET workState = :workState, txJobStatus = :txJobStatus REMOVE leaseOwner, leaseExpires, jobShard"
+dbDynoUpdateJobRetry = "SET workState = :pending, txJobStatus = :txJobStatus, txJobId = :empty, pendingShard = :pendingShard REMOVE leaseOwner, leaseExpires, jobShard"
+dbDynoAdoptJob = "SET leaseOwner = :owner, leaseExpires = :leaseExpires"
+dbDynoAdoptJobCondition = "txJobId = :txJobId AND (attribute_not_exists(workState) OR workState = :submitted) AND (attribute_not_exists(leaseExpires) OR leaseExpires < :now OR leaseOwner = :owner)"
+dbDynoSelectJobsInProgress = f"SELECT objectName, bucketName, txJobId FROM \"{_tracking_table}\" WHERE txJobStatus=?"
 
 deserializer = TypeDeserializer()
 
-s3_client = boto3.client('s3', config=config)
+s3_client = boto3.client('s3', config=config.merge(Config(max_pool_connections=max(10, ingestListPartitions))))
 ddb = boto3.client('dynamodb', config=config)
-txract = boto3.client('textract', config=config)
+txract = boto3.client('textract', config=textractConfig)
 
-"""Main method that creates the threads and keeps the processing moving along"""
-def orchestrate():
-    
-    totalCount = 0
+"""Main method that starts the workers and keeps the processing moving along"""
+def orchestrate(threadCount=threadCountforTextractAPICall, queueSize=workQueueMaxSize, maxTPS=textractMaxTPS,
+                maxConcurrentJobs=textractMaxConcurrentJobs, waitForJobs=True, shardIndex=0, shardCount=1):
 
-    fileList = FileNameObjectsThreadSafeList()
-    
-    """Fetch max rows from DynamoDB and Initialize in memory list"""
-    results = getFilesToSendToTextractfromDynamoDB()
-    totalCount += len(results)    
+    totalCount = 0
+    started = time.perf_counter()
+
+    """SUBMITTED, FAILED and SKIPPED rows, counted by the workers"""
+    outcomes = Counter()
+    outcomesLock = threading.Lock()
+
+    """bounded queue between the DynamoDB reader and the Textract workers, the reader blocks while it is full"""
+    workQueue = queue.Queue(maxsize=queueSize)
+
+    """one rate governor shared by all workers"""
+    governor = TextractRateGovernor(maxTPS, minTPS=min(textractMinTPS, maxTPS))
+    stopped = threading.Event()
+    metricsThread = threading.Thread(name="Metrics", target=printGovernorMetrics, args=(governor, stopped), daemon=True)
+    metricsThread.start()
+
+    """window of Textract jobs in flight, starting with the jobs earlier runs of this process, or stopped processes, left in progress"""
+    window = TextractJobWindow(maxConcurrentJobs)
+    for record in iterTextractJobsInProgressfromDynamoDB(shardIndex, shardCount):
+        if inShard(record['objectName'], shardIndex, shardCount) and adoptTextractJob(record):
+            window.add(record['txJobId'], record)
+    print(f"{len(window)} Textract jobs in progress")
+    completionThread = threading.Thread(name="Completions", target=consumeTextractCompletions if _completion_queue_url else pollTextractJobs,
+                                        args=(window, stopped), daemon=True)
+    completionThread.start()
+    if _completion_queue_url:
+        """a completion can be dead-lettered before this feeder receives it, or was consumed before a restart, the old jobs are polled so every slot is released"""
+        fallbackThread = threading.Thread(name="CompletionFallback", target=pollTextractJobs,
+                                          args=(window, stopped, completionFallbackIntervalSeconds, completionFallbackAgeSeconds), daemon=True)
+        fallbackThread.start()
+
+    """create and start our long running worker threads for processing Textract"""
+    threadsforTextractAPI = [threading.Thread(name="Thread - " + str(i), target=procestTextractFunction, args=(workQueue, governor, window, outcomes, outcomesLock), daemon=True) for i in range(threadCount)]
+    for thread in threadsforTextractAPI:
+        thread.start()
 
     print("Starting process of sending files to Textract")
 
-    while len(results) > 0:
-        for record in results: # put these records into our thread safe list
-            fileList.append(record)    
-        
-        """create our threads for processing Textract"""
-        threadsforTextractAPI = [threading.Thread(name="Thread - " + str(i), target=procestTextractFunction, args=(fileList,)) for i in range(threadCountforTextractAPICall)]    
-        
-        """start up threads for processing Textract"""
-        for thread in threadsforTextractAPI:
-            thread.start()
-
-        """wait for threads to complete"""
+    try:
+        while True:
+            """page through the pending rows in DynamoDB, staying at most queueSize rows ahead of the workers"""
+            passCount = 0
+            for record in iterFilesToSendToTextractfromDynamoDB(shardIndex, shardCount):
+                workQueue.put(record)
+                passCount += 1
+            totalCount += passCount
+
+            """wait for the queued rows to be processed, then look for rows that became pending in the meantime"""
+            workQueue.join()
+            if passCount == 0:
+                if not waitForJobs or len(window) == 0:
+                    break
+                """wait for the last jobs to finish so their status is in DynamoDB, failed jobs come back as pending rows"""
+                while not window.waitUntilEmpty(metricsIntervalSeconds):
+                    print(f"waiting for {len(window)} Textract jobs in progress")
+            if hasIndex(pendingIndexName):
+                time.sleep(pendingIndexSettleSeconds)
+    finally:
+        """stop the workers"""
+        for _ in threadsforTextractAPI:
+            workQueue.put(None)
         for thread in threadsforTextractAPI:
             thread.join()
+        stopped.set()
 
-        """Get more rows from DynamoDB and repeat until no more rows"""
-        results = getFilesToSendToTextractfromDynamoDB()
-        totalCount += len(results)
-    
     print("Finished sending " + str(totalCount) + " files to Textract")
+    print(f"Textract rate: {governor.metrics()}")
+    return {'rows': totalCount, 'submitted': outcomes[SUBMITTED], 'failed': outcomes[FAILED], 'skipped': outcomes[SKIPPED],
+            'textractCalls': governor.calls, 'throttles': governor.throttles, 'seconds': time.perf_counter() - started}
 
 
 
-"""Method that calls Textract API and stores the Job ID"""
-def procestTextractFunction(fileList):
-    while fileList.length() > 0:
+"""Worker that takes rows off the queue until it gets None"""
+def procestTextractFunction(workQueue, governor, window, outcomes, outcomesLock):
+    while True:
+        record = workQueue.get()
         try:
-            record = fileList.pop()
-            response = txract.start_document_text_detection(
-                DocumentLocation={
-                    'S3Object': {
-                    'Bucket': record['bucketName'],
-                    'Name': record['objectName']
-                }},
-                OutputConfig={
-                    'S3Bucket': _output_bucket
-                }
-            )            
-            
-            """Update the DynamoDB table with the JobId of the Textract call"""
-            ddb.execute_statement(Statement=dbDynoUpdate, Parameters=[{'S': response["JobId"]}, {'S': _output_bucket}, {'S': record['objectName']}, {'S': record['bucketName']}])
-        
+            if record is None:
+                return
+            """a throttled row goes to the back of the queue, if the queue is full this worker retries it"""
+            while (outcome := sendFileToTextract(record, governor, window)) == THROTTLED:
+                try:
+                    workQueue.put_nowait(record)
+                    break
+                except queue.Full:
+                    pass
+            if outcome != THROTTLED:
+                with outcomesLock:
+                    outcomes[outcome] += 1
         except Exception as e:
             logger.error(e)
-            print(e.response)
             print(record)
-            """update the DynamoDB table with a -1 for the JobId and an empty string for the output bucket name Swallow exception and continue, a retry for this file will occur next time row is retrived from DynamoDB"""
-            ddb.execute_statement(Statement=dbDynoUpdate, Parameters=[{'S': '-1'}, {'S': ''}, {'S': record['objectName']}, {'S': record['bucketName']}])
+        finally:
+            workQueue.task_done()
+
+
+"""print the achieved Textract TPS and throttle rate until stopped"""
+def printGovernorMetrics(governor, stopped):
+    while not stopped.wait(metricsIntervalSeconds):
+        print(f"Textract rate: {governor.metrics()}")
+
+
+"""Method that claims a row, calls Textract API and stores the Job ID, returns SUBMITTED, FAILED, THROTTLED or SKIPPED"""
+def sendFileToTextract(record, governor, window):
+    """wait for a free slot in the window of in flight Textract jobs"""
+    window.reserve()
+    claimed = claimFile(record)
+    if claimed is None:
+        """another process holds the row, or is done with it"""
+        window.cancel()
+        return SKIPPED
+    try:
+        governor.acquire()
+        startArguments = {
+            'DocumentLocation': {
+                'S3Object': {
+                'Bucket': record['bucketName'],
+                'Name': record['objectName']
+            }},
+            'OutputConfig': {
+                'S3Bucket': _output_bucket
+            },
+            'ClientRequestToken': clientRequestTokenFor(claimed)
+        }
+        if _sns_topic_arn and _sns_role_arn:
+            startArguments['NotificationChannel'] = {'SNSTopicArn': _sns_topic_arn, 'RoleArn': _sns_role_arn}
+        response = callTextract(txract.start_document_text_detection, **startArguments)
+    
+    except Exception as e:
+        window.cancel()
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') in THROTTLING_ERRORS:
+            """back off and try the file again later instead of marking it failed"""
+            governor.throttled()
+            return THROTTLED
+        logger.error(e)
+        print(getattr(e, 'response', e))
+        print(record)
+        """the row stays pending for another attempt, after textractMaxAttempts it is FAILED with a -1 for the JobId"""
+        updateStartFailed(claimed)
+        return FAILED
 
-"""Enumarete over bucket objects and put into DynamoDB table"""
-def fetchAllObjectsInBucketandStoreName():
+    governor.success()
+
+    """Update the DynamoDB table with the JobId of the Textract call, before the completion of the job can be seen"""
+    try:
+        updateSentFile(claimed, response["JobId"])
+    except ddb.exceptions.ConditionalCheckFailedException:
+        """the lease expired and another process took the row over, with the same request token it got the same job and tracks it"""
+        window.cancel()
+        return SKIPPED
+    except Exception:
+        window.started(response["JobId"], record)
+        raise
+    """a completion that arrives before the job is in the window goes back to the queue and is received again"""
+    window.started(response["JobId"], record)
+    return SUBMITTED
+
+
+"""a server or connection error that is worth retrying, throttling is not one of them"""
+def isTransientError(e):
+    if isinstance(e, (BotoConnectionError, HTTPClientError)):
+        return True
+    if isinstance(e, ClientError):
+        errorCode = e.response.get('Error', {}).get('Code')
+        statusCode = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return errorCode not in THROTTLING_ERRORS and (errorCode in TRANSIENT_ERRORS or statusCode >= 500)
+    return False
+
+
+"""call Textract, retrying transient errors with backoff, throttling errors are raised at once for the governor.
+StartDocumentTextDetection is safe to repeat as the attempt of a file always sends the same ClientRequestToken"""
+def callTextract(method, **arguments):
+    attempt = 0
+    while True:
+        try:
+            return method(**arguments)
+        except Exception as e:
+            if attempt >= textractTransientRetries or not isTransientError(e):
+                raise
+            logger.warning(f"retrying {method.__name__} after {e}")
+        attempt += 1
+        time.sleep(min(5, 0.1 * 2 ** attempt) * random.random())
+
+
+def updateTrackedFile(record, updateExpression, conditionExpression, values):
+    ddb.update_item(
+        TableName=_tracking_table,
+        Key={'objectName': {'S': record['objectName']}},
+        UpdateExpression=updateExpression,
+        ConditionExpression=conditionExpression,
+        ExpressionAttributeValues=values)
+
+
+"""take a lease on a pending row, returns the row with its attempts, or None if it is not pending or another process holds it"""
+def claimFile(record):
+    now = round(time.time() * 1000)
+    try:
+        response = ddb.update_item(
+            TableName=_tracking_table,
+            Key={'objectName': {'S': record['objectName']}},
+            UpdateExpression=dbDynoClaim,
+            ConditionExpression=dbDynoClaimCondition,
+            ExpressionAttributeValues={
+                ':pending': {'S': WORK_PENDING},
+                ':owner': {'S': _worker_id},
+                ':now': {'N': str(now)},
+                ':leaseExpires': {'N': str(now + leaseSeconds * 1000)},
+                ':zero': {'N': '0'},
+                ':bucketName': {'S': record['bucketName']}
+            },
+            ReturnValues='ALL_NEW')
+    except ddb.exceptions.ConditionalCheckFailedException:
+        return None
+    return {k: deserializer.deserialize(v) for k, v in response['Attributes'].items()}
+
+
+"""the same attempt of a file always gets the same token, Textract returns the job of the first request for a repeated token"""
+def clientRequestTokenFor(claimed):
+    return hashlib.sha256(f"{claimed['bucketName']}/{claimed['objectName']}#{claimed['attempts']}".encode('utf-8')).hexdigest()
+
+
+"""store the job of a claimed row sent to Textract, which removes the row from the pending work, fails if the lease was lost"""
+def updateSentFile(claimed, txJobId):
+    updateTrackedFile(claimed, dbDynoUpdateSent, dbDynoLeaseHeld, {
+        ':submitted': {'S': WORK_SUBMITTED},
+        ':txJobId': {'S': txJobId},
+        ':outputbucketName': {'S': _output_bucket},
+        ':txJobStatus': {'S': JOB_IN_PROGRESS},
+        ':jobShard': {'S': pendingShardFor(claimed['objectName'])},
+        ':one': {'N': '1'},
+        ':leaseExpires': {'N': str(round(time.time() * 1000) + jobLeaseSeconds * 1000)},
+        ':owner': {'S': _worker_id},
+        ':pending': {'S': WORK_PENDING}
+    })
+
+
+"""count a failed StartDocumentTextDetection call, the row is released for a retry or FAILED once it is out of attempts"""
+def updateStartFailed(claimed):
+    leaseHeld = {':one': {'N': '1'}, ':owner': {'S': _worker_id}, ':pending': {'S': WORK_PENDING}}
+    try:
+        if claimed['attempts'] + 1 < textractMaxAttempts:
+            updateTrackedFile(claimed, dbDynoUpdateStartFailed, dbDynoLeaseHeld, leaseHeld)
+        else:
+            updateTrackedFile(claimed, dbDynoUpdateGaveUp, dbDynoLeaseHeld, {
+                **leaseHeld,
+                ':failed': {'S': WORK_FAILED},
+                ':txJobId': {'S': '-1'},
+                ':outputbucketName': {'S': ''},
+                ':txJobStatus': {'S': 'FAILED'}
+            })
+    except ddb.exceptions.ConditionalCheckFailedException:
+        """the lease expired and another process has the row"""
+        pass
+
+
+"""store the final status of a job, a FAILED job puts its row back into the pending work until it is out of attempts"""
+def updateJobStatus(record, txJobId, status):
+    values = {':txJobId': {'S': txJobId}, ':txJobStatus': {'S': status}}
+    try:
+        if status in JOB_SUCCEEDED_STATUSES:
+            updateTrackedFile(record, dbDynoUpdateJobStatus, 'txJobId = :txJobId', {**values, ':workState': {'S': WORK_SUCCEEDED}})
+            return
+        try:
+            updateTrackedFile(record, dbDynoUpdateJobRetry, 'txJobId = :txJobId AND attempts < :maxAttempts', {
+                **values,
+                ':pending': {'S': WORK_PENDING},
+                ':empty': {'S': ''},
+                ':pendingShard': {'S': pendingShardFor(record['objectName'])},
+                ':maxAttempts': {'N': str(textractMaxAttempts)}
+            })
+        except ddb.exceptions.ConditionalCheckFailedException:
+            updateTrackedFile(record, dbDynoUpdateJobStatus, 'txJobId = :txJobId', {**values, ':workState': {'S': WORK_FAILED}})
+    except ddb.exceptions.ConditionalCheckFailedException:
+        """the row has moved on to another job, this status is stale"""
+        pass
+
+
+"""take over the job of a row this process submitted before it restarted, or whose job lease expired, returns True if this process now tracks it"""
+def adoptTextractJob(record):
+    now = round(time.time() * 1000)
+    try:
+        updateTrackedFile(record, dbDynoAdoptJob, dbDynoAdoptJobCondition, {
+            ':owner': {'S': _worker_id},
+            ':now': {'N': str(now)},
+            ':leaseExpires': {'N': str(now + jobLeaseSeconds * 1000)},
+            ':txJobId': {'S': record['txJobId']},
+            ':submitted': {'S': WORK_SUBMITTED}
+        })
+    except ddb.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+"""free the window slot of a finished Textract job and store its status in DynamoDB"""
+def completeTextractJob(window, jobId, status):
+    record = window.get(jobId)
+    try:
+        if record is not None:
+            updateJobStatus(record, jobId, status)
+    finally:
+        """only free the slot once the status is stored, orchestrate() returns when the window is empty"""
+        window.release(jobId)
+
+
+"""release the slots of finished jobs by polling the oldest jobs in flight first, jobPollBatchSize per round, only those in flight for minAgeSeconds"""
+def pollTextractJobs(window, stopped, intervalSeconds=jobPollIntervalSeconds, minAgeSeconds=0):
+    pollGovernor = TextractRateGovernor(jobPollTPS, minTPS=min(textractMinTPS, jobPollTPS))
+    while not stopped.wait(intervalSeconds):
+        for jobId, _ in window.oldest(jobPollBatchSize, minAgeSeconds):
+            pollGovernor.acquire()
+            try:
+                response = callTextract(txract.get_document_text_detection, JobId=jobId, MaxResults=1)
+            except Exception as e:
+                errorCode = getattr(e, 'response', {}).get('Error', {}).get('Code')
+                if errorCode in THROTTLING_ERRORS:
+                    pollGovernor.throttled()
+                    break
+                logger.error(e)
+                if errorCode == 'InvalidJobIdException':
+                    completeTextractJob(window, jobId, 'FAILED')
+                continue
+            pollGovernor.success()
+            if response['JobStatus'] != JOB_IN_PROGRESS:
+                completeTextractJob(window, jobId, response['JobStatus'])
+
+
+"""release the slots of finished jobs from the Textract completion notifications (SNS topic -> SQS queue).
+Several feeders or shards may read the same queue, each one only handles and deletes the completions of the jobs in its own window
+and returns the others to the queue for their owner. A completion that overtakes the start of its job comes back the same way.
+Give the queue a redrive policy for completions no feeder tracks anymore"""
+def consumeTextractCompletions(window, stopped):
+    sqs = boto3.client('sqs', config=config, endpoint_url=_sqs_endpoint_url or None)
+    while not stopped.is_set():
+        response = sqs.receive_message(QueueUrl=_completion_queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=20)
+        handled, returned = [], []
+        for message in response.get('Messages', []):
+            body = json.loads(message['Body'])
+            """SNS wraps the Textract notification in its own envelope unless raw message delivery is on"""
+            notification = json.loads(body['Message']) if 'Message' in body else body
+            if window.get(notification['JobId']) is None:
+                returned.append(message)
+                continue
+            completeTextractJob(window, notification['JobId'], notification['Status'])
+            handled.append(message)
+        if handled:
+            sqs.delete_message_batch(QueueUrl=_completion_queue_url, Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(handled)])
+        if returned:
+            sqs.change_message_visibility_batch(QueueUrl=_completion_queue_url, Entries=[
+                {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle'], 'VisibilityTimeout': completionReturnSeconds} for i, message in enumerate(returned)])
+
+
+"""Enumarete over bucket objects and put into DynamoDB table, a list page at a time with parallel batch writes"""
+def fetchAllObjectsInBucketandStoreName(writerCount=ingestWriterCount, resume=True, listPartitions=ingestListPartitions):
     
     print("method - fetchAllObjectsInBucketandStoreName")
     logger.info(f"started - {time.perf_counter()}")
+
+    """continue after the last page a previous run stored completely, the parallel listing has no single position to resume from"""
     s3_profile = S3Profile(_input_bucket, _input_prefix)
-    counter = 0
-    for item in s3_profile.profile_object_list:
-        DocumentObjStatusModel(
-            objectName=item['fileObj'],
-            bucketName=_input_bucket,
-            createDate=round(time.time() * 1000),
-            outputbucketName='',
-            txJobId='').save()
-        counter += 1
+    checkpoint = loadIngestCheckpoint() if resume and listPartitions == 1 else {}
+    continuationToken = checkpoint.get('ContinuationToken')
+    counter = checkpoint.get('Count', 0)
+    if continuationToken:
+        print(f"Resuming after {counter} objects")
+    elif listPartitions == 1:
+        """mark the ingest as started, a restarted script only ingests again while it is unfinished"""
+        saveIngestCheckpoint(None, 0)
+
+    """pages are written in parallel, the checkpoint only moves past pages in listing order once they are written"""
+    pagesInFlight = deque()
+    def finishOldestPage():
+        nonlocal counter
+        future, nextToken, pageCount = pagesInFlight.popleft()
+        future.result()
+        counter += pageCount
+        if listPartitions == 1:
+            saveIngestCheckpoint(nextToken, counter)
+
+    with ThreadPoolExecutor(max_workers=writerCount) as executor:
+        if listPartitions == 1:
+            pages = s3_profile.pages(continuationToken)
+        else:
+            pages = ((objectNames, None) for objectNames in s3_profile.parallelPages(listPartitions))
+        for objectNames, nextToken in pages:
+            pagesInFlight.append((executor.submit(writeObjectNamesToDynamoDB, objectNames), nextToken, len(objectNames)))
+            while pagesInFlight and (pagesInFlight[0][0].done() or len(pagesInFlight) > 2 * writerCount):
+                finishOldestPage()
+        while pagesInFlight:
+            finishOldestPage()
+
+    """the listing is complete, a new run starts from the beginning"""
+    if os.path.exists(_ingest_checkpoint_file):
+        os.remove(_ingest_checkpoint_file)
 
     logger.info(f"finished - {time.perf_counter()}")
     print("Populated " + str(counter) + " rows in DynamoDB table " + _tracking_table)
 
 
+"""put rows for the object names with BatchWriteItem, 25 at a time, retrying unprocessed items with backoff"""
+def writeObjectNamesToDynamoDB(objectNames):
+    createDate = round(time.time() * 1000)
+    requests = [{'PutRequest': {'Item': DocumentObjStatusModel(
+        objectName=objectName,
+        bucketName=_input_bucket,
+        createDate=createDate,
+        outputbucketName='',
+        txJobId='',
+        workState=WORK_PENDING,
+        attempts=0,
+        pendingShard=pendingShardFor(objectName)).serialize()}} for objectName in objectNames]
+
+    for start in range(0, len(requests), 25):
+        unprocessed = {_tracking_table: requests[start:start + 25]}
+        attempt = 0
+        while unprocessed:
+            if attempt:
+                if attempt > 10:
+                    raise RuntimeError(f"{len(unprocessed[_tracking_table])} items not written after {attempt} attempts")
+                time.sleep(min(5, 0.05 * 2 ** attempt) * random.random())
+            unprocessed = ddb.batch_write_item(RequestItems=unprocessed).get('UnprocessedItems')
+            attempt += 1
+
+
+def loadIngestCheckpoint():
+    if not os.path.exists(_ingest_checkpoint_file):
+        return {}
+    with open(_ingest_checkpoint_file) as f:
+        checkpoint = json.load(f)
+    """a checkpoint of another bucket or prefix does not apply"""
+    if checkpoint.get('Bucket') != _input_bucket or checkpoint.get('Prefix') != _input_prefix:
+        return {}
+    return checkpoint
+
+
+def saveIngestCheckpoint(continuationToken, count):
+    with open(_ingest_checkpoint_file + ".tmp", 'w') as f:
+        json.dump({'Bucket': _input_bucket, 'Prefix': _input_prefix, 'ContinuationToken': continuationToken, 'Count': count}, f)
+    os.replace(_ingest_checkpoint_file + ".tmp", _ingest_checkpoint_file)
+
+
 """select rows from DyanmoDB table"""
 def getFilesToSendToTextractfromDynamoDB():
 
-    results = []
-
     """Query DynamoDB Table for object names and stop when reached max count"""
     try:
-        ddbresponse = ddb.execute_statement(Statement=dbDynoSelect, Limit=500, Parameters=[{'S': ""}])                                         
-        while 'NextToken' in ddbresponse and len(results) < dynamoDBMaxlistCount:
-            for record in ddbresponse['Items']:
-                deserialized_document = {k: deserializer.deserialize(v) for k, v in record.items()}
-                results.append(deserialized_document)
-                if len(results) == dynamoDBMaxlistCount:
-                    break
-            ddbresponse = ddb.execute_statement(Statement=dbDynoSelect, Limit=500, NextToken=ddbresponse['NextToken'], Parameters=[{'S': ""}]) 
-        if (len(results) < dynamoDBMaxlistCount):
-            for record in ddbresponse['Items']:
-                deserialized_document = {k: deserializer.deserialize(v) for k, v in record.items()}
-                results.append(deserialized_document)
-                if len(results) == dynamoDBMaxlistCount:
-                    break
-        
-        return results
+        return list(itertools.islice(iterFilesToSendToTextractfromDynamoDB(), dynamoDBMaxlistCount))
 
     except Exception as e:
         logger.error(e)
         return 1
 
 
-"""Create DynamoDB table if it does not exist"""
+"""yield the rows of the Textract jobs still in progress in the shard, from the sparse index of the jobs in progress"""
+def iterTextractJobsInProgressfromDynamoDB(shardIndex=0, shardCount=1):
+
+    if hasIndex(jobsInProgressIndexName):
+        yield from queryIndexShards(jobsInProgressIndexName, 'jobShard', shardIndex, shardCount)
+        return
+
+    """tables without the index are scanned"""
+    nextToken = {}
+    while True:
+        ddbresponse = ddb.execute_statement(Statement=dbDynoSelectJobsInProgress, Limit=500, Parameters=[{'S': JOB_IN_PROGRESS}], **nextToken)
+        for record in ddbresponse['Items']:
+            yield {k: deserializer.deserialize(v) for k, v in record.items()}
+        if 'NextToken' not in ddbresponse:
+            return
+        nextToken = {'NextToken': ddbresponse['NextToken']}
+
+
+"""the partition of the pending work index, and of the index of the jobs in progress, a row goes to, the same in every process"""
+def pendingShardFor(objectName):
+    return str(zlib.crc32(objectName.encode('utf-8')) % pendingShardCount)
+
+
+"""tables created before the pending work index or the index of the jobs in progress do not have them"""
+@lru_cache(maxsize=None)
+def hasIndex(indexName):
+    table = ddb.describe_table(TableName=_tracking_table)['Table']
+    return any(index['IndexName'] == indexName for index in table.get('GlobalSecondaryIndexes', []))
+
+
+"""the shard of the runner processes that sends a row, the same in every process"""
+def inShard(objectName, shardIndex, shardCount):
+    return shardCount == 1 or zlib.crc32(objectName.encode('utf-8')) % shardCount == shardIndex
+
+
+"""yield the pending rows of the DyanmoDB table in the shard page by page, following the cursor of every page so every row is read once per pass"""
+def iterFilesToSendToTextractfromDynamoDB(shardIndex=0, shardCount=1):
+
+    if not hasIndex(pendingIndexName):
+        yield from (record for record in scanFilesToSendToTextractfromDynamoDB() if inShard(record['objectName'], shardIndex, shardCount))
+        return
+
+    """the sparse index only holds the rows still to send"""
+    yield from queryIndexShards(pendingIndexName, 'pendingShard', shardIndex, shardCount)
+
+
+"""query the partitions of a sparse index sharded by pendingShardFor in turn, a page at a time, yielding the rows of the runner shard.
+When shardCount divides pendingShardCount the rows of an index partition are all in the same runner shard"""
+def queryIndexShards(indexName, shardAttribute, shardIndex=0, shardCount=1):
+
+    indexShards = [shard for shard in range(pendingShardCount) if pendingShardCount % shardCount or shard % shardCount == shardIndex]
+    cursors = {str(shard): {} for shard in indexShards}
+    while cursors:
+        for shard in list(cursors):
+            ddbresponse = ddb.query(TableName=_tracking_table, IndexName=indexName, Limit=500,
+                                    KeyConditionExpression=f'{shardAttribute} = :shard',
+                                    ExpressionAttributeValues={':shard': {'S': shard}},
+                                    **cursors[shard])
+            for record in ddbresponse['Items']:
+                record = {k: deserializer.deserialize(v) for k, v in record.items()}
+                if inShard(record['objectName'], shardIndex, shardCount):
+                    yield record
+            if 'LastEvaluatedKey' in ddbresponse:
+                cursors[shard] = {'ExclusiveStartKey': ddbresponse['LastEvaluatedKey']}
+            else:
+                del cursors[shard]
+
+
+"""yield the pending rows with a full table scan, for tables without the pending work index"""
+def scanFilesToSendToTextractfromDynamoDB():
+
+    nextToken = {}
+    while True:
+        ddbresponse = ddb.execute_statement(Statement=dbDynoSelect, Limit=500, Parameters=[{'S': ""}], **nextToken)
+        for record in ddbresponse['Items']:
+            yield {k: deserializer.deserialize(v) for k, v in record.items()}
+        if 'NextToken' not in ddbresponse:
+            return
+        nextToken = {'NextToken': ddbresponse['NextToken']}
+
+
+"""Create DynamoDB table if it does not exist, returns True if it was created"""
 def createDynamoDB():
     if not DocumentObjStatusModel.exists():
         print("creating DynamoDB table " + _tracking_table + " in " + boto3.Session().region_name + " for tracking")
@@ -150,26 +639,161 @@ def createDynamoDB():
                                          write_capacity_units=150,
                                          wait=True)
         print("DynamoDB table " + _tracking_table + " created")
-
-
-"""custom class, wrapping a list in order to make it thread safe""" 
-class FileNameObjectsThreadSafeList():
-    def __init__(self):
-        self._list = list()
-        self._lock = Lock()
-
-    def append(self, value):
+        return True
+    return False
+
+
+"""Token bucket shared by the workers that paces the Textract calls, with AIMD (additive increase, multiplicative decrease) of the rate on throttling"""
+class TextractRateGovernor():
+    def __init__(self, maxTPS, minTPS=0.5, additiveIncrease=0.5, decreaseFactor=0.5, metricsWindowSeconds=60):
+        self.maxTPS = maxTPS
+        self.minTPS = minTPS
+        self.tps = maxTPS
+        self.additiveIncrease = additiveIncrease # TPS gained per second without throttling
+        self.decreaseFactor = decreaseFactor
+        self.metricsWindowSeconds = metricsWindowSeconds
+        self.calls = 0
+        self.throttles = 0
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._started = self._updated
+        self._lastDecrease = 0.0
+        self._recentCalls = deque()
+        self._recentThrottles = deque()
+        self._lock = threading.Lock()
+
+    """block until the bucket holds a token and take it"""
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(max(1.0, self.tps), self._tokens + (now - self._updated) * self.tps)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.calls += 1
+                    self._recentCalls.append(now)
+                    return
+                wait = (1 - self._tokens) / self.tps
+            time.sleep(wait)
+
+    """a call went through, raise the rate by additiveIncrease per second"""
+    def success(self):
         with self._lock:
-            self._list.append(value)
+            self.tps = min(self.maxTPS, self.tps + self.additiveIncrease / self.tps)
 
-    def pop(self):
+    """a call was throttled, cut the rate, at most once a second as the calls in flight are throttled together"""
+    def throttled(self):
         with self._lock:
-            response = self._list.pop()
-            return response
-    
-    def length(self):
+            now = time.monotonic()
+            self.throttles += 1
+            self._recentThrottles.append(now)
+            self._tokens = 0.0
+            if now - self._lastDecrease >= 1.0:
+                self.tps = max(self.minTPS, self.tps * self.decreaseFactor)
+                self._lastDecrease = now
+
+    """current rate, achieved TPS and throttle rate over the last metricsWindowSeconds"""
+    def metrics(self):
         with self._lock:
-            return len(self._list)
+            now = time.monotonic()
+            for recent in (self._recentCalls, self._recentThrottles):
+                while recent and recent[0] < now - self.metricsWindowSeconds:
+                    recent.popleft()
+            window = max(min(self.metricsWindowSeconds, now - self._started), 1e-9)
+            return {
+                'allowedTPS': round(self.tps, 2),
+                'achievedTPS': round(len(self._recentCalls) / window, 2),
+                'throttleRate': round(len(self._recentThrottles) / len(self._recentCalls), 4) if self._recentCalls else 0.0,
+                'calls': self.calls,
+                'throttles': self.throttles
+            }
+
+"""The Textract jobs in flight, at most maxJobs; workers wait in reserve() for a free slot"""
+class TextractJobWindow():
+    def __init__(self, maxJobs):
+        self.maxJobs = maxJobs
+        self._jobs = OrderedDict() # jobId -> row, oldest first
+        self._since = {} # jobId -> time.monotonic() the job came into the window
+        self._reserved = 0 # slots of calls being made
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._jobs)
+
+    def reserve(self):
+        with self._condition:
+            while len(self._jobs) + self._reserved >= self.maxJobs:
+                self._condition.wait()
+            self._reserved += 1
+
+    """the job of a reserved slot was started"""
+    def started(self, jobId, record):
+        with self._condition:
+            self._reserved -= 1
+            self._jobs[jobId] = record
+            self._since[jobId] = time.monotonic()
+
+    """the call of a reserved slot failed"""
+    def cancel(self):
+        with self._condition:
+            self._reserved -= 1
+            self._condition.notify_all()
+
+    """a job started before, e.g. by an earlier run, it counts as old as its start is not known"""
+    def add(self, jobId, record):
+        with self._condition:
+            self._jobs[jobId] = record
+            self._since[jobId] = float('-inf')
+
+    """the job finished, returns its row or None if it is not in the window"""
+    def release(self, jobId):
+        with self._condition:
+            record = self._jobs.pop(jobId, None)
+            self._since.pop(jobId, None)
+            self._condition.notify_all()
+            return record
+
+    def get(self, jobId):
+        with self._condition:
+            return self._jobs.get(jobId)
+
+    """up to count of the oldest jobs, that have been in the window for at least minAgeSeconds"""
+    def oldest(self, count, minAgeSeconds=0):
+        with self._condition:
+            startedBefore = time.monotonic() - minAgeSeconds
+            jobs = (job for job in self._jobs.items() if self._since[job[0]] <= startedBefore)
+            return list(itertools.islice(jobs, count))
+
+    """True once no job is in flight, False if that did not happen within timeout seconds"""
+    def waitUntilEmpty(self, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._jobs and not self._reserved, timeout)
+
+"""Sparse index of the rows still to send to Textract, a row leaves it when pendingShard is removed"""
+class PendingWorkIndex(GlobalSecondaryIndex):
+
+    class Meta:
+        index_name = pendingIndexName
+        projection = IncludeProjection(['bucketName'])
+        read_capacity_units = 150
+        write_capacity_units = 150
+
+    pendingShard = UnicodeAttribute(hash_key=True)
+    createDate = NumberAttribute(range_key=True)
+
+"""Sparse index of the rows whose Textract job is in progress, a row leaves it when jobShard is removed"""
+class JobsInProgressIndex(GlobalSecondaryIndex):
+
+    class Meta:
+        index_name = jobsInProgressIndexName
+        projection = IncludeProjection(['bucketName', 'txJobId'])
+        read_capacity_units = 150
+        write_capacity_units = 150
+
+    jobShard = UnicodeAttribute(hash_key=True)
+    createDate = NumberAttribute(range_key=True)
 
 """DynamoDB Class"""
 class DocumentObjStatusModel(Model):
@@ -182,27 +806,82 @@ class DocumentObjStatusModel(Model):
     bucketName = UnicodeAttribute(null=True)
     createDate = NumberAttribute(null=True)
     txJobId = UnicodeAttribute(null=True)
+    txJobStatus = UnicodeAttribute(null=True)
     outputbucketName = UnicodeAttribute(null=True)
-
-"""S3 Class for retrieving Object Names"""
+    workState = UnicodeAttribute(null=True)
+    attempts = NumberAttribute(null=True)
+    leaseOwner = UnicodeAttribute(null=True)
+    leaseExpires = NumberAttribute(null=True)
+    pendingShard = UnicodeAttribute(null=True)
+    jobShard = UnicodeAttribute(null=True)
+    pendingWorkIndex = PendingWorkIndex()
+    jobsInProgressIndex = JobsInProgressIndex()
+
+"""S3 Class for retrieving Object Names, lazily a list page at a time with a shared client"""
 class S3Profile:
-    def __init__(self, bucketName, prefixName):
+    """first characters of the keys after the prefix, the ranges of parallelPages are split at them"""
+    partitionCharacters = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+    def __init__(self, bucketName, prefixName, s3=None):
         self.bucketName = bucketName
         self.prefixName = prefixName
-        self.s3_client = boto3.client('s3')
-        self.profile_object_list = []
-        paginator = self.s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=self.bucketName, Prefix=self.prefixName)
-        try:
-            for page in pages:
-                for content in page.get('Contents'):
-                    file = content.get('Key')
-                    self.profile_object_list.append({"fileObj": file})
-        except Exception as e:
-            print("Error, most likely caused by either invalid bucket name or invalid prefix name")
-            logger.error(e)
-
-
+        self.s3_client = s3 or s3_client
+
+    """yield the keys of each list page with the token that continues after it, keys from endBefore on end the listing"""
+    def pages(self, continuationToken=None, startAfter=None, endBefore=None):
+        listArguments = {'Bucket': self.bucketName, 'Prefix': self.prefixName}
+        if startAfter:
+            listArguments['StartAfter'] = startAfter
+        while True:
+            if continuationToken:
+                listArguments['ContinuationToken'] = continuationToken
+            response = self.s3_client.list_objects_v2(**listArguments)
+            continuationToken = response.get('NextContinuationToken')
+            keys = [content['Key'] for content in response.get('Contents', [])]
+            if endBefore is not None and keys and keys[-1] >= endBefore:
+                yield [key for key in keys if key < endBefore], None
+                return
+            yield keys, continuationToken
+            if not continuationToken:
+                return
+
+    def __iter__(self):
+        for keys, _ in self.pages():
+            yield from keys
+
+    """key ranges (startAt, endBefore) split by the first character after the prefix, the outer ranges are open"""
+    def partitions(self, partitionCount):
+        characters = self.partitionCharacters
+        partitionCount = max(1, min(partitionCount, len(characters)))
+        bounds = [self.prefixName + characters[i * len(characters) // partitionCount] for i in range(1, partitionCount)]
+        return list(zip([None] + bounds, bounds + [None]))
+
+    """list the key ranges in parallel, pages are yielded as they arrive and in no particular order"""
+    def parallelPages(self, partitionCount):
+        pageQueue = queue.Queue(maxsize=2 * partitionCount)
+
+        def listPartition(startAt, endBefore):
+            try:
+                """S3 lists the keys after StartAfter, start just before startAt, keys below it are filtered"""
+                startAfter = startAt[:-1] + chr(ord(startAt[-1]) - 1) + '\U0010ffff' if startAt else None
+                for keys, _ in self.pages(startAfter=startAfter, endBefore=endBefore):
+                    pageQueue.put([key for key in keys if not startAt or key >= startAt])
+                pageQueue.put(None)
+            except Exception as e:
+                pageQueue.put(e)
+
+        partitions = self.partitions(partitionCount)
+        for startAt, endBefore in partitions:
+            threading.Thread(target=listPartition, args=(startAt, endBefore), daemon=True).start()
+        remaining = len(partitions)
+        while remaining:
+            page = pageQueue.get()
+            if page is None:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            elif page:
+                yield page
 
 
 """Main entry point into script --- Start Here"""
@@ -211,10 +890,11 @@ if __name__ == "__main__":
     print("started")
 
     """created DynamoDB table for tracking object names"""
-    createDynamoDB()
+    tableCreated = createDynamoDB()
 
-    """Fetch all object names in bucket and upsert rows into DynamoDB"""
-    fetchAllObjectsInBucketandStoreName()
+    """Fetch all object names in bucket and upsert rows into DynamoDB, a restarted run keeps the rows and their state unless the ingest was interrupted"""
+    if tableCreated or os.path.exists(_ingest_checkpoint_file):
+        fetchAllObjectsInBucketandStoreName()
 
     """Start the process of sending files to Textract using multiple threads"""
     orchestrate()
@@ -0,0 +1,168 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import textractFeeder
+import convertTextractOutIntoTextHelper
+
+
+"""Command line of the runner, the settings it does not take keep the defaults of the scripts"""
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Send the documents of a bucket to Textract and convert the output into text, "
+                                                 "with the rows split into shards by hash of objectName, one process per shard")
+    parser.add_argument('--input-bucket', default=textractFeeder._input_bucket)
+    parser.add_argument('--input-prefix', default=textractFeeder._input_prefix)
+    parser.add_argument('--output-bucket', default=textractFeeder._output_bucket)
+    parser.add_argument('--phase', choices=['ingest', 'feed', 'text', 'all'], default='all',
+                        help="ingest the bucket into the tracking table, send the rows to Textract, convert the output into text, or all of them in turn")
+    parser.add_argument('--shard-count', type=int, default=1, help="number of shards over all hosts")
+    parser.add_argument('--shard-index', type=int, action='append',
+                        help="shard this host runs, may be given more than once, all shards by default")
+    parser.add_argument('--threads', type=int, default=textractFeeder.threadCountforTextractAPICall, help="Textract threads per shard")
+    parser.add_argument('--text-threads', type=int, default=convertTextractOutIntoTextHelper.threadCountforTextExtract, help="text extraction threads per shard")
+    parser.add_argument('--max-tps', type=float, default=textractFeeder.textractMaxTPS, help="StartDocumentTextDetection calls per second over all shards")
+    parser.add_argument('--max-jobs', type=int, default=textractFeeder.textractMaxConcurrentJobs, help="Textract jobs in flight over all shards")
+    parser.add_argument('--sns-topic-arn', default=textractFeeder._sns_topic_arn, help="SNS topic Textract notifies on job completion")
+    parser.add_argument('--sns-role-arn', default=textractFeeder._sns_role_arn, help="role that allows Textract to publish to the topic")
+    parser.add_argument('--completion-queue-url', default=textractFeeder._completion_queue_url,
+                        help="SQS queue subscribed to the topic the feeder learns about completed jobs from, the job status is polled without it")
+    parser.add_argument('--text-queue-url', default=convertTextractOutIntoTextHelper._completion_queue_url,
+                        help="SQS queue with the Textract completion notifications, the text conversion then runs next to the feed, converting each job as it completes")
+    parser.add_argument('--sqs-endpoint-url', default=convertTextractOutIntoTextHelper._sqs_endpoint_url, help="endpoint of a local SQS stand-in")
+    parser.add_argument('--ingest', action='store_true', help="ingest the bucket even if the tracking table already exists")
+    parser.add_argument('--summary-file', help="write the summary of the shards of this host as JSON")
+    parser.add_argument('--merge', nargs='+', metavar='SUMMARY_FILE', help="only print the combined summary of the summary files of several hosts")
+    args = parser.parse_args(argv)
+    if not args.merge:
+        if args.shard_count < 1:
+            parser.error("--shard-count has to be at least 1")
+        if any(index < 0 or index >= args.shard_count for index in args.shard_index or []):
+            parser.error("--shard-index has to be between 0 and --shard-count - 1")
+        """Textract only sends completion notifications with a notification channel"""
+        if (args.text_queue_url or args.completion_queue_url) and not (args.sns_topic_arn and args.sns_role_arn):
+            parser.error("--text-queue-url and --completion-queue-url need --sns-topic-arn and --sns-role-arn")
+    return args
+
+
+"""Point the module globals of the scripts at the bucket of the run, the leases of every shard get their own owner"""
+def configureScripts(args, shardIndex=None):
+    textractFeeder._input_bucket = args['input_bucket']
+    textractFeeder._input_prefix = args['input_prefix']
+    textractFeeder._output_bucket = args['output_bucket']
+    textractFeeder._sns_topic_arn = args['sns_topic_arn']
+    textractFeeder._sns_role_arn = args['sns_role_arn']
+    textractFeeder._completion_queue_url = args['completion_queue_url']
+    textractFeeder._sqs_endpoint_url = args['sqs_endpoint_url']
+    convertTextractOutIntoTextHelper._completion_queue_url = args['text_queue_url']
+    convertTextractOutIntoTextHelper._sqs_endpoint_url = args['sqs_endpoint_url']
+    if shardIndex is not None:
+        textractFeeder._worker_id = f"{socket.gethostname()}-shard{shardIndex}"
+
+
+"""Run the phases of one shard, in its own process, and return its summary"""
+def runShard(args, shardIndex):
+    configureScripts(args, shardIndex)
+    shardCount = args['shard_count']
+    summary = {'shard': shardIndex}
+    """with a completion queue the text conversion overlaps with the feed, it runs until the feed is done and then drains the queue"""
+    feedDone = threading.Event()
+    completions = None
+    if args['phase'] in ('text', 'all') and args['text_queue_url']:
+        completions = ThreadPoolExecutor(max_workers=1).submit(convertTextractOutIntoTextHelper.consumeTextractCompletions,
+                                                               threadCount=args['text_threads'], stopped=feedDone)
+    if args['phase'] in ('feed', 'all'):
+        """the Textract quotas are per account, every shard gets its part"""
+        summary['feed'] = textractFeeder.orchestrate(threadCount=args['threads'],
+                                                     maxTPS=args['max_tps'] / shardCount,
+                                                     maxConcurrentJobs=max(1, args['max_jobs'] // shardCount),
+                                                     shardIndex=shardIndex, shardCount=shardCount)
+    feedDone.set()
+    if completions is not None:
+        summary['text'] = completions.result()
+    elif args['phase'] in ('text', 'all'):
+        summary['text'] = convertTextractOutIntoTextHelper.orchestrateTextExtraction(threadCount=args['text_threads'],
+                                                                                    shardIndex=shardIndex, shardCount=shardCount)
+    return summary
+
+
+"""Ingest the bucket once, before the shards start, if the table is new, the last ingest was interrupted or it is asked for"""
+def ingest(args):
+    configureScripts(args)
+    tableCreated = textractFeeder.createDynamoDB()
+    if tableCreated or args['ingest'] or args['phase'] == 'ingest' or os.path.exists(textractFeeder._ingest_checkpoint_file):
+        textractFeeder.fetchAllObjectsInBucketandStoreName()
+
+
+"""Totals over the shard summaries, the latency percentiles over the documents of all shards"""
+def combineSummaries(shardSummaries):
+    feeds = [summary['feed'] for summary in shardSummaries if 'feed' in summary]
+    texts = [summary['text'] for summary in shardSummaries if 'text' in summary]
+    total = {'shards': len(shardSummaries)}
+    if feeds:
+        for key in ('rows', 'submitted', 'failed', 'skipped', 'textractCalls', 'throttles'):
+            total[f"feed_{key}"] = sum(feed[key] for feed in feeds)
+        total['feed_seconds'] = max(feed['seconds'] for feed in feeds)
+    if texts:
+        latencies = sorted(latency for text in texts for latency in text['latencies'])
+        seconds = max(text['seconds'] for text in texts)
+        total['text_documents'] = sum(text['documents'] for text in texts)
+        total['text_failed'] = sum(text['failed'] for text in texts)
+        total['text_seconds'] = seconds
+        total['text_documents_per_second'] = len(latencies) / seconds if seconds else 0
+        if latencies:
+            for name, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                total[f"text_latency_{name}"] = latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+            total['text_latency_max'] = latencies[-1]
+    return total
+
+
+def printSummary(shardSummaries, total):
+    for summary in sorted(shardSummaries, key=lambda summary: summary['shard']):
+        line = f"shard {summary['shard']}:"
+        if 'feed' in summary:
+            feed = summary['feed']
+            line += f" sent {feed['submitted']}, failed {feed['failed']}, skipped {feed['skipped']}, throttled {feed['throttles']} in {feed['seconds']:.1f} s;"
+        if 'text' in summary:
+            text = summary['text']
+            line += f" text {text['documents']}, failed {text['failed']} in {text['seconds']:.1f} s"
+        print(line)
+    print("total: " + ", ".join(f"{key} {value:.3f}" if isinstance(value, float) else f"{key} {value}" for key, value in total.items()))
+
+
+"""Main entry point of the runner --- Start Here"""
+if __name__ == "__main__":
+    now = time.perf_counter()
+    args = parseArguments()
+
+    if args.merge:
+        shardSummaries = []
+        for summaryFile in args.merge:
+            with open(summaryFile) as f:
+                shardSummaries += json.load(f)['shards']
+        printSummary(shardSummaries, combineSummaries(shardSummaries))
+        raise SystemExit(0)
+
+    runArgs = vars(args)
+    if args.phase in ('ingest', 'all'):
+        ingest(runArgs)
+
+    shardSummaries = []
+    if args.phase != 'ingest':
+        shardIndexes = sorted(set(args.shard_index)) if args.shard_index else list(range(args.shard_count))
+        print(f"running shards {shardIndexes} of {args.shard_count}")
+        """a process per shard, so the shards do not share the GIL"""
+        with multiprocessing.get_context('spawn').Pool(len(shardIndexes)) as pool:
+            shardSummaries = pool.starmap(runShard, [(runArgs, shardIndex) for shardIndex in shardIndexes])
+
+        total = combineSummaries(shardSummaries)
+        printSummary(shardSummaries, total)
+        if args.summary_file:
+            with open(args.summary_file, 'w') as f:
+                json.dump({'shards': shardSummaries, 'total': total}, f)
+
+    print(f"completed in - {time.perf_counter()-now} seconds")